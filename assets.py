@@ -0,0 +1,71 @@
+import pygame
+
+# Images of the client, loaded, scaled and converted to the display format
+# once per process and shared by every sprite that shows them. Variants
+# named in preload() are packed into one atlas surface and handed out as
+# subsurfaces of it, so creating a sprite never touches the disk.
+
+COLORKEY = (0, 0, 0)
+
+
+def load_variant(file_name, scale, angle):
+    # the display must be set up before this, convert() needs its format
+    img = pygame.image.load(file_name).convert()
+    img = pygame.transform.rotozoom(img, angle, scale).convert()
+    img.set_colorkey(COLORKEY)
+    return img
+
+
+class AssetCache:
+    def __init__(self):
+        # (file name, scale, angle) -> surface
+        self.images = {}
+        # (color, width, height) -> surface
+        self.fills = {}
+        self.atlas = None
+
+    def preload(self, variants):
+        # load every (file name, scale, angle) and pack them into rows of
+        # one atlas, tallest first
+        loaded = {key: load_variant(*key) for key in variants if key not in self.images}
+        if not loaded:
+            return
+        order = sorted(loaded, key=lambda key: loaded[key].get_height(), reverse=True)
+        width = max(1024, max(img.get_width() for img in loaded.values()))
+
+        places = {}
+        x = y = row_height = 0
+        for key in order:
+            img = loaded[key]
+            if x + img.get_width() > width:
+                x, y = 0, y + row_height
+                row_height = 0
+            places[key] = (x, y)
+            x += img.get_width()
+            row_height = max(row_height, img.get_height())
+
+        self.atlas = pygame.Surface((width, y + row_height)).convert()
+        self.atlas.fill(COLORKEY)
+        self.atlas.set_colorkey(COLORKEY)
+        for key in order:
+            img = loaded[key]
+            self.atlas.blit(img, places[key])
+            # subsurfaces share the atlas pixels and its colorkey
+            self.images[key] = self.atlas.subsurface(pygame.Rect(places[key], img.get_size()))
+
+    def image(self, file_name, scale, angle):
+        key = (file_name, scale, angle)
+        img = self.images.get(key)
+        if img is None:
+            # not preloaded, load it on its own
+            img = self.images[key] = load_variant(*key)
+        return img
+
+    def fill(self, color, width, height):
+        # a solid rectangle, e.g. a bullet
+        key = (color, width, height)
+        img = self.fills.get(key)
+        if img is None:
+            img = self.fills[key] = pygame.Surface((width, height)).convert()
+            img.fill(color)
+        return img
@@ -0,0 +1,89 @@
+# Benchmark of GameServer.step() with the naive all-pairs collision pass,
+# the spatial hash broadphase and the numpy engine (if numpy is installed).
+#
+#   python bench-collisions.py
+#   python bench-collisions.py --players 50 200 800 --bullets 500 4000 --field 3000 --ticks 20
+
+import argparse
+import copy
+import importlib
+import importlib.util
+import random
+import time
+
+game_server = importlib.import_module('game-server')
+
+
+def make_world(server, players, bullets, seed):
+    rng = random.Random(seed)
+    for i in range(players):
+        player = game_server.Player(rng.uniform(0, server.game_field_width), rng.uniform(0, server.game_field_height), i, None)
+        player.speed_x = rng.uniform(-3, 3)
+        player.speed_y = rng.uniform(-3, 3)
+        server.players.append(player)
+    for i in range(bullets):
+        server.bullets.append(game_server.Bullet(rng.uniform(0, server.game_field_width), rng.uniform(0, server.game_field_height),
+                                                 i, rng.randrange(players), 0, -10))
+
+
+def snapshot(server):
+    if server.engine is not None:
+        bullets = list(zip(server.engine.bullet_id.tolist(), server.engine.bullet_x.tolist(), server.engine.bullet_y.tolist()))
+    else:
+        bullets = [(b.id, b.x, b.y) for b in server.bullets]
+    return [(p.id, p.x, p.y, p.hit_points) for p in server.players], bullets
+
+
+def run(world, ticks, **kwargs):
+    server = game_server.GameServer(**kwargs)
+    server.game_field_width = world.game_field_width
+    server.game_field_height = world.game_field_height
+    server.players = copy.deepcopy(world.players)
+    for bullet in copy.deepcopy(world.bullets):
+        if server.engine is not None:
+            server.engine.spawn_bullet(bullet)
+        else:
+            server.bullets.append(bullet)
+
+    start = time.perf_counter()
+    for _ in range(ticks):
+        server.step()
+    elapsed = time.perf_counter() - start
+    return elapsed / ticks, snapshot(server)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--players', type=int, nargs='+', default=[10, 50, 100, 200, 400])
+    parser.add_argument('--bullets', type=int, nargs='+', default=[100, 1000, 3000])
+    parser.add_argument('--ticks', type=int, default=10)
+    parser.add_argument('--field', type=int, default=800, help='width and height of the game field')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    configs = {'naive': {'broadphase': 'naive'}, 'grid': {'broadphase': 'grid'}}
+    if importlib.util.find_spec('numpy') is not None:
+        configs['numpy'] = {'engine': 'numpy'}
+
+    print(f'{"players":>8} {"bullets":>8}' + ''.join(f' {name + " ms":>10}' for name in configs))
+    for players in args.players:
+        for bullets in args.bullets:
+            world = game_server.GameServer()
+            world.game_field_width = world.game_field_height = args.field
+            make_world(world, players, bullets, args.seed)
+
+            times = []
+            naive_state = None
+            for name, kwargs in configs.items():
+                elapsed, state = run(world, args.ticks, **kwargs)
+                if naive_state is None:
+                    naive_state = state
+                elif state != naive_state:
+                    raise SystemExit(f'{name} and naive results differ for {players} players, {bullets} bullets')
+                times.append(elapsed)
+
+            print(f'{players:>8} {bullets:>8}' + ''.join(f' {elapsed * 1000:>10.2f}' for elapsed in times))
+
+
+if __name__ == '__main__':
+    main()
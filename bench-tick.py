@@ -0,0 +1,166 @@
+# Microbenchmark of the phases of one server tick, without sockets or the
+# scheduler: the simulation step, recording the snapshot and encoding the
+# frames of every client (text, binary keyframes, binary deltas and area of
+# interest deltas for a --view sized view). Every player is a client; the
+# KiB columns are the bytes of all frames of one tick.
+#
+#   python bench-tick.py
+#   python bench-tick.py --players 50 200 --bullets 500 4000 --output after.json --compare before.json
+#
+# Worlds are generated from --seed, so two runs on the same machine measure
+# the same work. --output writes every result as JSON, --compare prints
+# each phase as a ratio against such a file.
+
+import argparse
+import copy
+import importlib
+import importlib.util
+import json
+import platform
+import statistics
+import sys
+import time
+
+game_server = importlib.import_module('game-server')
+bench_collisions = importlib.import_module('bench-collisions')
+
+# encode mode -> (client protocol, view size or None, clients ack every state)
+ENCODE_MODES = {
+    'text': ('text', None, False),
+    'keyframe': ('binary', None, False),
+    'delta': ('binary', None, True),
+    'view': ('binary', 'view', True),
+}
+
+
+def make_server(world, kwargs, client_protocol, view_size):
+    server = game_server.GameServer(view_size=view_size, **kwargs)
+    server.game_field_width = world.game_field_width
+    server.game_field_height = world.game_field_height
+    for player in copy.deepcopy(world.players):
+        # nobody dies, so every tick of a run has the same population
+        player.hit_points = 10 ** 9
+        player.protocol = client_protocol
+        server.players.append(player)
+    for bullet in copy.deepcopy(world.bullets):
+        if server.engine is not None:
+            server.engine.spawn_bullet(bullet)
+        else:
+            server.bullets.append(bullet)
+    return server
+
+
+def run(world, ticks, warmup, kwargs, mode, view_size):
+    # times of every phase over ticks, after warmup ticks that fill the
+    # snapshot history so deltas have a baseline
+    client_protocol, view, acks = ENCODE_MODES[mode]
+    server = make_server(world, kwargs, client_protocol, view_size if view else None)
+    times = {'step': [], 'snapshot': [], 'encode': []}
+    frame_bytes = []
+    for tick in range(warmup + ticks):
+        start = time.perf_counter()
+        server.step()
+        stepped = time.perf_counter()
+        server.record_snapshot()
+        recorded = time.perf_counter()
+        frames = server.encode_frames()
+        encoded = time.perf_counter()
+
+        if acks:
+            for player in server.players:
+                player.acked_seq = server.seq
+        if tick < warmup:
+            continue
+        times['step'].append(stepped - start)
+        times['snapshot'].append(recorded - stepped)
+        times['encode'].append(encoded - recorded)
+        frame_bytes.append(sum(len(frame) for player, frame in frames))
+    return times, frame_bytes
+
+
+def summary(samples):
+    return {
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'median_ms': statistics.median(samples) * 1000,
+        'min_ms': min(samples) * 1000,
+    }
+
+
+def compare(results, path):
+    with open(path) as f:
+        before = {(r['engine'], r['players'], r['bullets'], r['phase']): r for r in json.load(f)['results']}
+    print(f'\nmedian against {path} (< 1 is faster)')
+    print(f'{"engine":>8} {"players":>8} {"bullets":>8} {"phase":>16} {"before ms":>10} {"after ms":>10} {"ratio":>7}')
+    for r in results:
+        old = before.get((r['engine'], r['players'], r['bullets'], r['phase']))
+        if old is None:
+            continue
+        ratio = r['median_ms'] / old['median_ms'] if old['median_ms'] else float('nan')
+        print(f'{r["engine"]:>8} {r["players"]:>8} {r["bullets"]:>8} {r["phase"]:>16} '
+              f'{old["median_ms"]:>10.3f} {r["median_ms"]:>10.3f} {ratio:>7.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--players', type=int, nargs='+', default=[10, 50, 100, 200, 400])
+    parser.add_argument('--bullets', type=int, nargs='+', default=[100, 1000, 3000])
+    parser.add_argument('--engines', nargs='+', choices=['naive', 'grid', 'numpy'], default=['grid', 'numpy'])
+    parser.add_argument('--modes', nargs='+', choices=list(ENCODE_MODES), default=list(ENCODE_MODES))
+    parser.add_argument('--ticks', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--field', type=int, default=800, help='width and height of the game field')
+    parser.add_argument('--view', default='400x400', help='area of interest of the view mode, WIDTHxHEIGHT')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='JSON file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    configs = {'naive': {'broadphase': 'naive'}, 'grid': {'broadphase': 'grid'}, 'numpy': {'engine': 'numpy'}}
+    engines = [name for name in args.engines if name != 'numpy' or importlib.util.find_spec('numpy') is not None]
+    view_size = tuple(int(v) for v in args.view.split('x'))
+
+    results = []
+    print(f'{"engine":>8} {"players":>8} {"bullets":>8} {"step ms":>9} {"snapshot ms":>12}'
+          + ''.join(f' {mode + " ms":>12} {"KiB":>8}' for mode in args.modes))
+    for players in args.players:
+        for bullets in args.bullets:
+            world = game_server.GameServer()
+            world.game_field_width = world.game_field_height = args.field
+            bench_collisions.make_world(world, players, bullets, args.seed)
+
+            for engine in engines:
+                steps, snapshots, row = [], [], []
+                for mode in args.modes:
+                    times, frame_bytes = run(world, args.ticks, args.warmup, configs[engine], mode, view_size)
+                    steps += times['step']
+                    snapshots += times['snapshot']
+                    encode = summary(times['encode'])
+                    kib = statistics.fmean(frame_bytes) / 1024
+                    results.append({'engine': engine, 'players': players, 'bullets': bullets,
+                                    'phase': f'encode-{mode}', 'bytes': statistics.fmean(frame_bytes), **encode})
+                    row.append(f' {encode["median_ms"]:>12.3f} {kib:>8.1f}')
+
+                step, snapshot = summary(steps), summary(snapshots)
+                results.append({'engine': engine, 'players': players, 'bullets': bullets, 'phase': 'step', **step})
+                results.append({'engine': engine, 'players': players, 'bullets': bullets, 'phase': 'snapshot', **snapshot})
+                print(f'{engine:>8} {players:>8} {bullets:>8} {step["median_ms"]:>9.3f} {snapshot["median_ms"]:>12.3f}'
+                      + ''.join(row))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'machine': platform.machine(),
+                'seed': args.seed,
+                'ticks': args.ticks,
+                'field': args.field,
+                'view': args.view,
+                'results': results,
+            }, f, indent=1)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+# Headless load generator: many bot clients from one asyncio loop, speaking
+# the same protocol as game-client.py (text, or binary with deltas and acks).
+#
+#   python bot-swarm.py --bots 1000 --ramp 200 --duration 60
+#   python bot-swarm.py --bots 50 --protocol text --behaviour circle
+#   python bot-swarm.py --bots 10 --script moves.txt
+#   python bot-swarm.py --bots 50 --transport udp --port 8889
+#
+# A script has one "move_x move_y fire seconds" line per step and loops.
+#
+# Every --report seconds it prints, over all bots, the snapshots received
+# per second per bot, the gap between consecutive snapshots, the bytes
+# received per second, the server tick lag and the input to ack latency.
+# Tick lag is how late a state arrived compared to its sequence number at
+# --send-rate, relative to the earliest arrival a bot has seen. Both lag
+# and input latency are only measured by binary bots.
+
+import argparse
+import asyncio
+import itertools
+import random
+import resource
+import time
+
+import compression
+import protocol
+from udp_transport import open_udp_connection
+
+
+def percentiles(values, points=(50, 90, 99)):
+    values = sorted(values)
+    return {p: values[min(len(values) - 1, int(len(values) * p / 100))] for p in points}
+
+
+def format_percentiles(values):
+    if not values:
+        return 'n/a'
+    return ' '.join(f'p{p} {value * 1000:.1f}' for p, value in percentiles(values).items())
+
+
+class Stats:
+    def __init__(self, keep=200000):
+        self.keep = keep
+        self.connected = 0
+        self.failed = 0
+        self.disconnected = 0
+        self.snapshots = 0
+        self.bytes = 0
+        self.gaps = []
+        self.lags = []
+        self.input_lags = []
+        self.all_gaps = []
+        self.all_lags = []
+        self.all_input_lags = []
+        self.total_snapshots = 0
+        self.total_bytes = 0
+        # the compression.DecompressingReaders of bots that asked for it
+        self.decompressors = []
+
+    def received(self, size, gap, lag):
+        self.snapshots += 1
+        self.bytes += size
+        if gap is not None:
+            self.gaps.append(gap)
+        if lag is not None:
+            self.lags.append(lag)
+
+    def input_acked(self, latency):
+        self.input_lags.append(latency)
+
+    def report(self, elapsed, final=False):
+        if final:
+            snapshots, size = self.total_snapshots, self.total_bytes
+            gaps, lags, input_lags = self.all_gaps, self.all_lags, self.all_input_lags
+        else:
+            snapshots, size = self.snapshots, self.bytes
+            gaps, lags, input_lags = self.gaps, self.lags, self.input_lags
+        bots = max(self.connected - self.disconnected, 1)
+        print(f'{"total" if final else "last"} {elapsed:.0f}s: bots {self.connected - self.disconnected} '
+              f'(failed {self.failed}, dropped {self.disconnected}) '
+              f'snapshots/s/bot {snapshots / elapsed / bots:.1f} '
+              f'KiB/s {size / elapsed / 1024:.1f} | '
+              f'gap ms {format_percentiles(gaps)} | tick lag ms {format_percentiles(lags)} | '
+              f'input ack ms {format_percentiles(input_lags)}')
+        if final and self.decompressors:
+            wire = sum(reader.bytes_in for reader in self.decompressors)
+            raw = sum(reader.bytes_out for reader in self.decompressors)
+            seconds = sum(reader.seconds for reader in self.decompressors)
+            print(f'compression {raw / max(wire, 1):.2f}x: {wire / elapsed / 1024:.1f} KiB/s on the wire for '
+                  f'{raw / elapsed / 1024:.1f} KiB/s of states, decompressing takes '
+                  f'{seconds / elapsed / len(self.decompressors) * 100:.3f}% of a CPU per bot')
+
+        if not final:
+            self.total_snapshots += self.snapshots
+            self.total_bytes += self.bytes
+            for window, total in ((self.gaps, self.all_gaps), (self.lags, self.all_lags),
+                                  (self.input_lags, self.all_input_lags)):
+                total.extend(window)
+                if len(total) > self.keep:
+                    total[:] = random.sample(total, self.keep)
+            self.snapshots = 0
+            self.bytes = 0
+            self.gaps = []
+            self.lags = []
+            self.input_lags = []
+
+
+def random_moves(rng):
+    while True:
+        yield rng.choice((-1, 0, 1)), rng.choice((-1, 0, 1)), rng.random() < 0.2, rng.uniform(0.2, 1.5)
+
+
+def circle_moves(rng):
+    directions = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+    start = rng.randrange(len(directions))
+    for move_x, move_y in itertools.cycle(directions[start:] + directions[:start]):
+        yield move_x, move_y, True, 0.4
+
+
+def idle_moves(rng):
+    while True:
+        yield 0, 0, False, 1.0
+
+
+def script_moves(steps):
+    def moves(rng):
+        return itertools.cycle(steps)
+    return moves
+
+
+def load_script(path):
+    steps = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            move_x, move_y, fire, seconds = line.split()
+            steps.append((int(move_x), int(move_y), fire == '1', float(seconds)))
+    return steps
+
+
+class Bot:
+    def __init__(self, number, args, stats, moves):
+        self.number = number
+        self.args = args
+        self.stats = stats
+        self.rng = random.Random(args.seed + number)
+        self.moves = moves(self.rng)
+        self.use_binary = args.protocol == 'binary' or args.transport == 'udp'
+        self.running = True
+
+    async def send_inputs(self, writer):
+        # like game-client.py: the keys when they change, and again every
+        # --keepalive seconds when they do not
+        keys = last_keys = None
+        last_sent = change_at = 0
+        seq = 0
+        while self.running:
+            now = time.monotonic()
+            if now >= change_at:
+                move_x, move_y, fire, seconds = next(self.moves)
+                keys = (move_x, move_y, fire)
+                change_at = now + seconds
+            if keys != last_keys or now - last_sent >= self.args.keepalive:
+                seq += 1
+                move_x, move_y, fire = keys
+                if self.use_binary:
+                    writer.write(protocol.encode_input([(seq, int(now * 1000), move_x, move_y, fire)]))
+                else:
+                    writer.write(f"{move_x},{move_y},{1 if fire else 0}\n".encode())
+                await writer.drain()
+                last_keys, last_sent = keys, now
+            await asyncio.sleep(max(min(change_at, last_sent + self.args.keepalive) - time.monotonic(), 0))
+
+    async def receive_states(self, reader, writer):
+        snapshots = protocol.SnapshotReceiver()
+        send_interval = 1 / self.args.send_rate
+        last_arrival = None
+        first = None
+        while self.running:
+            if self.use_binary:
+                frame_type, payload = await protocol.read_frame(reader)
+                size = protocol.FRAME_HEADER.size + len(payload)
+                if frame_type == protocol.INPUT_ACK:
+                    seq, sent_ms = protocol.decode_input_ack(payload)
+                    self.stats.input_acked(((int(time.monotonic() * 1000) - sent_ms) & 0xFFFFFFFF) / 1000)
+                    continue
+                received = snapshots.receive(frame_type, payload)
+                if received is None:
+                    continue
+                seq = received[0]
+                writer.write(protocol.encode_ack(seq))
+            else:
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionResetError
+                size = len(line)
+                seq = None
+
+            now = time.monotonic()
+            gap = now - last_arrival if last_arrival is not None else None
+            last_arrival = now
+
+            lag = None
+            if seq is not None:
+                # offset of this arrival from the seq's place on the send
+                # schedule; the smallest offset seen is taken as zero lag
+                offset = now - seq * send_interval
+                if first is None or offset < first:
+                    first = offset
+                lag = offset - first
+            self.stats.received(size, gap, lag)
+
+    async def run(self):
+        try:
+            if self.args.transport == 'udp':
+                reader, writer, _ = await open_udp_connection(self.args.host, self.args.port)
+            else:
+                reader, writer = await self.open_tcp()
+        except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+            self.stats.failed += 1
+            if self.stats.failed <= 5:
+                print(f'bot {self.number} failed to connect: {e!r}')
+            return
+
+        self.stats.connected += 1
+        try:
+            await asyncio.gather(self.send_inputs(writer), self.receive_states(reader, writer))
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            self.stats.disconnected += 1
+        finally:
+            self.running = False
+            writer.close()
+
+    async def open_tcp(self):
+        reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+        try:
+            greeting = (await reader.readline()).decode().strip().split(':')
+            if self.args.compress:
+                if compression.ADVERT not in greeting[2:]:
+                    raise ConnectionError(f'server does not offer {compression.ADVERT}')
+                reader = await compression.request(reader, writer)
+                self.stats.decompressors.append(reader)
+            if self.use_binary:
+                if protocol.ADVERT not in greeting[2:]:
+                    raise ConnectionError(f'server does not offer {protocol.ADVERT}')
+                writer.write(protocol.UPGRADE)
+                await writer.drain()
+                while await reader.readline() != protocol.UPGRADE:
+                    pass
+                frame_type, payload = await protocol.read_frame(reader)
+                protocol.decode_hello(payload)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+
+async def main(args):
+    # thousands of sockets need more than the usual 1024 descriptors
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < args.bots + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, args.bots + 64), hard))
+
+    if args.script:
+        moves = script_moves(load_script(args.script))
+    else:
+        moves = {'random': random_moves, 'circle': circle_moves, 'idle': idle_moves}[args.behaviour]
+
+    stats = Stats()
+    tasks = []
+    start = time.monotonic()
+    last_report = start
+
+    async def reporter():
+        nonlocal last_report
+        while True:
+            await asyncio.sleep(args.report)
+            now = time.monotonic()
+            stats.report(now - last_report)
+            last_report = now
+
+    report_task = asyncio.create_task(reporter())
+    for number in range(args.bots):
+        # connections are opened on a fixed schedule, however busy the loop is
+        delay = start + number / args.ramp - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if time.monotonic() - start > args.duration:
+            break
+        tasks.append(asyncio.create_task(Bot(number, args, stats, moves).run()))
+
+    remaining = args.duration - (time.monotonic() - start)
+    if remaining > 0:
+        await asyncio.wait(tasks, timeout=remaining)
+    report_task.cancel()
+    for task in tasks:
+        task.cancel()
+
+    now = time.monotonic()
+    stats.report(now - last_report)
+    stats.report(now - start, final=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--bots', type=int, default=100)
+    parser.add_argument('--ramp', type=float, default=100, help='new connections per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds from the first connection')
+    parser.add_argument('--protocol', choices=['text', 'binary'], default='binary')
+    parser.add_argument('--compress', action='store_true',
+                        help="ask for compressed states, the server must run with --compress-level")
+    parser.add_argument('--transport', choices=['tcp', 'udp'], default='tcp',
+                        help="udp connects to the server's --udp-port, always binary")
+    parser.add_argument('--behaviour', choices=['random', 'circle', 'idle'], default='random')
+    parser.add_argument('--script', default=None, help='file of "move_x move_y fire seconds" lines, overrides --behaviour')
+    parser.add_argument('--keepalive', type=float, default=1.0, help='seconds after which unchanged keys are sent again')
+    parser.add_argument('--send-rate', type=float, default=20, help="the server's --send-rate, for the tick lag")
+    parser.add_argument('--report', type=float, default=5, help='seconds between reports')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
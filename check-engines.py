@@ -0,0 +1,69 @@
+# Checks that the numpy engine steps the world exactly as the per-object
+# loop does. Headless games (see game-sim.py) are played on a range of
+# seeds with the objects engine and recorded, and each recording is then
+# stepped again with the numpy engine as game-replay.py verify does; the
+# first tick that comes out different is reported.
+#
+#   python check-engines.py
+#   python check-engines.py --seeds 20 --ticks 4000 --clients 40 --rewind-window 200 --latency 120
+#
+# The server options are those of game-server.py, --engine is ignored.
+
+import argparse
+import importlib
+import os
+import random
+import tempfile
+
+from headless import ScriptedClient, VirtualClock, run_headless
+from replay import ReplayReader, ReplayRecorder
+
+game_server = importlib.import_module('game-server')
+game_replay = importlib.import_module('game-replay')
+bot_swarm = importlib.import_module('bot-swarm')
+
+
+def record_game(args, seed, path):
+    random.seed(seed)
+    clock = VirtualClock()
+    args.engine = 'objects'
+    server = game_server.server_from_args(args, clock=clock, sleep=clock.sleep)
+    server.recorder = ReplayRecorder.for_server(path, server)
+    clients = [ScriptedClient(server, bot_swarm.random_moves(random.Random(seed + number)), 'binary',
+                              respawn=True, latency=args.latency / 1000)
+               for number in range(args.clients)]
+    try:
+        run_headless(server, clients, args.ticks)
+    finally:
+        server.recorder.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seeds', type=int, default=10, help='games to play, on seeds --seed and up')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--ticks', type=int, default=2000, help='simulation steps per game')
+    parser.add_argument('--clients', type=int, default=40)
+    parser.add_argument('--latency', type=float, default=0, help='round trip of the clients\' state acks in ms')
+    game_server.add_server_arguments(parser)
+    args = parser.parse_args()
+
+    failed = []
+    with tempfile.TemporaryDirectory() as directory:
+        for seed in range(args.seed, args.seed + args.seeds):
+            path = os.path.join(directory, f'{seed}.rep')
+            record_game(args, seed, path)
+            print(f'seed {seed}: ', end='', flush=True)
+            replay = ReplayReader(path)
+            try:
+                if game_replay.verify(replay, argparse.Namespace(start=0, end=None, engine='numpy')):
+                    failed.append(seed)
+            finally:
+                replay.close()
+    if failed:
+        raise SystemExit(f'the engines differ on seeds {", ".join(map(str, failed))}')
+    print(f'the engines agree on all {args.seeds} seeds')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import time
+import zlib
+
+# Optional compression of what the server sends on a TCP connection. The
+# states of consecutive ticks repeat the same ids, similar coordinates and
+# the same delimiters, so one zlib stream per connection, flushed after
+# every frame, lets each state refer back to the ones before it. A preset
+# dictionary trained on snapshot traffic (train-dictionary.py) does the
+# same for the first states, before the stream has any history.
+#
+# A server that compresses adds ADVERT to its greeting,
+#
+#   id:<id>:bin4:zd<dictionary checksum>
+#
+# so a client only asks when it holds the same dictionary. It asks with
+# the line REQUEST while the connection still speaks text, before any
+# upgrade to binary frames (after it the line would be read as a frame
+# header); the server echoes that line uncompressed and everything it
+# sends after the echo is part of the compressed stream. The client side
+# stays uncompressed, its inputs are a few bytes each.
+
+DICTIONARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots.zdict')
+
+
+def load_dictionary(path=DICTIONARY_FILE):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return b''
+
+
+DICTIONARY = load_dictionary()
+ADVERT = f'zd{zlib.adler32(DICTIONARY):08x}'
+REQUEST = f'compress:{ADVERT}\n'.encode()
+
+
+class StreamCompressor:
+    # the sending end of one connection; counts what it saved and the CPU
+    # time it took
+    def __init__(self, level=6, dictionary=DICTIONARY):
+        if dictionary:
+            self.compressor = zlib.compressobj(level, zdict=dictionary)
+        else:
+            self.compressor = zlib.compressobj(level)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames = 0
+        self.seconds = 0.0
+
+    def compress(self, data):
+        start = time.thread_time()
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.seconds += time.thread_time() - start
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        self.frames += 1
+        return out
+
+    def ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out else 0.0
+
+
+class DecompressingReader:
+    # The receiving end: reads the compressed stream from reader and
+    # decompresses it chunk by chunk as it arrives, offering the
+    # asyncio.StreamReader calls the game code uses, so read_frame() and
+    # readline() work on it unchanged.
+    def __init__(self, reader, dictionary=DICTIONARY):
+        self.reader = reader
+        if dictionary:
+            self.decompressor = zlib.decompressobj(zdict=dictionary)
+        else:
+            self.decompressor = zlib.decompressobj()
+        self.buffer = bytearray()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    async def fill(self):
+        chunk = await self.reader.read(65536)
+        if not chunk:
+            return False
+        start = time.thread_time()
+        data = self.decompressor.decompress(chunk)
+        self.seconds += time.thread_time() - start
+        self.bytes_in += len(chunk)
+        self.bytes_out += len(data)
+        self.buffer += data
+        return True
+
+    async def readexactly(self, n):
+        while len(self.buffer) < n:
+            if not await self.fill():
+                partial = bytes(self.buffer)
+                self.buffer.clear()
+                raise asyncio.IncompleteReadError(partial, n)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def readline(self):
+        # like StreamReader.readline: the rest of the stream at its end
+        while (end := self.buffer.find(b'\n')) < 0:
+            if not await self.fill():
+                end = len(self.buffer) - 1
+                break
+        data = bytes(self.buffer[:end + 1])
+        del self.buffer[:end + 1]
+        return data
+
+    async def read(self, n=-1):
+        if not self.buffer:
+            await self.fill()
+        if n < 0:
+            n = len(self.buffer)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+
+async def request(reader, writer):
+    # asks a server that offered ADVERT to compress; returns the reader to
+    # use from then on. Lines the server sent before the echo are dropped.
+    writer.write(REQUEST)
+    await writer.drain()
+    while (line := await reader.readline()) != REQUEST:
+        if not line:
+            raise ConnectionError('connection closed while asking for compression')
+    return DecompressingReader(reader)
@@ -0,0 +1,68 @@
+import collections
+
+# Generational ids: the low INDEX_BITS are a slot index that gets reused,
+# the high bits count how often the slot has been reused. An id handed out
+# again for the same slot therefore never equals an id that was freed.
+
+INDEX_BITS = 16
+INDEX_MASK = (1 << INDEX_BITS) - 1
+GENERATION_MASK = 0xFFFF
+
+
+def index_of(e_id):
+    # the slot index, what the text protocol sends as the id
+    return e_id & INDEX_MASK
+
+
+def generation_of(e_id):
+    return e_id >> INDEX_BITS
+
+
+class IdAllocator:
+    # O(1) allocate and release from a free list of slots. Freed slots are
+    # reused oldest first so a slot sits idle as long as possible.
+    def __init__(self):
+        self.generations = []
+        self.live = []
+        self.free = collections.deque()
+
+    @classmethod
+    def from_state(cls, generations, free):
+        # an allocator that continues from state(): slots not on the free
+        # list are live
+        allocator = cls()
+        allocator.generations = list(generations)
+        allocator.free = collections.deque(free)
+        allocator.live = [True] * len(generations)
+        for index in free:
+            allocator.live[index] = False
+        return allocator
+
+    def state(self):
+        return list(self.generations), list(self.free)
+
+    def allocate(self):
+        if self.free:
+            index = self.free.popleft()
+        else:
+            index = len(self.generations)
+            if index > INDEX_MASK:
+                raise RuntimeError('out of entity ids')
+            self.generations.append(0)
+            self.live.append(False)
+        self.live[index] = True
+        return (self.generations[index] << INDEX_BITS) | index
+
+    def is_live(self, e_id):
+        index = e_id & INDEX_MASK
+        return index < len(self.generations) and self.live[index] and self.generations[index] == e_id >> INDEX_BITS
+
+    def release(self, e_id):
+        # releasing an id that is not live (twice, or one we never gave
+        # out) is ignored
+        if not self.is_live(e_id):
+            return
+        index = e_id & INDEX_MASK
+        self.generations[index] = (self.generations[index] + 1) & GENERATION_MASK
+        self.live[index] = False
+        self.free.append(index)
@@ -1,92 +1,144 @@
 # Example file showing a basic pygame "game loop"
+import argparse
 import asyncio
+import collections
 import threading
 import logging
+import time
 from dataclasses import dataclass
 
 import pygame
 
+import compression
+import protocol
+from assets import AssetCache
+from interpolation import SnapshotBuffer
+from prediction import ShipPredictor
+from tracing import add_trace_arguments, start_from_args, tracer
+from udp_transport import open_udp_connection
+
 # pygame setup
 pygame.init()
 screen = pygame.display.set_mode((800, 800))
 clock = pygame.time.Clock()
 running = True
-
-def prepare_image(file_name, scale, angle):
-    img = pygame.image.load(file_name)
-    img.convert()
-    img = pygame.transform.rotozoom(img, angle, scale)
-
-    img.set_colorkey("black")
-
-    return img
-
-class Console:
+protocol_choice = 'binary'
+# ask the server to compress what it sends, if it offers to
+compress_choice = False
+# 'udp' takes the game over UDP, always with the binary protocol
+transport_choice = 'tcp'
+server_address = ('localhost', 8888)
+# remote entities are drawn this many seconds in the past
+interpolation_delay = 0.1
+# predict the own ship locally, None draws it like the others
+predictor = None
+# seconds after which unchanged keys are sent again
+keepalive_interval = 1.0
+# 'dirty' redraws only what changed, 'full' the whole screen every frame
+render_mode = 'dirty'
+
+# drawing order of the sprite layers
+BULLET_LAYER = 0
+SHIP_LAYER = 1
+HUD_LAYER = 2
+
+# every image is loaded once and shared, see assets.py
+assets = AssetCache()
+SHIP_IMAGES = ["images/ship1.png", "images/ship2.png", "images/ship3.png"]
+ENEMY_IMAGES = ["images/e-ship1.png", "images/e-ship2.png", "images/e-ship3.png"]
+SHIP_SCALE = 0.25
+
+class Console(pygame.sprite.DirtySprite):
+    # the HUD. Its surface is only rendered again when the text changes.
     def __init__(self, screen):
+        super().__init__()
         self.x = 0
         self.y = 0
         self.width = screen.get_width()
         self.height = 100
         self.color = "white"
-        self.text = ""
+        self.text = None
         self.font = pygame.font.SysFont(None, 22)
-        self.screen = screen
-        self.visible = True
+        self.image = pygame.Surface((self.width, self.height), pygame.SRCALPHA)
+        self.rect = self.image.get_rect(topleft=(self.x, self.y))
+        self.log("")
 
     def hide(self):
-        self.visible = False
+        self.visible = 0
+        self.dirty = 1
 
     def show(self):
-        self.visible = True
-
-    def draw(self):
-        if not self.visible:
-            return
-
-        # draw transparent background with alpha 128
-        # pygame.draw.rect(screen, self.color, (self.x, self.y, self.width, self.height), 0, pygame.BLEND_RGBA_MULT)
-
-        s = pygame.Surface((self.width, self.height))  # the size of your rect
-        s.set_alpha(80)  # alpha level
-        s.fill(self.color)  # this fills the entire surface
-        screen.blit(s, (self.x, self.y))
-
-        # pygame.draw.rect(screen, self.color, (self.x, self.y, self.width, self.height))
-
-        text = self.font.render(self.text, True, "white")
-
-        # draw transparent text
-        text.set_alpha(190)
-        screen.blit(text, (self.x + 10, self.y + 10))
+        self.visible = 1
+        self.dirty = 1
 
     def log(self, text):
+        if text == self.text:
+            return
         self.text = text
 
+        # transparent background with alpha 80 and the text over it
+        background = pygame.Color(self.color)
+        background.a = 80
+        self.image.fill(background)
+        for i, line in enumerate(text.split("\n")):
+            rendered = self.font.render(line.strip(), True, "white")
+            rendered.set_alpha(190)
+            self.image.blit(rendered, (10, 10 + i * self.font.get_linesize()))
+        self.dirty = 1
+
     def update(self):
         pass
 
-class Player:
+class FrameTimes(pygame.sprite.DirtySprite):
+    # overlay with the time a frame takes to draw in each render mode, so
+    # the dirty rect mode can be compared with full redraws
+    def __init__(self, screen, interval=0.5):
+        super().__init__()
+        self.font = pygame.font.SysFont(None, 20)
+        self.interval = interval
+        self.image = pygame.Surface((0, 0))
+        self.rect = self.image.get_rect(bottomleft=(5, screen.get_height() - 5))
+        # mode -> [seconds, frames] of the current interval, mode -> ms
+        self.samples = {}
+        self.averages = {}
+        self.next_update = 0
+
+    def add(self, mode, seconds, entities, now):
+        sample = self.samples.setdefault(mode, [0.0, 0])
+        sample[0] += seconds
+        sample[1] += 1
+        if now < self.next_update:
+            return
+        self.next_update = now + self.interval
+        for name, (total, frames) in self.samples.items():
+            if frames:
+                self.averages[name] = total / frames * 1000
+        self.samples = {}
+
+        modes = ", ".join(f"{name} {ms:.2f} ms" for name, ms in sorted(self.averages.items()))
+        text = f"draw: {modes} | {entities} entities | F2: switch to {'full' if mode == 'dirty' else 'dirty'}"
+        self.image = self.font.render(text, True, "yellow")
+        self.rect = self.image.get_rect(bottomleft=self.rect.bottomleft)
+        self.dirty = 1
+
+class Player(pygame.sprite.DirtySprite):
     def __init__(self, screen, image_files, scale, angle):
+        super().__init__()
         self.x = 0
         self.y = 0
         self.id = None
         self.hit_points = 5
 
-        self.screen = screen
-
         self.image_index = 0
 
-        self.images = []
-        for file_name in image_files:
-            self.images.append(prepare_image(file_name, scale, angle))
+        self.images = [assets.image(file_name, scale, angle) for file_name in image_files]
 
         self.image = self.images[self.image_index]
         self.rect = self.image.get_rect()
 
-    def draw(self):
-        self.screen.blit(self.image, self.rect)
-
     def update(self):
+        if not self.visible:
+            return
         self.image_index += 1
         self.image_index %= len(self.images)
 
@@ -94,24 +146,37 @@ class Player:
 
         self.rect.x = self.x
         self.rect.y = self.y
+        # the animation changes the image every frame
+        self.dirty = 1
 
-class Bullet:
+class Bullet(pygame.sprite.DirtySprite):
     def __init__(self, screen, color, id):
+        super().__init__()
         self.x = 0
         self.y = 0
 
         self.screen_width = screen.get_width()
         self.screen_height = screen.get_height()
-        self.screen = screen
         self.id = id
         self.width = 10
         self.height = 10
         self.color = color
 
         self.image_index = 0
+        self.image = assets.fill(color, self.width, self.height)
+        self.rect = self.image.get_rect()
 
-    def draw(self):
-        pygame.draw.rect(screen, self.color, (self.x, self.y, self.width, self.height))
+    def set_color(self, color):
+        if color != self.color:
+            self.color = color
+            self.image = assets.fill(color, self.width, self.height)
+            self.dirty = 1
+
+    def update(self):
+        if self.rect.x != int(self.x) or self.rect.y != int(self.y):
+            self.rect.x = self.x
+            self.rect.y = self.y
+            self.dirty = 1
 
 @dataclass
 class EventsData:
@@ -121,127 +186,288 @@ class EventsData:
     right_key: bool
     fire_key: bool
 
-async def send_events(eventsData, writer):
+def client_ms():
+    return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+def keys_of(eventsData):
+    move_x = -1 if eventsData.left_key else 1 if eventsData.right_key else 0
+    move_y = -1 if eventsData.up_key else 1 if eventsData.down_key else 0
+    return move_x, move_y, eventsData.fire_key
+
+class InputChannel:
+    # key changes from the render loop to the network thread. Every change
+    # is an input with the next sequence number; the sender writes all
+    # inputs queued since its last write at once.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.keys = (0, 0, False)
+        self.pending = collections.deque()
+        self.loop = None
+        self.wakeup = None
+        # smoothed time from sending an input to its ack, seconds
+        self.latency = None
+
+    def attach(self):
+        # on the network thread, before anything is sent
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+
+    def push(self, keys):
+        with self.lock:
+            self.seq += 1
+            self.keys = keys
+            self.pending.append((self.seq, client_ms()) + keys)
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def take(self):
+        with self.lock:
+            inputs = list(self.pending)
+            self.pending.clear()
+        return inputs
+
+    def acked(self, sent_ms):
+        latency = ((client_ms() - sent_ms) & 0xFFFFFFFF) / 1000
+        self.latency = latency if self.latency is None else self.latency + (latency - self.latency) * 0.2
+        if predictor is not None:
+            predictor.observe_latency(latency)
+
+async def send_events(channel, writer, use_binary):
+    # inputs go out when the keys change, and again every
+    # keepalive_interval when they do not
+    channel.attach()
     while running:
-        move_x = -1 if eventsData.left_key else 1 if eventsData.right_key else 0
-        move_y = -1 if eventsData.up_key else 1 if eventsData.down_key else 0
-        fire = 1 if eventsData.fire_key else 0
-
-        message = f"{move_x},{move_y},{fire}\n"
-
-        writer.write(message.encode())
+        try:
+            await asyncio.wait_for(channel.wakeup.wait(), keepalive_interval)
+        except asyncio.TimeoutError:
+            channel.push(channel.keys)
+        channel.wakeup.clear()
+
+        inputs = channel.take()
+        if not inputs:
+            continue
+        if use_binary:
+            message = b''.join(protocol.encode_input(inputs[i:i + 255]) for i in range(0, len(inputs), 255))
+        else:
+            message = ''.join(f"{move_x},{move_y},{1 if fire else 0}\n"
+                              for seq, sent_ms, move_x, move_y, fire in inputs).encode()
+        writer.write(message)
         await writer.drain()
-        await asyncio.sleep(0.2)
-
-        logging.info(f"send_events coroutine: sent {message}")
-
-async def receive_events(player, other_players, bullets, reader):
-    while running:
-        message = await reader.readline()
-
-        logging.info(f"message received: {message.decode()}")
-        message = message.decode().strip()
-        players_list, bullets_list = message.split(":") if ":" in message else (message, None)
-
-        players_list = players_list.split(",")
 
-        bullets_list = bullets_list.split(",") if bullets_list is not None else []
-        
-        ids = []
-        for i in range(0, len(players_list), 4):
-            if players_list[i] == "":
+        tracer('input', 'send_events coroutine: sent %r', message)
+
+def decode_text_state(message):
+    players_list, bullets_list = message.split(":") if ":" in message else (message, None)
+
+    players_list = players_list.split(",")
+
+    bullets_list = bullets_list.split(",") if bullets_list is not None else []
+
+    players_state = []
+    for i in range(0, len(players_list), 4):
+        if players_list[i] == "":
+            continue
+        players_state.append((int(players_list[i]), float(players_list[i+1]), float(players_list[i+2]), int(players_list[i+3])))
+
+    bullets_state = []
+    for i in range(0, len(bullets_list), 4):
+        if bullets_list[i] == "":
+            continue
+        bullets_state.append((int(bullets_list[i]), int(bullets_list[i+1]), float(bullets_list[i+2]), float(bullets_list[i+3])))
+
+    return players_state, bullets_state
+
+class Scene:
+    # The sprites on screen, kept in step with the state the render loop
+    # samples once per frame. other_players and bullets are dicts by id:
+    # spawn, update and despawn are O(1) and an entity only ever matches
+    # its own id. Sprites of entities that are gone are hidden and wait in
+    # a free list to be reused for the next spawn. They stay in the group:
+    # one killed leaves its rect twice in the group's lost rects, and the
+    # sprites over it, the console, get blended twice there.
+    def __init__(self, player, sprites):
+        self.player = player
+        self.sprites = sprites
+        self.other_players = {}
+        self.bullets = {}
+        self.free_players = []
+        self.free_bullets = []
+
+    def apply(self, players_state, bullets_state):
+        player = self.player
+        other_players = self.other_players
+        ids = set()
+        for player_id, x, y, hit_points in players_state:
+            if player_id == player.id:
+                player.x = x
+                player.y = y
+                player.hit_points = hit_points
                 continue
-            player_id = int(players_list[i])
-            while len(other_players) <= player_id :
-                other_players.append(Player(screen, ["images/e-ship1.png", "images/e-ship2.png", "images/e-ship3.png"], 0.25, 0))
-                print(f"adding player {player_id}")
-            ids.append(player_id)
 
-        for i in range(0, len(players_list), 4):
-            if players_list[i] == "":
-                continue
-            player_id = int(players_list[i])
-            if player_id == player.id:
-                player.x = float(players_list[i+1])
-                player.y = float(players_list[i+2])
-                player.hit_points = int(players_list[i+3])
-            else:
-                other_players[player_id].x = float(players_list[i+1])
-                other_players[player_id].y = float(players_list[i+2])
-                other_players[player_id].id = player_id
+            other_player = other_players.get(player_id)
+            if other_player is None:
+                if self.free_players:
+                    other_player = self.free_players.pop()
+                    other_player.visible = 1
+                    other_player.dirty = 1
+                else:
+                    other_player = Player(screen, ENEMY_IMAGES, SHIP_SCALE, 0)
+                    self.sprites.add(other_player, layer=SHIP_LAYER)
+                other_player.id = player_id
+                other_players[player_id] = other_player
+                print(f"adding player {player_id}")
+            other_player.x = x
+            other_player.y = y
+            other_player.hit_points = hit_points
+            ids.add(player_id)
 
         # remove players that are not in the list
-        for player_o in other_players:
-            if player_o.id not in ids and player_o.id != None:
-                print(f"removing player {player_o.id}")
-                other_players.remove(player_o)
-
-        ids = []
-
-        for i in range(0, len(bullets_list), 4):
-            if bullets_list[i] == "":
+        for player_id in [player_id for player_id in other_players if player_id not in ids]:
+            print(f"removing player {player_id}")
+            other_player = other_players.pop(player_id)
+            other_player.visible = 0
+            other_player.dirty = 1
+            self.free_players.append(other_player)
+
+        bullets = self.bullets
+        ids = set()
+        for bullet_id, bullet_player_id, x, y in bullets_state:
+            bullet = bullets.get(bullet_id)
+            if bullet is None:
+                if self.free_bullets:
+                    bullet = self.free_bullets.pop()
+                    bullet.id = bullet_id
+                    bullet.visible = 1
+                    bullet.dirty = 1
+                else:
+                    bullet = Bullet(screen, 'red', bullet_id)
+                    self.sprites.add(bullet, layer=BULLET_LAYER)
+                bullets[bullet_id] = bullet
+            bullet.set_color('green' if bullet_player_id == player.id else 'red')
+            bullet.x = x
+            bullet.y = y
+            ids.add(bullet_id)
+
+        for bullet_id in [bullet_id for bullet_id in bullets if bullet_id not in ids]:
+            bullet = bullets.pop(bullet_id)
+            bullet.visible = 0
+            bullet.dirty = 1
+            self.free_bullets.append(bullet)
+
+async def receive_events(player, channel, buffer, reader, writer, use_binary):
+    # states only go into the buffer, the render loop draws from it
+    snapshots = protocol.SnapshotReceiver()
+    while running:
+        if use_binary:
+            frame_type, payload = await protocol.read_frame(reader)
+            if frame_type == protocol.INPUT_ACK:
+                seq, sent_ms = protocol.decode_input_ack(payload)
+                channel.acked(sent_ms)
                 continue
-            bullet_id = int(bullets_list[i])
-            while len(bullets) <= bullet_id:
-                bullets.append(Bullet(screen, 'red', bullet_id))
-            ids.append(bullet_id)
-
-        for i in range(0, len(bullets_list), 4):
-            if bullets_list[i] == "":
+            # rebuild the full state from keyframes and deltas and ack it
+            # so the server can diff against it
+            received = snapshots.receive(frame_type, payload)
+            if received is None:
                 continue
-            bullet_id = int(bullets_list[i])
-            bullet_player_id = int(bullets_list[i+1])
-            if bullet_player_id == player.id:
-                bullets[bullet_id].color = 'green'
-            bullets[bullet_id].x = float(bullets_list[i+2])
-            bullets[bullet_id].y = float(bullets_list[i+3])
-            bullets[bullet_id].id = bullet_id
-
-        for bullet in bullets:
-            if bullet.id not in ids and bullet.id != None:
-                bullets.remove(bullet)
-
-async def data_exchange(player, eventsData, other_players, bullets):
-    reader, writer = await asyncio.open_connection('localhost', 8888)
-
-    initial_data = await reader.readline()
-    logging.info(f"initial data received: {initial_data.decode()}")
-    data_parts=initial_data.decode().split(":")
-    player.id = int(data_parts[1])
-    print(f"player id: {player.id}")
-
-    send_events_task = asyncio.create_task(send_events(eventsData, writer))
-    receive_events_task = asyncio.create_task(receive_events(player, other_players, bullets, reader))
+            seq, snapshot = received
+            writer.write(protocol.encode_ack(seq))
+            tracer('state', 'state %d received: %d bytes', seq, len(payload))
+            players_state, bullets_state = protocol.snapshot_tuples(snapshot)
+        else:
+            message = await reader.readline()
+
+            tracer('state', 'message received: %r', message)
+            players_state, bullets_state = decode_text_state(message.decode().strip())
+
+        now = time.monotonic()
+        buffer.push(now, players_state, bullets_state)
+        if predictor is not None:
+            for player_id, x, y, hit_points in players_state:
+                if player_id == player.id:
+                    predictor.reconcile(now, x, y)
+
+async def data_exchange(player, channel, buffer):
+    if transport_choice == 'udp':
+        reader, writer, player.id = await open_udp_connection(*server_address)
+        print(f"player id: {player.id}")
+        use_binary = True
+    else:
+        reader, writer, player.id, use_binary = await open_tcp(*server_address)
+
+    send_events_task = asyncio.create_task(send_events(channel, writer, use_binary))
+    receive_events_task = asyncio.create_task(receive_events(player, channel, buffer, reader, writer, use_binary))
 
     await asyncio.gather(send_events_task, receive_events_task)
 
+    if isinstance(reader, compression.DecompressingReader):
+        print(f"compression: {reader.bytes_out / max(reader.bytes_in, 1):.2f}x, {reader.bytes_in / 1024:.1f} KiB "
+              f"received, {reader.seconds * 1000:.1f} ms decompressing")
     print("data_exchange coroutine finished")
 
-def data_exchange_thread_func(player, eventsData, other_players, bullets):
+async def open_tcp(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+
+    initial_data = await reader.readline()
+    logging.info(f"initial data received: {initial_data.decode()}")
+    data_parts=initial_data.decode().strip().split(":")
+    player_id = int(data_parts[1])
+    print(f"player id: {player_id}")
+
+    # from here on the states arrive compressed, if the server offers it
+    if compress_choice and compression.ADVERT in data_parts[2:]:
+        reader = await compression.request(reader, writer)
+
+    # switch to the binary protocol if the server offers it
+    use_binary = protocol_choice == 'binary' and protocol.ADVERT in data_parts[2:]
+    if use_binary:
+        writer.write(protocol.UPGRADE)
+        await writer.drain()
+        # text states may still arrive until the server echoes the upgrade
+        while await reader.readline() != protocol.UPGRADE:
+            pass
+        frame_type, payload = await protocol.read_frame(reader)
+        player_id = protocol.decode_hello(payload)
+    return reader, writer, player_id, use_binary
+
+def data_exchange_thread_func(player, channel, buffer):
     global running
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    loop.run_until_complete(data_exchange(player, eventsData, other_players, bullets))
+    loop.run_until_complete(data_exchange(player, channel, buffer))
 
     loop.close()
 
     print("data_exchange thread finished")
 
 def main():
-    global running
-
-    bullets = []
-
-    other_players = []
+    global running, render_mode
 
-    player = Player(screen, ["images/ship1.png", "images/ship2.png", "images/ship3.png"], 0.25, 0)
+    assets.preload([(file_name, SHIP_SCALE, 0) for file_name in SHIP_IMAGES + ENEMY_IMAGES])
+    player = Player(screen, SHIP_IMAGES, SHIP_SCALE, 0)
+    player.visible = 0
     console = Console(screen)
+    frame_times = FrameTimes(screen)
+
+    # everything on screen is a sprite in one group, drawn layer by layer;
+    # in dirty mode the group repaints only the areas that changed
+    background = pygame.Surface(screen.get_size()).convert()
+    background.fill("black")
+    sprites = pygame.sprite.LayeredDirty()
+    sprites.add(player, layer=SHIP_LAYER)
+    sprites.add(console, frame_times, layer=HUD_LAYER)
+    sprites.clear(screen, background)
+    scene = Scene(player, sprites)
+    screen.blit(background, (0, 0))
+    pygame.display.flip()
 
     eventsData = EventsData(False, False, False, False, False)
+    channel = InputChannel()
+    buffer = SnapshotBuffer(interpolation_delay)
 
     # create data exchange thread
-    data_exchange_thread = threading.Thread(target=data_exchange_thread_func, args=(player, eventsData, other_players, bullets))
+    data_exchange_thread = threading.Thread(target=data_exchange_thread_func, args=(player, channel, buffer))
     data_exchange_thread.start()
 
     while running:
@@ -265,6 +491,9 @@ def main():
                         console.hide()
                     else:
                         console.show()
+                elif event.key == pygame.K_F2:
+                    render_mode = 'full' if render_mode == 'dirty' else 'dirty'
+                    sprites.repaint_rect(screen.get_rect())
 
             elif event.type == pygame.KEYUP:
                 if event.key == pygame.K_UP:
@@ -278,30 +507,46 @@ def main():
                 elif event.key == pygame.K_SPACE:
                     eventsData.fire_key = False
 
-
-        # fill the screen with a color to wipe away anything from last frame
-        screen.fill("black")
-
-        # draw other players
-        for other_player in other_players:
-            if other_player.id is not None:
-                other_player.update()
-                other_player.draw()
-
-        if player.id is not None:
-            player.update()
-            player.draw()
-
-        # draw bullets
-        for bullet in bullets:
-            bullet.draw()
-
+        # all key changes of this frame go out as one input
+        keys = keys_of(eventsData)
+        if keys != channel.keys:
+            channel.push(keys)
+            if predictor is not None:
+                predictor.apply_input(keys[0], keys[1])
+
+        # the world a little in the past, the own ship predicted up to now
+        now = time.monotonic()
+        state = buffer.sample(now)
+        if state is not None:
+            scene.apply(*state)
+        if predictor is not None:
+            predictor.advance(now)
+            position = predictor.position(now)
+            if position is not None:
+                player.x, player.y = position
+
+        if player.id is not None and not player.visible:
+            player.visible = 1
+
+        latency = f"{channel.latency * 1000:.0f} ms" if channel.latency is not None else "-"
         console.log(f"Player x: {int(player.x)}, y: {int(player.y)}\n \
-                    Player hitpoints: {player.hit_points}\n")
-        console.draw()
-
-        # flip() the display to put your work on screen
-        pygame.display.flip()
+                    Player hitpoints: {player.hit_points}, input latency: {latency}\n")
+
+        draw_start = time.perf_counter()
+        sprites.update()
+        if render_mode == 'dirty':
+            # only the areas sprites moved from and to go to the display
+            pygame.display.update(sprites.draw(screen))
+        else:
+            # wipe the frame and put every sprite on screen again
+            screen.blit(background, (0, 0))
+            for sprite in sprites.sprites():
+                if sprite.visible:
+                    screen.blit(sprite.image, sprite.rect)
+            pygame.display.flip()
+        # the sprites of gone entities stay in the group, hidden
+        shown = len(sprites) - len(scene.free_players) - len(scene.free_bullets)
+        frame_times.add(render_mode, time.perf_counter() - draw_start, shown, now)
 
         clock.tick(60)  # limits FPS to 60
 
@@ -309,8 +554,45 @@ def main():
     pygame.quit()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888, help="the server's --port, or its --udp-port for UDP")
+    parser.add_argument('--transport', choices=['tcp', 'udp'], default='tcp',
+                        help='udp drops late states instead of waiting for them, always binary')
+    parser.add_argument('--protocol', choices=['text', 'binary'], default='binary',
+                        help='binary is used only if the server offers it')
+    parser.add_argument('--compress', action='store_true',
+                        help="have the server compress the states, if it runs with --compress-level")
+    parser.add_argument('--interpolation-delay', type=float, default=100,
+                        help='ms in the past remote ships and bullets are drawn, 0 draws the newest state')
+    parser.add_argument('--no-prediction', action='store_true', help='draw the own ship from the server states only')
+    parser.add_argument('--render', choices=['dirty', 'full'], default='dirty',
+                        help='redraw only the changed areas or the whole screen every frame (F2 switches)')
+    parser.add_argument('--tick-rate', type=float, default=20, help="the server's --tick-rate, for the prediction")
+    parser.add_argument('--field', default='800x800',
+                        help="the server's --field, WIDTHxHEIGHT, where the prediction stops the ship")
+    parser.add_argument('--latency', type=float, default=50,
+                        help='ms from an input to its ack until the first one is measured, for the prediction')
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+    protocol_choice = args.protocol
+    transport_choice = args.transport
+    compress_choice = args.compress
+    server_address = (args.host, args.port)
+    interpolation_delay = args.interpolation_delay / 1000
+    render_mode = args.render
+    if not args.no_prediction:
+        field = tuple(int(v) for v in args.field.split('x'))
+        predictor = ShipPredictor(args.tick_rate, args.latency / 1000, field)
+
     format = "SRV: %(asctime)s: %(message)s"
     logging.basicConfig(format=format, level=logging.ERROR,
                         datefmt="%F-%H-%M-%S")
 
-    main()
\ No newline at end of file
+    tracing = start_from_args(args)
+    try:
+        main()
+    finally:
+        if tracing:
+            tracer.stop()
+            print(tracer.report())
\ No newline at end of file
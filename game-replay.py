@@ -0,0 +1,219 @@
+# Reads the replay logs written by `game-server.py --record`.
+#
+#   python game-replay.py info match.rep
+#   python game-replay.py play match.rep --from 1200 --to 1600
+#   python game-replay.py play match.rep --speed 0 --dump > ticks.jsonl
+#   python game-replay.py serve match.rep --from 1200 --speed 4
+#   python game-replay.py verify match.rep --from 1200 --to 1300
+#
+# info prints the size, ticks and chunks of a log. play decodes the ticks
+# headless at --speed times real time (0: as fast as possible) and prints
+# the throughput, or with --dump one JSON line per tick for other tools.
+# serve streams the ticks to game-client.py like a server would, so a game
+# can be watched again from any tick. verify restores the server from the
+# nearest chunk before --from, steps it with the recorded inputs and
+# reports the first tick whose state differs from the log.
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import time
+
+import protocol
+from entity_ids import INDEX_MASK
+from replay import ReplayReader
+
+game_server = importlib.import_module('game-server')
+
+async def paced(replay, start, end, speed):
+    # the ticks from start to end, each released when it is due at speed
+    # times real time. Stretches of more than a second without ticks (an
+    # empty server) are skipped.
+    tick_interval = 1 / replay.tick_rate
+    due = time.monotonic()
+    previous = None
+    for tick, snapshot, events in replay.ticks(start, end):
+        if speed > 0 and previous is not None:
+            due += min(tick - previous, replay.tick_rate) * tick_interval / speed
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # behind, carry on from now rather than rushing to catch up
+                due = time.monotonic()
+        previous = tick
+        yield tick, snapshot, events
+
+
+def info(replay, path):
+    ticks = sum(1 for _ in replay.ticks())
+    size = os.path.getsize(path)
+    seconds = ticks / replay.tick_rate
+    print(f'{path}: {size / 1024:.1f} KiB, {"indexed" if replay.closed else "not closed, index rebuilt"}')
+    print(f'tick rate {replay.tick_rate:g}, field {replay.field[0]}x{replay.field[1]}, '
+          f'fire interval {replay.fire_interval:g}, rewind window {replay.rewind_window} ticks')
+    if replay.index:
+        print(f'ticks {replay.index[0][0]}..{replay.last_tick}: {ticks} recorded, {seconds:.1f} s of play, '
+              f'{size / max(ticks, 1):.0f} bytes per tick')
+    print(f'{len(replay.index)} chunks of up to {replay.chunk_ticks} ticks')
+
+
+async def play(replay, args):
+    start = time.perf_counter()
+    ticks = players = bullets = events = 0
+    async for tick, snapshot, tick_events in paced(replay, args.start, args.end, args.speed):
+        ticks += 1
+        players += len(snapshot[0])
+        bullets += len(snapshot[1])
+        events += len(tick_events)
+        if args.dump:
+            players_state, bullets_state = protocol.snapshot_tuples(snapshot)
+            print(json.dumps({'tick': tick, 'players': players_state, 'bullets': bullets_state,
+                              'events': tick_events}))
+    elapsed = time.perf_counter() - start
+    if args.dump:
+        return
+    if not ticks:
+        print('no ticks in that range')
+        return
+    played = ticks / replay.tick_rate
+    print(f'{ticks} ticks in {elapsed:.3f} s: {ticks / elapsed:.0f} ticks/s, {played / elapsed:.1f}x real time')
+    print(f'mean {players / ticks:.1f} players, {bullets / ticks:.1f} bullets, {events} events')
+
+
+async def watch(reader, writer, replay, args):
+    # one watching client: the greeting of a server, then the ticks as
+    # binary deltas against the tick before or as text lines
+    use_binary = await protocol.accept_watcher(reader, writer, INDEX_MASK)
+
+    async def discard():
+        # acks and inputs of the client are read and ignored
+        while await reader.read(4096):
+            pass
+    discarding = asyncio.create_task(discard())
+
+    print(f'Streaming to {writer.get_extra_info("peername")}')
+    previous = previous_tick = None
+    try:
+        async for tick, snapshot, events in paced(replay, args.start, args.end, args.speed):
+            if not use_binary:
+                frame = game_server.encode_text_snapshot(snapshot)
+            elif previous is None:
+                frame = protocol.encode_keyframe(tick, snapshot)
+            else:
+                frame = protocol.encode_delta(tick, previous_tick, previous, snapshot)
+            previous, previous_tick = snapshot, tick
+            writer.write(frame)
+            await writer.drain()
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        discarding.cancel()
+        writer.close()
+
+
+async def serve(replay, args):
+    server = await asyncio.start_server(lambda r, w: watch(r, w, replay, args), '0.0.0.0', args.port)
+    print(f'Replay served at {server.sockets[0].getsockname()}')
+    async with server:
+        await server.serve_forever()
+
+
+def apply_events(server, events):
+    # what handle_client, drop_player, acknowledge and ingest_inputs did
+    # live
+    for event in events:
+        if event[0] == 'join':
+            p_id, x, y, hit_points = event[1:]
+            server.player_ids.allocate()
+            player = server.make_player(p_id, x, y)
+            player.hit_points = hit_points
+            server.players.append(player)
+        elif event[0] == 'leave':
+            for player in server.players:
+                if player.id == event[1]:
+                    server.players.remove(player)
+                    server.player_ids.release(player.id)
+                    break
+        elif event[0] == 'rewind':
+            for player in server.players:
+                if player.id == event[1]:
+                    player.rewind_ticks = event[2]
+                    break
+        else:
+            p_id, seq, move_x, move_y, fire, pressed = event[1:]
+            for player in server.players:
+                if player.id == p_id:
+                    server.apply_input(player, move_x, move_y, fire)
+                    if pressed:
+                        player.fire_pressed = True
+                    break
+
+
+def first_difference(expected, actual):
+    for name, want, got in zip(('player', 'bullet'), expected, actual):
+        for e_id in sorted(set(want) | set(got)):
+            if want.get(e_id) != got.get(e_id):
+                return f'{name} {e_id}: recorded {want.get(e_id)}, simulated {got.get(e_id)}'
+    return None
+
+
+def verify(replay, args):
+    chunk_tick, state = replay.sim_state(args.start)
+    server = game_server.GameServer(engine=args.engine, tick_rate=replay.tick_rate, fire_interval=replay.fire_interval,
+                                    rewind_window=replay.rewind_window / replay.tick_rate)
+    server.game_field_width, server.game_field_height = replay.field
+    server.load_sim_state(state)
+
+    ticks = 0
+    for tick, snapshot, events in replay.ticks(chunk_tick + 1, args.end):
+        apply_events(server, events)
+        # the rest of GameServer.tick()
+        server.ticks = tick
+        if server.players:
+            server.apply_held_inputs()
+            server.step()
+            if server.history is not None:
+                server.history.record(tick, server.players)
+        ticks += 1
+        difference = first_difference(snapshot, server.snapshot())
+        if difference is not None:
+            print(f'tick {tick} differs after {ticks} simulated ticks from {chunk_tick}: {difference}')
+            return 1
+    print(f'{ticks} ticks from {chunk_tick} simulated, all match the log')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['info', 'play', 'serve', 'verify'])
+    parser.add_argument('log', help='replay log written by game-server.py --record')
+    parser.add_argument('--from', dest='start', type=int, default=0, help='first tick')
+    parser.add_argument('--to', dest='end', type=int, default=None, help='last tick')
+    parser.add_argument('--speed', type=float, default=None,
+                        help='times real time, 0 as fast as possible (default: 0 for play, 1 for serve)')
+    parser.add_argument('--dump', action='store_true', help='play: print every tick as a JSON line')
+    parser.add_argument('--port', type=int, default=8888, help='serve: port game-client.py connects to')
+    parser.add_argument('--engine', choices=['objects', 'numpy'], default='objects', help='verify: engine to step with')
+    args = parser.parse_args()
+    if args.speed is None:
+        args.speed = 1.0 if args.command == 'serve' else 0.0
+
+    replay = ReplayReader(args.log)
+    try:
+        if args.command == 'info':
+            info(replay, args.log)
+        elif args.command == 'play':
+            asyncio.run(play(replay, args))
+        elif args.command == 'serve':
+            asyncio.run(serve(replay, args))
+        else:
+            return verify(replay, args)
+    finally:
+        replay.close()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
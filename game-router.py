@@ -0,0 +1,285 @@
+# Lobby / router in front of a pool of worker processes, each running any
+# number of game rooms (one GameServer per room).
+#
+# The router only accepts connections. It picks a room for each one and
+# hands the socket itself over to the room's worker process, which then
+# talks to the client directly, so clients connect to one port and the
+# protocol is unchanged.
+#
+#   python game-router.py --workers 4 --room-capacity 8
+
+import argparse
+import asyncio
+import importlib
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from multiprocessing.reduction import recv_handle, send_handle
+
+game_server = importlib.import_module('game-server')
+
+# a worker that dies sooner than this after starting is not started again,
+# it would most likely crash the same way
+RESPAWN_MIN_UPTIME = 5.0
+
+
+class Worker:
+    # runs in the worker process
+    def __init__(self, conn, args, stats_interval):
+        self.conn = conn
+        self.args = args
+        self.stats_interval = stats_interval
+        # room id -> [GameServer, loop task, open connections]
+        self.rooms = {}
+
+    def open_room(self, room_id):
+        server = game_server.server_from_args(self.args)
+        task = asyncio.create_task(server.update_and_send_state())
+        self.rooms[room_id] = [server, task, 0]
+        logging.info(f'Room {room_id} opened in worker {os.getpid()}')
+        return self.rooms[room_id]
+
+    def close_room(self, room_id):
+        server, task, connections = self.rooms.pop(room_id)
+        task.cancel()
+        self.conn.send(('closed', room_id))
+        logging.info(f'Room {room_id} closed in worker {os.getpid()}')
+
+    async def join(self, room_id, sock):
+        room = self.rooms.get(room_id) or self.open_room(room_id)
+        room[2] += 1
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+            await room[0].handle_client(reader, writer)
+        finally:
+            room[2] -= 1
+            self.conn.send(('left', room_id))
+            if room[2] == 0 and self.rooms.get(room_id) is room:
+                self.close_room(room_id)
+
+    def on_message(self):
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            self.stopped.set_result(None)
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            return
+        if message[0] == 'join':
+            # the socket follows the join message
+            sock = socket.socket(fileno=recv_handle(self.conn))
+            asyncio.create_task(self.join(message[1], sock))
+
+    def stats(self, cpu_used, elapsed):
+        rooms = {}
+        for room_id, (server, task, connections) in self.rooms.items():
+            scheduler = server.scheduler.stats()
+            rooms[room_id] = {
+                'connections': connections,
+                'players': len(server.players),
+                'bullets': server.bullet_count(),
+                'overruns': scheduler['overruns'],
+                'skipped_steps': scheduler['skipped_steps'],
+                'jitter_max': scheduler['jitter_max'],
+            }
+        return {'pid': os.getpid(), 'cpu': cpu_used / elapsed if elapsed else 0.0, 'rooms': rooms}
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        loop.add_reader(self.conn.fileno(), self.on_message)
+
+        last_wall = time.monotonic()
+        last_cpu = time.process_time()
+        while not self.stopped.done():
+            await asyncio.wait([self.stopped], timeout=self.stats_interval)
+            wall, cpu = time.monotonic(), time.process_time()
+            self.conn.send(('stats', self.stats(cpu - last_cpu, wall - last_wall)))
+            last_wall, last_cpu = wall, cpu
+
+
+def worker_main(conn, args, stats_interval):
+    format = "WRK: %(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.ERROR,
+                        datefmt="%F-%H-%M-%S")
+    try:
+        asyncio.run(Worker(conn, args, stats_interval).run())
+    except KeyboardInterrupt:
+        pass
+
+
+class Router:
+    def __init__(self, args):
+        self.args = args
+        self.room_capacity = args.room_capacity
+        self.next_room_id = 0
+        # room id -> {'worker': index, 'connections': n}
+        self.rooms = {}
+        self.workers = [self.start_worker() for i in range(args.workers)]
+
+    def start_worker(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=worker_main, args=(child_conn, self.args, self.args.worker_stats_interval),
+                                          daemon=True)
+        process.start()
+        child_conn.close()
+        return {'process': process, 'conn': conn, 'connections': 0, 'stats': None, 'alive': True,
+                'started': time.monotonic()}
+
+    def listen(self, index):
+        asyncio.get_running_loop().add_reader(self.workers[index]['conn'].fileno(), self.on_message, index)
+
+    def worker_died(self, index):
+        # its rooms and their connections went with the process; a new
+        # worker takes its place unless it died right after starting
+        worker = self.workers[index]
+        if not worker['alive']:
+            return
+        worker['alive'] = False
+        asyncio.get_running_loop().remove_reader(worker['conn'].fileno())
+        worker['conn'].close()
+        worker['process'].join(1)
+        lost = [room_id for room_id, room in self.rooms.items() if room['worker'] == index]
+        for room_id in lost:
+            del self.rooms[room_id]
+        logging.error(f'Worker {index} died (exit code {worker["process"].exitcode}), '
+                      f'{len(lost)} rooms and {worker["connections"]} connections lost')
+        if time.monotonic() - worker['started'] < RESPAWN_MIN_UPTIME:
+            logging.error(f'Worker {index} died right after starting, not starting it again')
+            return
+        self.workers[index] = self.start_worker()
+        self.listen(index)
+
+    def place(self):
+        # fill the fullest room that still has space, so matches fill up,
+        # otherwise open a room on the live worker with the fewest
+        # connections; None when every worker is dead
+        open_rooms = [(room['connections'], room_id) for room_id, room in self.rooms.items()
+                      if room['connections'] < self.room_capacity]
+        if open_rooms:
+            return max(open_rooms)[1]
+
+        alive = [i for i, worker in enumerate(self.workers) if worker['alive']]
+        if not alive:
+            return None
+        worker = min(alive, key=lambda i: (self.workers[i]['connections'],
+                                           sum(1 for r in self.rooms.values() if r['worker'] == i)))
+        room_id = self.next_room_id
+        self.next_room_id += 1
+        self.rooms[room_id] = {'worker': worker, 'connections': 0}
+        return room_id
+
+    def hand_over(self, sock):
+        # a worker found dead on the way is replaced and the connection
+        # placed again; with no worker left it is refused
+        try:
+            while (room_id := self.place()) is not None:
+                room = self.rooms[room_id]
+                index = room['worker']
+                worker = self.workers[index]
+                try:
+                    worker['conn'].send(('join', room_id))
+                    send_handle(worker['conn'], sock.fileno(), worker['process'].pid)
+                except OSError:
+                    self.worker_died(index)
+                    continue
+                room['connections'] += 1
+                worker['connections'] += 1
+                logging.error(f'New player placed in room {room_id} on worker {index}')
+                return
+            logging.error('No worker left, connection refused')
+        finally:
+            sock.close()
+
+    def on_message(self, index):
+        worker = self.workers[index]
+        try:
+            message = worker['conn'].recv()
+        except (EOFError, OSError):
+            self.worker_died(index)
+            return
+
+        kind, payload = message
+        if kind == 'left':
+            worker['connections'] -= 1
+            room = self.rooms.get(payload)
+            if room is not None:
+                room['connections'] -= 1
+        elif kind == 'closed':
+            room = self.rooms.get(payload)
+            if room is not None and room['connections'] <= 0:
+                del self.rooms[payload]
+        elif kind == 'stats':
+            worker['stats'] = payload
+
+    def stats(self):
+        workers = []
+        for i, worker in enumerate(self.workers):
+            stats = worker['stats'] or {'cpu': 0.0, 'rooms': {}}
+            workers.append({
+                'worker': i,
+                'connections': worker['connections'],
+                'rooms': len(stats['rooms']),
+                'players': sum(room['players'] for room in stats['rooms'].values()),
+                'cpu': stats['cpu'],
+                'alive': worker['alive'],
+            })
+        rooms = {}
+        for worker in self.workers:
+            if worker['alive'] and worker['stats'] is not None:
+                rooms.update(worker['stats']['rooms'])
+        return workers, rooms
+
+    def report(self):
+        workers, rooms = self.stats()
+        lines = [f'{"worker":>6} {"conns":>6} {"rooms":>6} {"players":>8} {"cpu":>6}']
+        for w in workers:
+            if not w['alive']:
+                lines.append(f'{w["worker"]:>6} {"dead":>6}')
+                continue
+            lines.append(f'{w["worker"]:>6} {w["connections"]:>6} {w["rooms"]:>6} {w["players"]:>8} {w["cpu"] * 100:>5.1f}%')
+        lines.append(f'{"room":>6} {"conns":>6} {"players":>8} {"bullets":>8} {"overruns":>9} {"jitter max":>11}')
+        for room_id, r in sorted(rooms.items()):
+            lines.append(f'{room_id:>6} {r["connections"]:>6} {r["players"]:>8} {r["bullets"]:>8} {r["overruns"]:>9} '
+                         f'{r["jitter_max"] * 1000:>9.1f}ms')
+        connections = [w['connections'] for w in workers if w['alive']] or [0]
+        lines.append(f'balance: {max(connections) - min(connections)} connections between the busiest and idlest worker')
+        print('\n'.join(lines))
+
+    async def run(self, port):
+        loop = asyncio.get_running_loop()
+        for i in range(len(self.workers)):
+            self.listen(i)
+
+        listener = socket.create_server(('0.0.0.0', port))
+        listener.setblocking(False)
+        print(f'Router started at {listener.getsockname()} with {len(self.workers)} workers')
+
+        if self.args.stats_interval > 0:
+            asyncio.create_task(self.report_loop())
+        while True:
+            sock, address = await loop.sock_accept(listener)
+            self.hand_over(sock)
+
+    async def report_loop(self):
+        while True:
+            await asyncio.sleep(self.args.stats_interval)
+            self.report()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--room-capacity', type=int, default=8, help='players per room')
+    parser.add_argument('--stats-interval', type=float, default=10, help='seconds between load reports, 0 to disable')
+    parser.add_argument('--worker-stats-interval', type=float, default=1)
+    game_server.add_server_arguments(parser)
+    args = parser.parse_args()
+
+    format = "RTR: %(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.ERROR,
+                        datefmt="%F-%H-%M-%S")
+
+    asyncio.run(Router(args).run(args.port))
@@ -1,8 +1,37 @@
 import random
 
+import argparse
 import asyncio
+import collections
 import logging
-from dataclasses import dataclass
+import struct
+import time
+from dataclasses import dataclass, field
+
+import compression
+import protocol
+from entity_ids import IdAllocator, index_of
+from interest import InterestIndex
+from metrics import SIZE_BUCKETS, TICK_BUCKETS, Registry
+from outbox import Outbox
+from position_history import PositionHistory
+from scheduler import TickScheduler
+from spatial_hash import SpatialHash
+from tracing import add_trace_arguments, start_from_args, tracer
+from udp_transport import UdpOutbox, UdpServer
+
+# the lines game-client.py sends, parsed once: (move x, move y, fire)
+TEXT_INPUTS = {f'{move_x},{move_y},{fire}\n'.encode(): (move_x, move_y, fire == 1)
+               for move_x in (-1, 0, 1) for move_y in (-1, 0, 1) for fire in (0, 1)}
+# longest INPUT frame a client may send, the most inputs one frame holds
+MAX_INPUT_FRAME = protocol.INPUT_COUNT.size + 255 * protocol.INPUT_RECORD.size
+
+def encode_text_snapshot(snapshot):
+    # the text protocol line of a protocol.py snapshot
+    players_state, bullets_state = protocol.snapshot_tuples(snapshot)
+    game_state_encoded = ''.join(f'{index_of(p_id)},{x},{y},{hp},' for p_id, x, y, hp in players_state) + ':'
+    game_state_encoded += ''.join(f'{index_of(b_id)},{index_of(owner)},{x},{y},' for b_id, owner, x, y in bullets_state)
+    return f"{game_state_encoded[:-1]}\n".encode()
 
 @dataclass
 class Player:
@@ -15,6 +44,45 @@ class Player:
     speed_y: float = 0
     hit_points: int = 5
 
+    # 'text' or 'binary', see protocol.py
+    protocol: str = 'text'
+    # newest state the client has acknowledged, binary protocol only
+    acked_seq: int = -1
+    # the interest cells of the views this client was sent, by seq, when
+    # area of interest is on, and those of the newest view and its bounds
+    views: dict = field(default_factory=dict)
+    view_cells: frozenset = frozenset()
+    view_bounds: tuple = None
+    # send queue drained by the connection's own writer task
+    outbox: Outbox = None
+    # what the client sent, for the metrics
+    bytes_in: int = 0
+    messages_in: int = 0
+
+    # the keys the client holds, applied every tick
+    move_x: float = 0
+    move_y: float = 0
+    fire: bool = False
+    # a fire press that has not made a bullet yet, so short taps count
+    fire_pressed: bool = False
+    fire_cooldown: float = 0
+    # newest input applied, its client time, and the seq last echoed
+    input_seq: int = -1
+    input_time: int = 0
+    echoed_seq: int = -1
+    # inputs received since the last tick, (seq, client ms, move x, move y,
+    # fire) with seq None for text input; the oldest fall out when full
+    inputs: collections.deque = None
+    # token bucket of the input rate limit
+    input_tokens: float = 0
+    input_refilled: float = 0
+    inputs_dropped: int = 0
+    inputs_malformed: int = 0
+    # round trip time measured from the state acks, smoothed, and the
+    # ticks this player's bullets rewind their targets by
+    rtt: float = None
+    rewind_ticks: int = 0
+
 @dataclass
 class Bullet:
     x: float
@@ -24,179 +92,908 @@ class Bullet:
 
     speed_x: float = 0
     speed_y: float = 0
+    # hits are tested against where the targets were this many ticks ago
+    rewind: int = 0
+
+@dataclass
+class Watcher:
+    # a spectator relay subscribed on the watch port: it is sent the whole
+    # world as deltas against the newest state it acked, and has no ship
+    outbox: Outbox = None
+    acked_seq: int = -1
 
 class GameServer:
-    def __init__(self):
+    def __init__(self, broadphase='grid', engine='objects', view_size=None, view_margin=50, tick_rate=20, send_rate=None,
+                 max_backlog=40, input_rate=60, fire_interval=0.2, rewind_window=0, client_delay=0.1,
+                 compress_level=0, clock=time.monotonic, sleep=asyncio.sleep):
         self.players = []
+        # spectator relays, see spectator-relay.py
+        self.watchers = []
         self.bullets = []
         self.game_field_width = 800
         self.game_field_height = 800
         self.acceleration = 0.1
         self.player_width = 50
         self.player_height = 50
+        self.bullet_size = 5
+        # clients used to send their keys every 0.2 s, each message adding
+        # to the speed and firing once; held keys keep that pace
+        self.input_interval = 0.2
+        # speeds and the friction are pixels per 0.05 s, the tick of the
+        # original loop; a step moves things its share of that
+        self.speed_interval = 0.05
+        # seconds between two bullets of a player
+        self.fire_interval = fire_interval
+        # inputs a client may send per second (and in a burst), and how many
+        # are kept between two ticks
+        self.input_rate = input_rate
+        self.input_buffer = 32
+
+        # generational ids, a reused id never equals one that was freed
+        self.player_ids = IdAllocator()
+        self.bullet_ids = IdAllocator()
+
+        # 'grid' uses the spatial hash, 'naive' the all-pairs loops
+        self.broadphase = broadphase
+        cell_size = max(self.player_width, self.player_height)
+        self.player_grid = SpatialHash(cell_size)
+        self.bullet_grid = SpatialHash(cell_size)
+
+        # recent snapshots by sequence number, the baselines for deltas.
+        # A client that has not acked any of them gets a keyframe.
+        self.seq = 0
+        self.snapshots = {}
+        self.delta_window = 32
+        # clock time each of those was recorded, for round trip times
+        self.snapshot_times = {}
+
+        # (width, height) of the area around its ship a client is sent,
+        # None sends everyone the whole world
+        self.view_size = view_size
+        self.view_margin = view_margin
+        # the interest.InterestIndex of every snapshot, the baselines of views
+        self.interest_indexes = {}
+
+        # simulation steps at tick_rate, states go out at send_rate. The
+        # clock and sleep are the wall clock unless a headless run passes
+        # a virtual one, see headless.py
+        self.clock = clock
+        self.scheduler = TickScheduler(tick_rate, send_rate, clock=clock, sleep=sleep)
+        # so the game plays at the same pace whatever the tick rate
+        self.step_scale = self.scheduler.tick_interval / self.speed_interval
+        # states in a row a client may fail to take before it is dropped
+        self.max_backlog = max_backlog
+
+        # lag compensation: a bullet hits its targets where its shooter saw
+        # them, its round trip time plus the client's interpolation delay
+        # ago, up to rewind_window seconds. Off when that is 0.
+        self.rewind_window = round(rewind_window / self.scheduler.tick_interval)
+        self.client_delay = client_delay
+        self.history = PositionHistory(self.rewind_window + 1) if self.rewind_window > 0 else None
+        # the largest rewind of the bullets of the current step
+        self.max_rewind = 0
+
+        # zlib level of the compression offered to TCP clients, 0 offers
+        # none, see compression.py
+        self.compress_level = compress_level
+
+        # 'objects' simulates the Player/Bullet dataclasses one by one,
+        # 'numpy' keeps bullets in arrays and steps the world vectorized
+        self.engine = None
+        if engine == 'numpy':
+            from numpy_engine import NumpyEngine
+            self.engine = NumpyEngine(self)
+
+        # seconds the last step spent moving things and colliding them
+        self.phase_times = {'physics': 0.0, 'collisions': 0.0}
+        self.input_messages = 0
+        self.inputs_dropped = 0
+        self.inputs_malformed = 0
+        # set by enable_metrics()
+        self.metrics = None
+        # simulation steps run, the tick numbers of a replay log
+        self.ticks = 0
+        # a replay.ReplayRecorder the ticks are appended to, or None
+        self.recorder = None
+
+    def players_overlap(self, player, other_player):
+        return (player.x < other_player.x + self.player_width and
+                player.x + self.player_width > other_player.x and
+                player.y < other_player.y + self.player_height and
+                player.y + self.player_height > other_player.y)
+
+    def bullet_hits(self, player, bullet):
+        x, y = player.x, player.y
+        if bullet.rewind and self.history is not None:
+            x, y = self.history.position(player.id, self.ticks - bullet.rewind, x, y)
+        return (x < bullet.x + self.bullet_size and
+                x + self.player_width > bullet.x and
+                y < bullet.y + self.bullet_size and
+                y + self.player_height > bullet.y)
+
+    def knockback(self, player, other_player):
+        if player.x < other_player.x:
+            player.x -= 10
+        else:
+            player.x += 10
+        if player.y < other_player.y:
+            player.y -= 10
+        else:
+            player.y += 10
+
+    def move_player(self, player):
+        player.x += player.speed_x * self.step_scale
+        player.y += player.speed_y * self.step_scale
+
+        # prevent player from going off screen
+        if player.x < 0:
+            player.x = 0
+            player.speed_x = 0
+        elif player.x > self.game_field_width - self.player_width:
+            player.x = self.game_field_width - self.player_width
+            player.speed_x = 0
+        if player.y < 0:
+            player.y = 0
+            player.speed_y = 0
+        elif player.y > self.game_field_height - self.player_height:
+            player.y = self.game_field_height - self.player_height
+            player.speed_y = 0
+
+        # add friction
+        friction = self.acceleration * 0.5 * self.step_scale
+        if player.speed_x > 0:
+            player.speed_x -= friction
+        elif player.speed_x < 0:
+            player.speed_x += friction
+        if player.speed_y > 0:
+            player.speed_y -= friction
+        elif player.speed_y < 0:
+            player.speed_y += friction
+
+    def collide_naive(self, index, player, hit_bullets):
+        # aabb collision detection with a knokback
+        for i, other_player in enumerate(self.players):
+            if i != index and self.players_overlap(player, other_player):
+                self.knockback(player, other_player)
+
+        # aabb collision detection with bullets
+        for i, bullet in enumerate(self.bullets):
+            if i in hit_bullets or bullet.player_id == player.id:
+                continue
+            if self.bullet_hits(player, bullet):
+                hit_bullets.add(i)
+                player.hit_points -= 1
+                if player.hit_points <= 0:
+                    break
 
-    async def update_and_send_state(self):
+    def collide_grid(self, index, player, hit_bullets):
+        # same checks as collide_naive, but only against the neighbouring
+        # cells. Candidates are visited in list order so the knockback
+        # sequence and the bullets consumed match the naive pass exactly;
+        # after every knockback the player has moved, so look again.
+        checked = -1
         while True:
-            if len(self.players) == 0:
-                await asyncio.sleep(0.1)
+            candidates = sorted(i for i in self.player_grid.query(
+                player.x - self.player_width, player.y - self.player_height,
+                player.x + self.player_width, player.y + self.player_height) if i > checked and i != index)
+            for i in candidates:
+                checked = i
+                other_player = self.players[i]
+                if self.players_overlap(player, other_player):
+                    self.knockback(player, other_player)
+                    break
+            else:
+                break
+        self.player_grid.move(index, player.x, player.y)
+
+        # with lag compensation the player is hit where it was, anywhere
+        # along its path over the rewound ticks
+        x0, y0, x1, y1 = player.x, player.y, player.x, player.y
+        if self.max_rewind:
+            x0, y0, x1, y1 = self.history.extent(player.id, self.ticks - self.max_rewind, self.ticks - 1, x0, y0)
+        candidates = sorted(self.bullet_grid.query(
+            x0 - self.bullet_size, y0 - self.bullet_size, x1 + self.player_width, y1 + self.player_height))
+        for i in candidates:
+            bullet = self.bullets[i]
+            if i in hit_bullets or bullet.player_id == player.id:
                 continue
+            if self.bullet_hits(player, bullet):
+                hit_bullets.add(i)
+                player.hit_points -= 1
+                if player.hit_points <= 0:
+                    break
 
-            logging.info(f'Updating and sending state')
-            game_state_encoded = ''
+    def bullet_count(self):
+        if self.engine is not None:
+            return self.engine.bullet_count()
+        return len(self.bullets)
+
+    def spawn_bullet(self, player):
+        b_id = self.bullet_ids.allocate()
+        bullet = Bullet(player.x + self.player_width // 2, player.y - self.player_height // 2, b_id, player.id, 0, -10,
+                        player.rewind_ticks)
+        if self.engine is not None:
+            self.engine.spawn_bullet(bullet)
+        else:
+            self.bullets.append(bullet)
+        return bullet
+
+    def remove_dead_players(self):
+        alive = []
+        for player in self.players:
+            if player.hit_points > 0:
+                alive.append(player)
+            else:
+                self.player_ids.release(player.id)
+        self.players = alive
+
+    def step(self):
+        if self.engine is not None:
+            return self.engine.step()
+
+        # advance the world by one tick. Hit bullets and dead players are
+        # collected and removed at the end so no list is mutated while it
+        # is being iterated.
+        hit_bullets = set()
+        physics = 0.0
+        start = time.perf_counter()
+        if self.history is not None:
+            self.max_rewind = max((bullet.rewind for bullet in self.bullets), default=0)
+
+        if self.broadphase == 'grid':
+            self.player_grid.clear()
+            for i, player in enumerate(self.players):
+                self.player_grid.insert(i, player.x, player.y)
+            self.bullet_grid.clear()
+            for i, bullet in enumerate(self.bullets):
+                self.bullet_grid.insert(i, bullet.x, bullet.y)
+            collide = self.collide_grid
+        else:
+            collide = self.collide_naive
+
+        now = time.perf_counter()
+        collisions = now - start
+        for i, player in enumerate(self.players):
+            self.move_player(player)
+            moved = time.perf_counter()
+            collide(i, player, hit_bullets)
+            collided = time.perf_counter()
+            physics += moved - now
+            collisions += collided - moved
+            now = collided
+
+        self.remove_dead_players()
+
+        bullets = []
+        for i, bullet in enumerate(self.bullets):
+            if i in hit_bullets:
+                self.bullet_ids.release(bullet.id)
+                continue
+            bullet.x += bullet.speed_x * self.step_scale
+            bullet.y += bullet.speed_y * self.step_scale
 
+            # remove bullet if it goes off screen
+            if bullet.x < 0 or bullet.x > self.game_field_width or bullet.y < 0 or bullet.y > self.game_field_height:
+                self.bullet_ids.release(bullet.id)
+                continue
+            bullets.append(bullet)
+        self.bullets = bullets
+
+        self.phase_times['physics'] = physics + time.perf_counter() - now
+        self.phase_times['collisions'] = collisions
+
+    def encode_state(self):
+        # the text protocol carries slot indices, old clients keep lists
+        # indexed by id
+        game_state_encoded = ''
+        for player in self.players:
+            game_state_encoded += f'{index_of(player.id)},{player.x},{player.y},{player.hit_points},'
+
+        game_state_encoded += ':' # end of player state
+
+        if self.engine is not None:
+            return game_state_encoded + self.engine.encode_bullets()
+
+        for bullet in self.bullets:
+            game_state_encoded += f'{index_of(bullet.id)},{index_of(bullet.player_id)},{bullet.x},{bullet.y},'
+
+        return game_state_encoded
+
+    def snapshot(self):
+        players = {player.id: protocol.player_record(player.x, player.y, player.hit_points) for player in self.players}
+        if self.engine is not None:
+            bullets = self.engine.bullet_snapshot()
+        else:
+            bullets = {bullet.id: protocol.bullet_record(bullet.player_id, bullet.x, bullet.y) for bullet in self.bullets}
+        return players, bullets
+
+    def record_snapshot(self):
+        self.seq += 1
+        self.snapshots[self.seq] = self.snapshot()
+        self.snapshots.pop(self.seq - self.delta_window, None)
+        self.snapshot_times[self.seq] = self.clock()
+        self.snapshot_times.pop(self.seq - self.delta_window, None)
+
+    def encode_state_binary(self, acked_seq, deltas):
+        # deltas caches the frames of this tick by baseline, clients that
+        # acked the same state share one encoding
+        frame = deltas.get(acked_seq)
+        if frame is None:
+            current = self.snapshots[self.seq]
+            base = self.snapshots.get(acked_seq)
+            if base is None:
+                frame = protocol.encode_keyframe(self.seq, current)
+            else:
+                frame = protocol.encode_delta(self.seq, acked_seq, base, current)
+            deltas[acked_seq] = frame
+        return frame
+
+    def interest_index(self):
+        scale = protocol.COORD_SCALE
+        view_width, view_height = self.view_size
+        index = InterestIndex(self.snapshots[self.seq], view_width * scale, view_height * scale,
+                              self.view_margin * scale, self.player_width * scale, self.player_height * scale)
+        self.interest_indexes[self.seq] = index
+        self.interest_indexes.pop(self.seq - self.delta_window, None)
+        return index
+
+    def encode_view(self, player, index, deltas):
+        # this client's part of the world, as a delta against the view it
+        # acked or as a text state. A view is a set of interest cells, and
+        # deltas holds an interest.Baseline per baseline tick, shared by
+        # every client that acked it, which encodes each cell once.
+        keys, player.view_bounds = index.view_cells(player.id, player.view_cells, player.view_bounds)
+        player.view_cells = keys
+        player.views[self.seq] = keys
+        player.views.pop(self.seq - self.delta_window, None)
+
+        if player.protocol == 'binary':
+            base_keys = player.views.get(player.acked_seq)
+            if base_keys is None:
+                return protocol.encode_keyframe(self.seq, index.view(player.id, keys))
+            baseline = deltas.get(player.acked_seq)
+            if baseline is None:
+                baseline = deltas[player.acked_seq] = index.against(self.interest_indexes[player.acked_seq])
+            return baseline.delta(self.seq, player.acked_seq, player.id, keys, base_keys)
+
+        return encode_text_snapshot(index.view(player.id, keys))
+
+    def tick(self):
+        # one fixed simulation step; the world is idle without players
+        self.ticks += 1
+        if len(self.players) == 0:
+            return
+        applied = self.ingest_inputs()
+        self.apply_held_inputs()
+        self.step()
+        if self.history is not None:
+            self.history.record(self.ticks, self.players)
+        if self.recorder is not None:
+            self.recorder.record(self.ticks, self, applied)
+        if self.metrics is not None:
+            for phase, seconds in self.phase_times.items():
+                self.metrics['phase'].observe(seconds, phase)
+
+    def encode_frames(self):
+        # the frame of every client for the last recorded snapshot, as
+        # (player, frame) pairs. Nothing is sent, so benchmarks can call it.
+        # The text state is encoded once, binary frames once per baseline.
+        frames = []
+        text_frame = None
+        deltas = {}
+        index = self.interest_index() if self.view_size is not None else None
+        for player in self.players:
+            if index is not None:
+                frame = self.encode_view(player, index, deltas)
+            elif player.protocol == 'binary':
+                frame = self.encode_state_binary(player.acked_seq, deltas)
+            else:
+                if text_frame is None:
+                    game_state_encoded = self.encode_state()
+                    text_frame = f"{game_state_encoded[:-1]}\n".encode()
+                frame = text_frame
+            frames.append((player, frame))
+
+        tracer('state', 'State %d encoded: %d frames, %d baselines, text %r', self.seq, len(frames), len(deltas),
+               text_frame)
+        return frames
+
+    def send_state(self):
+        # hands every client its frame; the writer tasks do the socket work
+        if len(self.players) == 0:
+            return
+
+        start = time.perf_counter()
+        self.record_snapshot()
+        frames = self.encode_frames()
+        encoded = time.perf_counter()
+        for player, frame in frames:
+            if player.input_seq != player.echoed_seq and player.protocol == 'binary':
+                player.outbox.send_control(protocol.encode_input_ack(player.input_seq, player.input_time))
+                player.echoed_seq = player.input_seq
+            player.outbox.send_state(frame)
+        # relays that keep up share one delta, however many watch them
+        watcher_deltas = {}
+        for watcher in self.watchers:
+            watcher.outbox.send_state(self.encode_state_binary(watcher.acked_seq, watcher_deltas))
+        tracer('state', 'State %d sent: encoded in %.3f ms, broadcast in %.3f ms', self.seq,
+               (encoded - start) * 1000, (time.perf_counter() - encoded) * 1000)
+
+        if self.metrics is not None:
+            self.metrics['phase'].observe(encoded - start, 'encoding')
+            self.metrics['phase'].observe(time.perf_counter() - encoded, 'broadcast')
+            for player, frame in frames:
+                self.metrics['snapshot_bytes'].observe(len(frame))
+
+    def enable_metrics(self, registry):
+        # tick phases and snapshot sizes are observed as they happen, the
+        # rest is read from the players and outboxes when scraped
+        self.metrics = {
+            'phase': registry.histogram('game_tick_phase_seconds', 'Time spent per tick phase', TICK_BUCKETS,
+                                        ['phase']),
+            'snapshot_bytes': registry.histogram('game_snapshot_bytes', 'Size of the state frames sent to clients',
+                                                 SIZE_BUCKETS),
+        }
+        players = registry.gauge('game_players', 'Connected players')
+        bullets = registry.gauge('game_bullets', 'Live bullets')
+        inputs = registry.counter('game_input_messages_total', 'Inputs accepted')
+        dropped_inputs = registry.counter('game_input_dropped_total', 'Inputs dropped by the rate limit or a full buffer')
+        malformed_inputs = registry.counter('game_input_malformed_total', 'Input messages that could not be parsed')
+        steps = registry.counter('game_steps_total', 'Simulation steps run')
+        skipped = registry.counter('game_skipped_steps_total', 'Simulation steps skipped after overruns')
+        overruns = registry.counter('game_tick_overruns_total', 'Scheduler wakeups that found more than one step due')
+        jitter = registry.gauge('game_tick_jitter_seconds', 'How late the first due step of the last wakeup ran')
+        jitter_max = registry.gauge('game_tick_jitter_max_seconds', 'How late the first due step of a wakeup ran at most')
+        per_client = {
+            'bytes_out': registry.counter('game_client_sent_bytes_total', 'Bytes sent to a client', ['client']),
+            'messages_out': registry.counter('game_client_sent_messages_total', 'Frames sent to a client', ['client']),
+            'bytes_in': registry.counter('game_client_received_bytes_total', 'Bytes received from a client', ['client']),
+            'messages_in': registry.counter('game_client_received_messages_total', 'Messages received from a client',
+                                            ['client']),
+            'dropped': registry.counter('game_client_dropped_states_total', 'States replaced before they were sent',
+                                        ['client']),
+            'queue': registry.gauge('game_client_send_queue_depth', 'Frames waiting in the outbox', ['client']),
+            'uncompressed': registry.counter('game_client_uncompressed_bytes_total',
+                                             'Bytes sent to a compressed client before compression', ['client']),
+            'compression_seconds': registry.counter('game_client_compression_seconds_total',
+                                                    'CPU time spent compressing for a client', ['client']),
+        }
+
+        def collect():
+            players.set(len(self.players))
+            bullets.set(self.bullet_count())
+            inputs.set_total(self.input_messages)
+            dropped_inputs.set_total(self.inputs_dropped)
+            malformed_inputs.set_total(self.inputs_malformed)
+            scheduler = self.scheduler.stats()
+            steps.set_total(scheduler['steps'])
+            skipped.set_total(scheduler['skipped_steps'])
+            overruns.set_total(scheduler['overruns'])
+            jitter.set(scheduler['jitter_last'])
+            jitter_max.set(scheduler['jitter_max'])
+            # disconnected clients drop out of the per client series
+            for metric in per_client.values():
+                metric.values = {}
             for player in self.players:
-                player.x += player.speed_x
-                player.y += player.speed_y
-
-                # prevent player from going off screen
-                if player.x < 0:
-                    player.x = 0
-                    player.speed_x = 0
-                elif player.x > self.game_field_width - self.player_width:
-                    player.x = self.game_field_width - self.player_width
-                    player.speed_x = 0
-                if player.y < 0:
-                    player.y = 0
-                    player.speed_y = 0
-                elif player.y > self.game_field_height - self.player_height:
-                    player.y = self.game_field_height - self.player_height
-                    player.speed_y = 0
-
-                # add friction
-                if player.speed_x > 0:
-                    player.speed_x -= self.acceleration * 0.5
-                elif player.speed_x < 0:
-                    player.speed_x += self.acceleration * 0.5
-                if player.speed_y > 0:
-                    player.speed_y -= self.acceleration * 0.5
-                elif player.speed_y < 0:
-                    player.speed_y += self.acceleration * 0.5
-
-                # aabb collision detection with a knokback
-                for other_player in self.players:
-                    if other_player == player:
-                        continue
-
-                    if (player.x < other_player.x + self.player_width and
-                        player.x + self.player_width > other_player.x and
-                        player.y < other_player.y + self.player_height and
-                        player.y + self.player_height > other_player.y):
-                        if player.x < other_player.x:
-                            player.x -= 10
-                        else:
-                            player.x += 10
-                        if player.y < other_player.y:
-                            player.y -= 10
-                        else:
-                            player.y += 10
-                    
-                # aabb collision detection with bullets
-                for bullet in self.bullets:
-                    if bullet.player_id == player.id:
-                        continue
-                    if (player.x < bullet.x + 5 and
-                        player.x + self.player_width > bullet.x and
-                        player.y < bullet.y + 5 and
-                        player.y + self.player_height > bullet.y):
-                        player.hit_points -= 1
-                        self.bullets.remove(bullet)
-                        if player.hit_points <= 0:
-                            self.players.remove(player)
-                
-                
-                game_state_encoded += f'{player.id},{player.x},{player.y},{player.hit_points},'
-
-            game_state_encoded += ':' # end of player state
-
-            for bullet in self.bullets:
-                bullet.x += bullet.speed_x
-                bullet.y += bullet.speed_y
-
-                # remove bullet if it goes off screen
-                if bullet.x < 0 or bullet.x > self.game_field_width or bullet.y < 0 or bullet.y > self.game_field_height:
-                    self.bullets.remove(bullet)
-                    continue
-
-                # logging.error(f'Bullet {bullet.id} at {bullet.x}, {bullet.y}')
-                game_state_encoded += f'{bullet.id},{bullet.player_id},{bullet.x},{bullet.y},'
+                client = str(player.id)
+                outbox = player.outbox
+                per_client['bytes_out'].set_total(outbox.bytes_sent, client)
+                per_client['messages_out'].set_total(outbox.frames_sent, client)
+                per_client['bytes_in'].set_total(player.bytes_in, client)
+                per_client['messages_in'].set_total(player.messages_in, client)
+                per_client['dropped'].set_total(outbox.dropped, client)
+                per_client['queue'].set(outbox.depth(), client)
+                compressor = getattr(outbox, 'compressor', None)
+                if compressor is not None:
+                    per_client['uncompressed'].set_total(compressor.bytes_in, client)
+                    per_client['compression_seconds'].set_total(compressor.seconds, client)
+
+        registry.on_collect(collect)
 
-            for player in self.players:
-                player.writer.write(f"{game_state_encoded[:-1]}\n".encode())
-                try:
-                    await player.writer.drain()
-                except:
-                    logging.error(f'Player {player.id} disconnected')
-                    if player in self.players:
-                        self.players.remove(player)
-                    continue
+    async def update_and_send_state(self):
+        await self.scheduler.run(self.tick, self.send_state)
+
+    def queue_input(self, player, seq, client_ms, move_x, move_y, fire):
+        # called as inputs arrive; they take effect at the next tick
+        if not (-1 <= move_x <= 1 and -1 <= move_y <= 1):
+            self.input_malformed(player)
+            return
+
+        now = self.clock()
+        player.input_tokens = min(player.input_tokens + (now - player.input_refilled) * self.input_rate, self.input_rate)
+        player.input_refilled = now
+        if player.input_tokens < 1 or len(player.inputs) == player.inputs.maxlen:
+            player.inputs_dropped += 1
+            self.inputs_dropped += 1
+            if player.input_tokens < 1:
+                return
+        player.input_tokens -= 1
+        self.input_messages += 1
+        player.inputs.append((seq, client_ms, move_x, move_y, fire))
+
+    def acknowledge(self, player, seq):
+        # the client has state seq: deltas can be based on it, and the time
+        # since it was recorded is a round trip time sample
+        if not player.acked_seq < seq <= self.seq:
+            return
+        player.acked_seq = seq
+        recorded = self.snapshot_times.get(seq)
+        if recorded is None or self.history is None:
+            return
+        rtt = self.clock() - recorded
+        player.rtt = rtt if player.rtt is None else player.rtt + (rtt - player.rtt) * 0.2
+        rewind = min(round((player.rtt + self.client_delay) / self.scheduler.tick_interval), self.rewind_window)
+        if rewind != player.rewind_ticks:
+            player.rewind_ticks = rewind
+            if self.recorder is not None:
+                self.recorder.rewound(player)
+
+    def input_malformed(self, player):
+        player.inputs_malformed += 1
+        self.inputs_malformed += 1
+        if player.inputs_malformed == 1:
+            logging.error(f'Malformed input from player {player.id}')
+
+    def ingest_inputs(self):
+        # the inputs of every player since the last tick, coalesced: the
+        # last one says which keys are held, a fire press in any of them
+        # fires, and the last seq is what gets echoed. Returns what was
+        # applied as (id, seq, move x, move y, fire, fire pressed).
+        applied = []
+        for player in self.players:
+            inputs = player.inputs
+            if not inputs:
+                continue
+            seq, client_ms, move_x, move_y, fire = inputs[-1]
+            pressed = any(i[4] for i in inputs)
+            self.apply_input(player, move_x, move_y, fire)
+            if pressed:
+                player.fire_pressed = True
+            if seq is not None:
+                player.input_seq, player.input_time = seq, client_ms
+            inputs.clear()
+            applied.append((player.id, seq, move_x, move_y, fire, pressed))
+        return applied
+
+    def apply_input(self, player, move_x, move_y, fire):
+        # an input is the keys held from now on, see apply_held_inputs
+        player.move_x = move_x
+        player.move_y = move_y
+        player.fire = fire
+        if fire:
+            player.fire_pressed = True
+
+    def apply_held_inputs(self):
+        # accelerate by the held keys, one input_interval worth per second
+        # of ticks, and fire every fire_interval while fire is held
+        tick_interval = self.scheduler.tick_interval
+        scale = tick_interval / self.input_interval
+        for player in self.players:
+            player.speed_x += player.move_x * scale
+            player.speed_y += player.move_y * scale
+
+            player.fire_cooldown = max(player.fire_cooldown - tick_interval, 0)
+            if (player.fire or player.fire_pressed) and player.fire_cooldown == 0:
+                self.spawn_bullet(player)
+                player.fire_pressed = False
+                player.fire_cooldown = self.fire_interval
+
+    def handle_frame(self, player, frame_type, payload):
+        # one binary frame from a client, over TCP or UDP
+        player.bytes_in += protocol.FRAME_HEADER.size + len(payload)
+        player.messages_in += 1
+        try:
+            if frame_type == protocol.INPUT:
+                for seq, client_ms, move_x, move_y, fire in protocol.decode_input(payload):
+                    self.queue_input(player, seq, client_ms, move_x, move_y, fire)
+            elif frame_type == protocol.ACK:
+                self.acknowledge(player, protocol.decode_ack(payload))
+            else:
+                self.input_malformed(player)
+        except struct.error:
+            self.input_malformed(player)
+
+    def handle_frames(self, player, data):
+        # the frames of one UDP datagram
+        offset = 0
+        while offset < len(data):
+            if len(data) - offset < protocol.FRAME_HEADER.size:
+                self.input_malformed(player)
+                return
+            length, frame_type = protocol.FRAME_HEADER.unpack_from(data, offset)
+            offset += protocol.FRAME_HEADER.size
+            if length > MAX_INPUT_FRAME or offset + length > len(data):
+                self.input_malformed(player)
+                return
+            self.handle_frame(player, frame_type, data[offset:offset + length])
+            offset += length
+
+    def add_udp_player(self, connection):
+        # a UDP client finished its handshake, it always speaks binary
+        player = self.make_player(self.player_ids.allocate(), random.randint(0, self.game_field_width),
+                                  random.randint(0, self.game_field_height))
+        player.protocol = 'binary'
+        player.outbox = UdpOutbox(connection, self.max_backlog, on_close=lambda: self.drop_player(player))
+        player.outbox.send_control(protocol.encode_hello(player.id))
+        self.add_player(player)
+        logging.error(f'New UDP player connected - total player: {len(self.players)}')
+        return player
+
+    def drop_player(self, player):
+        if player in self.players:
+            logging.error(f'Player {player.id} disconnected')
+            self.players.remove(player)
+            self.player_ids.release(player.id)
+            if self.recorder is not None:
+                self.recorder.left(player)
+
+    def make_player(self, p_id, x, y, writer=None):
+        player = Player(x, y, p_id, writer)
+        player.inputs = collections.deque(maxlen=self.input_buffer)
+        player.input_tokens = self.input_rate
+        player.input_refilled = self.clock()
+        return player
+
+    def add_player(self, player):
+        self.players.append(player)
+        if self.recorder is not None:
+            self.recorder.joined(player)
+
+    def sim_state(self):
+        # everything the next steps depend on, as plain tuples, see
+        # replay.py; load_sim_state() puts it back
+        players = [(p.id, p.x, p.y, p.speed_x, p.speed_y, p.hit_points, p.move_x, p.move_y, p.fire_cooldown,
+                    p.fire, p.fire_pressed, p.rewind_ticks) for p in self.players]
+        if self.engine is not None:
+            bullets = self.engine.bullet_states()
+        else:
+            bullets = [(b.id, b.player_id, b.x, b.y, b.speed_x, b.speed_y, b.rewind) for b in self.bullets]
+        history = self.history.state() if self.history is not None else []
+        return players, bullets, self.player_ids.state(), self.bullet_ids.state(), history
+
+    def load_sim_state(self, state):
+        players, bullets, player_ids, bullet_ids, history = state
+        self.players = []
+        for (p_id, x, y, speed_x, speed_y, hit_points, move_x, move_y, fire_cooldown, fire, fire_pressed,
+             rewind_ticks) in players:
+            player = self.make_player(p_id, x, y)
+            player.speed_x, player.speed_y, player.hit_points = speed_x, speed_y, hit_points
+            player.move_x, player.move_y, player.fire_cooldown = move_x, move_y, fire_cooldown
+            player.fire, player.fire_pressed, player.rewind_ticks = fire, fire_pressed, rewind_ticks
+            self.players.append(player)
+        self.bullets = []
+        if self.engine is not None:
+            self.engine = type(self.engine)(self)
+        for b_id, owner, x, y, speed_x, speed_y, rewind in bullets:
+            bullet = Bullet(x, y, b_id, owner, speed_x, speed_y, rewind)
+            if self.engine is not None:
+                self.engine.spawn_bullet(bullet)
+            else:
+                self.bullets.append(bullet)
+        self.player_ids = IdAllocator.from_state(*player_ids)
+        self.bullet_ids = IdAllocator.from_state(*bullet_ids)
+        if self.history is not None:
+            self.history.load_state(history)
 
-            logging.info(f'State sent: {game_state_encoded}')
-            await asyncio.sleep(0.05)
-            
     async def handle_client(self, reader, writer):
         # Get the client's name
         logging.error(f'New player connected - total player: {len(self.players)}')
 
         # create unique player id
-        new_id = 0
-        while new_id in [player.id for player in self.players]:
-            new_id += 1
+        new_id = self.player_ids.allocate()
 
         # get random position
-        player = Player(random.randint(0, self.game_field_width), random.randint(0, self.game_field_height), new_id, writer)
-
-        writer.write(f"id:{player.id}\n".encode())
-        await writer.drain()
-
-        self.players.append(player)
-
-        # Listen for messages from the client and broadcast them to all other clients
+        player = self.make_player(new_id, random.randint(0, self.game_field_width),
+                                  random.randint(0, self.game_field_height), writer)
+
+        # old clients only read the id, new ones may ask to switch to binary
+        # and for compression
+        offers = f':{compression.ADVERT}' if self.compress_level else ''
+        try:
+            writer.write(f"id:{index_of(player.id)}:{protocol.ADVERT}{offers}\n".encode())
+            await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            # gone before it joined: nothing but the id to give back
+            self.player_ids.release(player.id)
+            writer.close()
+            return
+
+        player.outbox = Outbox(writer, self.max_backlog, on_close=lambda: self.drop_player(player))
+        player.outbox.start()
+        self.add_player(player)
+
+        # Listen for messages from the client; inputs are queued for the
+        # next tick, anything that does not parse is counted and skipped
+        compressed = False
         while True:
             try:
-                message = (await reader.readline()).decode()
+                if player.protocol == 'binary':
+                    try:
+                        frame_type, payload = await protocol.read_frame(reader, MAX_INPUT_FRAME)
+                    except ValueError:
+                        # the stream is out of step, nothing more can be read
+                        self.input_malformed(player)
+                        break
+                    self.handle_frame(player, frame_type, payload)
+                    continue
+
+                try:
+                    message = await reader.readline()
+                except ValueError:
+                    # a line over the stream limit, the rest of it is skipped
+                    self.input_malformed(player)
+                    continue
                 if not message:
                     break
+                player.bytes_in += len(message)
+                player.messages_in += 1
 
-                logging.info(f'Player sent: {message}')
-                x_action, y_action, fire_action = message.split(',')
-                player.speed_x += float(x_action)
-                player.speed_y += float(y_action)
-
-                b_id = 0
-                if fire_action == '1\n':
-                    while b_id in [bullet.id for bullet in self.bullets]:
-                        b_id += 1
-                    bullet = Bullet(player.x + self.player_width // 2, player.y - self.player_height // 2, b_id, new_id, 0, -10)
-                    self.bullets.append(bullet)                    
-
-            except(ConnectionResetError, BrokenPipeError):
-                if player in self.players:
-                    logging.error(f'Player {player.id} disconnected')
-                    self.players.remove(player)
+                tracer('input', 'Player %d sent: %r', player.id, message)
+                keys = TEXT_INPUTS.get(message)
+                if keys is not None:
+                    self.queue_input(player, None, 0, *keys)
+                    continue
+
+                if message == protocol.UPGRADE:
+                    # a text state still queued must not follow the echo
+                    player.outbox.discard_state()
+                    player.outbox.send_control(protocol.UPGRADE + protocol.encode_hello(player.id))
+                    player.protocol = 'binary'
+                    continue
+
+                if message == compression.REQUEST and self.compress_level and not compressed:
+                    compressed = True
+                    player.outbox.send_control(compression.REQUEST)
+                    player.outbox.start_compression(compression.StreamCompressor(self.compress_level))
+                    continue
+
+                try:
+                    x_action, y_action, fire_action = message.split(b',')
+                    self.queue_input(player, None, 0, float(x_action), float(y_action), fire_action.strip() == b'1')
+                except ValueError:
+                    self.input_malformed(player)
+
+            except(asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
                 break
 
         # Remove the client from the list of connected clients
-        # del self.clients[name]
+        player.outbox.close()
         logging.info(f'Client disconnected')
 
-    async def start(self):
-        server = await asyncio.start_server(self.handle_client, '0.0.0.0', 8888)
+    async def start(self, port=8888):
+        server = await asyncio.start_server(self.handle_client, '0.0.0.0', port)
         print(f'Server started at {server.sockets[0].getsockname()}')
 
         async with server:
             await server.serve_forever()
 
-    async def run(self):
-        await asyncio.gather(self.start(), self.update_and_send_state())
+    async def handle_watcher(self, reader, writer):
+        watcher = Watcher()
+        watcher.outbox = Outbox(writer, self.max_backlog, on_close=lambda: self.watchers.remove(watcher))
+        watcher.outbox.send_control(protocol.encode_hello(protocol.WATCHER_ID))
+        watcher.outbox.start()
+        self.watchers.append(watcher)
+        logging.error(f'Relay subscribed - total relays: {len(self.watchers)}')
+        try:
+            # a relay only ever sends acks
+            while True:
+                frame_type, payload = await protocol.read_frame(reader, protocol.ACK_BODY.size)
+                if frame_type != protocol.ACK:
+                    break
+                seq = protocol.decode_ack(payload)
+                if watcher.acked_seq < seq <= self.seq:
+                    watcher.acked_seq = seq
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, struct.error):
+            pass
+        watcher.outbox.close()
+        logging.error(f'Relay unsubscribed')
+
+    async def start_watch(self, port):
+        server = await asyncio.start_server(self.handle_watcher, '0.0.0.0', port)
+        print(f'Relays subscribe at {server.sockets[0].getsockname()}')
+        async with server:
+            await server.serve_forever()
+
+    async def start_udp(self, port):
+        loop = asyncio.get_running_loop()
+        transport, udp_server = await loop.create_datagram_endpoint(lambda: UdpServer(self),
+                                                                    local_addr=('0.0.0.0', port))
+        print(f'UDP server started at {transport.get_extra_info("sockname")}')
+        try:
+            await udp_server.run()
+        finally:
+            transport.close()
+
+    async def run(self, port=8888, metrics_port=None, udp_port=None, watch_port=None):
+        tasks = [self.start(port), self.update_and_send_state()]
+        if udp_port is not None:
+            tasks.append(self.start_udp(udp_port))
+        if watch_port is not None:
+            tasks.append(self.start_watch(watch_port))
+        if metrics_port is not None:
+            registry = Registry()
+            self.enable_metrics(registry)
+            tracer.register(registry)
+            tasks.append(registry.serve(metrics_port))
+        await asyncio.gather(*tasks)
+
+def field_size(text):
+    # --field WIDTHxHEIGHT, within what the binary protocol can carry
+    try:
+        width, height = (int(v) for v in text.split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{text!r} is not WIDTHxHEIGHT')
+    if not (0 < width <= protocol.MAX_COORD and 0 < height <= protocol.MAX_COORD):
+        raise argparse.ArgumentTypeError(f'the field can be at most {protocol.MAX_COORD}x{protocol.MAX_COORD}, '
+                                         f'the range of binary coordinates')
+    return width, height
+
+def add_server_arguments(parser):
+    # options of a game world, shared with game-router.py
+    parser.add_argument('--engine', choices=['objects', 'numpy'], default='objects')
+    parser.add_argument('--broadphase', choices=['grid', 'naive'], default='grid')
+    parser.add_argument('--tick-rate', type=float, default=20, help='simulation steps per second')
+    parser.add_argument('--send-rate', type=float, default=None, help='states sent per second (default: the tick rate)')
+    parser.add_argument('--max-backlog', type=int, default=40,
+                        help='states in a row a slow client may miss before it is disconnected')
+    parser.add_argument('--input-rate', type=float, default=60,
+                        help='inputs per second a client may send, more are dropped')
+    parser.add_argument('--fire-interval', type=float, default=0.2, help='seconds between two bullets of a player')
+    parser.add_argument('--rewind-window', type=float, default=0,
+                        help='lag compensation: test hits against where targets were up to this many ms ago, '
+                             'as the shooter saw them (default 0, off)')
+    parser.add_argument('--client-delay', type=float, default=100,
+                        help='interpolation delay of the clients in ms, added to the round trip when rewinding')
+    parser.add_argument('--compress-level', type=int, default=0,
+                        help='offer TCP clients zlib compression at this level, 1-9, see compression.py (default: 0, off)')
+    parser.add_argument('--field', type=field_size, default=(800, 800),
+                        help=f'size of the game field, WIDTHxHEIGHT, at most {protocol.MAX_COORD} each (default: 800x800)')
+    parser.add_argument('--view', default=None,
+                        help='send each client only the WIDTHxHEIGHT area around its ship (default: the whole field)')
+
+def server_from_args(args, **kwargs):
+    # kwargs go to GameServer as they are, e.g. the clock of a headless run
+    view_size = tuple(int(v) for v in args.view.split('x')) if args.view else None
+    game_server = GameServer(broadphase=args.broadphase, engine=args.engine, view_size=view_size,
+                             tick_rate=args.tick_rate, send_rate=args.send_rate, max_backlog=args.max_backlog,
+                             input_rate=args.input_rate, fire_interval=args.fire_interval,
+                             rewind_window=args.rewind_window / 1000, client_delay=args.client_delay / 1000,
+                             compress_level=args.compress_level, **kwargs)
+    game_server.game_field_width, game_server.game_field_height = args.field
+    return game_server
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve Prometheus metrics on this local port (default: off)')
+    add_server_arguments(parser)
+    parser.add_argument('--udp-port', type=int, default=None,
+                        help='also accept clients over UDP on this port, see udp_transport.py (default: off)')
+    parser.add_argument('--watch-port', type=int, default=None,
+                        help='let spectator relays subscribe on this port, see spectator-relay.py (default: off)')
+    parser.add_argument('--record', default=None,
+                        help='append every tick and the inputs applied in it to this replay log, see game-replay.py')
+    add_trace_arguments(parser)
+    args = parser.parse_args()
 
     format = "SRV: %(asctime)s: %(message)s"
     logging.basicConfig(format=format, level=logging.ERROR,
                         datefmt="%F-%H-%M-%S")
 
-    game_server = GameServer()
-
-    asyncio.run(game_server.run())
+    game_server = server_from_args(args)
+    if args.record:
+        from replay import ReplayRecorder
+        game_server.recorder = ReplayRecorder.for_server(args.record, game_server)
+
+    tracing = start_from_args(args)
+    try:
+        asyncio.run(game_server.run(args.port, args.metrics_port, args.udp_port, args.watch_port))
+    finally:
+        if game_server.recorder is not None:
+            game_server.recorder.close()
+        if tracing:
+            tracer.stop()
+            print(tracer.report())
 
     asyncio.run()
\ No newline at end of file
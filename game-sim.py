@@ -0,0 +1,108 @@
+# Headless fast-forward: a GameServer with scripted clients on a virtual
+# clock, without sockets. The server runs its live loop (scheduler, tick,
+# send_state), only no tick waits for the wall clock, so hours of play
+# take seconds. For balance tests and for profiling the tick.
+#
+#   python game-sim.py --ticks 72000 --clients 20
+#   python game-sim.py --ticks 6000 --clients 200 --engine numpy --profile 25
+#   python game-sim.py --ticks 20000 --script moves.txt --respawn --record sim.rep
+#
+# Clients behave like the bots of bot-swarm.py (--behaviour or --script)
+# and are seeded from --seed, as are the spawn positions, so a run can be
+# repeated exactly. The server options are those of game-server.py.
+
+import argparse
+import cProfile
+import importlib
+import pstats
+import random
+import time
+
+from headless import ScriptedClient, VirtualClock, run_headless
+from tracing import add_trace_arguments, start_from_args, tracer
+
+game_server = importlib.import_module('game-server')
+bot_swarm = importlib.import_module('bot-swarm')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ticks', type=int, default=12000, help='simulation steps to run')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--behaviour', choices=['random', 'circle', 'idle'], default='random')
+    parser.add_argument('--script', default=None, help='file of "move_x move_y fire seconds" lines, see bot-swarm.py')
+    parser.add_argument('--protocol', choices=['text', 'binary'], default='binary')
+    parser.add_argument('--keepalive', type=float, default=1.0)
+    parser.add_argument('--latency', type=float, default=0, help='round trip of the binary clients\' state acks in ms')
+    parser.add_argument('--respawn', action='store_true', help='clients whose ship is destroyed join again')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--record', default=None, help='write a replay log, see game-replay.py')
+    parser.add_argument('--profile', type=int, nargs='?', const=20, default=None,
+                        help='profile the run and print the N functions with the most cumulative time')
+    game_server.add_server_arguments(parser)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    clock = VirtualClock()
+    server = game_server.server_from_args(args, clock=clock, sleep=clock.sleep)
+    if args.record:
+        from replay import ReplayRecorder
+        server.recorder = ReplayRecorder.for_server(args.record, server)
+
+    if args.script:
+        moves = bot_swarm.script_moves(bot_swarm.load_script(args.script))
+    else:
+        moves = {'random': bot_swarm.random_moves, 'circle': bot_swarm.circle_moves,
+                 'idle': bot_swarm.idle_moves}[args.behaviour]
+    clients = [ScriptedClient(server, moves(random.Random(args.seed + number)), args.protocol, args.keepalive,
+                              args.respawn, args.latency / 1000)
+               for number in range(args.clients)]
+
+    phases = dict.fromkeys(server.phase_times, 0.0)
+    busy_ticks = 0
+
+    def on_tick():
+        nonlocal busy_ticks
+        if server.players:
+            busy_ticks += 1
+            for phase, seconds in server.phase_times.items():
+                phases[phase] += seconds
+
+    tracing = start_from_args(args)
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        run_headless(server, clients, args.ticks, on_tick)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if server.recorder is not None:
+            server.recorder.close()
+        if tracing:
+            tracer.stop()
+    elapsed = time.perf_counter() - start
+
+    simulated = clock.now
+    stats = server.scheduler.stats()
+    print(f'{stats["steps"]} ticks, {simulated:.0f} s of play in {elapsed:.2f} s: '
+          f'{stats["steps"] / elapsed:.0f} ticks/s, {simulated / elapsed:.0f}x real time')
+    if busy_ticks:
+        print('per tick ms: ' + ', '.join(f'{phase} {seconds / busy_ticks * 1000:.3f}' for phase, seconds in phases.items())
+              + f', whole tick and send {elapsed / stats["steps"] * 1000:.3f}')
+    received = sum(client.bytes_received for client in clients)
+    print(f'players {len(server.players)} alive of {args.clients} clients, {sum(c.deaths for c in clients)} destroyed, '
+          f'{server.bullet_count()} bullets in flight, {stats["sends"]} states sent')
+    print(f'inputs {server.input_messages} accepted, {server.inputs_dropped} dropped; '
+          f'{received / max(simulated, 1e-9) / max(args.clients, 1) / 1024:.1f} KiB/s per client')
+
+    if tracing:
+        print(tracer.report())
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.profile)
+
+
+if __name__ == '__main__':
+    main()
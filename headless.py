@@ -0,0 +1,139 @@
+import asyncio
+import collections
+import random
+
+# Headless runs of a GameServer: no sockets and no wall clock. The server's
+# own loop (TickScheduler.run with tick() and send_state()) is driven by a
+# VirtualClock whose sleep returns at once with the clock moved forward,
+# so ticks run back to back as fast as the CPU allows while every part of
+# the server sees the times it would see live. Clients are ScriptedClients
+# that queue inputs the way game-client.py sends them, and take their
+# states through a HeadlessOutbox instead of a socket.
+
+
+class VirtualClock:
+    # stands in for time.monotonic (call it) and asyncio.sleep (sleep)
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        if delay > 0:
+            self.now += delay
+
+
+class HeadlessOutbox:
+    # the Outbox of a scripted client: frames are counted and dropped, and
+    # a binary client acks every state, latency seconds after it was sent
+    def __init__(self, client):
+        self.client = client
+        self.closed = False
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+
+    def depth(self):
+        return 0
+
+    def send_control(self, data):
+        self.bytes_sent += len(data)
+        self.frames_sent += 1
+        self.client.bytes_received += len(data)
+
+    def send_state(self, data):
+        self.bytes_sent += len(data)
+        self.frames_sent += 1
+        self.client.bytes_received += len(data)
+        if self.client.protocol == 'binary':
+            self.client.receive_state()
+
+    def discard_state(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class ScriptedClient:
+    # A player whose keys come from moves, an iterator of (move x, move y,
+    # fire, seconds) steps like the behaviours of bot-swarm.py. Like
+    # game-client.py it sends the keys when they change and again every
+    # keepalive seconds. A client whose ship was destroyed joins again as
+    # a new player when respawn is set, as if it had reconnected. Binary
+    # clients ack states after latency seconds, the round trip the server
+    # measures for lag compensation.
+    def __init__(self, server, moves, protocol='binary', keepalive=1.0, respawn=False, latency=0.0):
+        self.server = server
+        self.moves = moves
+        self.protocol = protocol
+        self.keepalive = keepalive
+        self.respawn = respawn
+        self.latency = latency
+        # (due time, seq) of the acks on their way
+        self.acks = collections.deque()
+        self.player = None
+        self.keys = self.last_keys = None
+        self.change_at = self.last_sent = 0.0
+        self.seq = 0
+        self.deaths = 0
+        # over every ship of the client
+        self.bytes_received = 0
+        self.join()
+
+    def join(self):
+        server = self.server
+        self.player = server.make_player(server.player_ids.allocate(), random.randint(0, server.game_field_width),
+                                         random.randint(0, server.game_field_height))
+        self.player.protocol = self.protocol
+        self.player.outbox = HeadlessOutbox(self)
+        self.last_keys = None
+        self.acks.clear()
+        server.add_player(self.player)
+
+    def receive_state(self):
+        seq = self.server.seq
+        if self.latency <= 0:
+            self.server.acknowledge(self.player, seq)
+        else:
+            self.acks.append((self.server.clock() + self.latency, seq))
+
+    def poll(self, now):
+        # deliver the acks and queue the inputs the client would have sent
+        # by now
+        while self.acks and self.acks[0][0] <= now:
+            self.server.acknowledge(self.player, self.acks.popleft()[1])
+        if self.player.hit_points <= 0:
+            if self.player.outbox.closed:
+                return
+            self.deaths += 1
+            if not self.respawn:
+                self.player.outbox.close()
+                return
+            self.join()
+
+        if now >= self.change_at:
+            move_x, move_y, fire, seconds = next(self.moves)
+            self.keys = (move_x, move_y, fire)
+            self.change_at = now + seconds
+        if self.keys != self.last_keys or now - self.last_sent >= self.keepalive:
+            self.seq += 1
+            seq = self.seq if self.protocol == 'binary' else None
+            self.server.queue_input(self.player, seq, int(now * 1000), *self.keys)
+            self.last_keys, self.last_sent = self.keys, now
+
+
+def run_headless(server, clients, ticks, on_tick=None):
+    # ticks steps of the live loop; the server must have been built with a
+    # VirtualClock as its clock and the clock's sleep. on_tick() is called
+    # after every step.
+    def step():
+        now = server.clock()
+        for client in clients:
+            client.poll(now)
+        server.tick()
+        if on_tick is not None:
+            on_tick()
+
+    asyncio.run(server.scheduler.run(step, server.send_state, max_steps=ticks))
@@ -0,0 +1,244 @@
+import operator
+from itertools import chain
+
+import protocol
+
+# cells along the shorter side of a view. A view is made of whole cells,
+# so smaller cells send fewer entities beyond the viewport but cost every
+# client more cells to look at.
+CELLS_PER_VIEW = 4
+
+# the Baseline entry of a view without cells
+EMPTY_CELL = (0, b'', 0, b'', (), (), (), ())
+
+EMPTY = {}
+
+# the parts of a Baseline entry
+ARRIVED = operator.itemgetter(6)
+DEPARTED = operator.itemgetter(7)
+
+
+class Changes(dict):
+    # id -> encoded change of an entity from base to current, b'' when it
+    # did not change, or its whole record when it is not in base. Filled
+    # as the clients' views need them and shared by all of them.
+    def __init__(self, base, current, fields):
+        super().__init__()
+        self.base = base
+        self.current = current
+        self.fields = fields
+
+    def __missing__(self, e_id):
+        record = self.current[e_id]
+        old = self.base.get(e_id)
+        change = self[e_id] = protocol.encode_change(e_id, old, record, self.fields) if old != record else b''
+        return change
+
+
+class Entries(dict):
+    # key -> make(key), made the first time a client asks for it
+    def __init__(self, make):
+        super().__init__()
+        self.make = make
+
+    def __missing__(self, key):
+        entry = self[key] = self.make(key)
+        return entry
+
+
+class InterestIndex:
+    # per tick index of a snapshot for area of interest filtering. Built
+    # once per tick, then every client only looks at the grid cells around
+    # its own ship instead of the whole world.
+    #
+    # A view is made of whole cells, of CELLS_PER_VIEW to a view side: the
+    # cells the viewport touches, and those the client already had that
+    # are still within margin of it, so nothing flickers on the border.
+    # A client also always sees its own ship and bullets.
+    #
+    # Coordinates are the quantized ones of the snapshot.
+    def __init__(self, snapshot, view_width, view_height, margin, ship_width, ship_height):
+        self.players, self.bullets = snapshot
+        # a view is never smaller than the ship, so the ship is always in it
+        self.half_width = max(view_width, ship_width) / 2
+        self.half_height = max(view_height, ship_height) / 2
+        self.margin = margin
+        self.ship_width = ship_width
+        self.ship_height = ship_height
+
+        # per kind: id -> cell, and cell -> {id: record} of the entities in it
+        self.cell_size = c = max(1, int(min(view_width, view_height) // CELLS_PER_VIEW))
+        self.cell_of = ({p_id: (x // c, y // c) for p_id, (x, y, hp) in self.players.items()},
+                        {b_id: (x // c, y // c) for b_id, (owner, x, y) in self.bullets.items()})
+        self.cells = ({}, {})
+        for records, cell_of, cells in zip(snapshot, self.cell_of, self.cells):
+            for e_id, key in cell_of.items():
+                cell = cells.get(key)
+                if cell is None:
+                    cells[key] = {e_id: records[e_id]}
+                else:
+                    cell[e_id] = records[e_id]
+        self.spawns = (Changes({}, self.players, protocol.PLAYER_FIELDS),
+                       Changes({}, self.bullets, protocol.BULLET_FIELDS))
+        # owner id -> ids of its bullets
+        self.owned = {}
+        for b_id, (owner, x, y) in self.bullets.items():
+            owned = self.owned.get(owner)
+            if owned is None:
+                self.owned[owner] = {b_id}
+            else:
+                owned.add(b_id)
+
+    def view_cells(self, player_id, previous, previous_bounds):
+        # the cells of player_id's view and the cell bounds they were made
+        # from, to be passed as previous and previous_bounds next tick;
+        # those are of the view it was sent last. The cells are made again
+        # only when the bounds change, when the ship moves to another cell.
+        me = self.players.get(player_id)
+        if me is None:
+            return frozenset(), None
+        center_x = me[0] + self.ship_width / 2
+        center_y = me[1] + self.ship_height / 2
+        c, m = self.cell_size, self.margin
+        left, right = center_x - self.half_width, center_x + self.half_width
+        top, bottom = center_y - self.half_height, center_y + self.half_height
+        bounds = (int(left // c), int(right // c), int(top // c), int(bottom // c),
+                  int((left - m) // c), int((right + m) // c), int((top - m) // c), int((bottom + m) // c))
+        if bounds == previous_bounds:
+            return previous, bounds
+        x0, x1, y0, y1, outer_x0, outer_x1, outer_y0, outer_y1 = bounds
+        keys = {(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)}
+        keys.update(key for key in previous if outer_x0 <= key[0] <= outer_x1 and outer_y0 <= key[1] <= outer_y1)
+        return frozenset(keys), bounds
+
+    def view(self, player_id, keys):
+        # the part of the snapshot made of the cells keys and the own
+        # bullets of player_id, for keyframes and text states
+        players, bullets = {}, {}
+        for key in keys:
+            cell = self.cells[0].get(key)
+            if cell is not None:
+                players.update(cell)
+            cell = self.cells[1].get(key)
+            if cell is not None:
+                bullets.update(cell)
+        for b_id in self.owned.get(player_id, ()):
+            bullets[b_id] = self.bullets[b_id]
+        return players, bullets
+
+    def against(self, base):
+        # what the clients with views of the tick of the index base share
+        return Baseline(self, base)
+
+
+class Baseline:
+    # The encodings clients with views of one baseline tick share in a
+    # tick. An entity in a client's view is sent as a change when it came
+    # from a cell of the client's baseline view, as a new record when it
+    # did not, and removed when it went to a cell outside the view. Most
+    # entities stay in their cell, so the changes of those that stayed are
+    # encoded once per cell and a client takes the block of every cell of
+    # its view whole; only the entities that crossed into or out of its
+    # cells, and its own bullets outside them, are looked at one by one.
+    def __init__(self, index, base):
+        self.index = index
+        self.base = base
+        self.changes = (Changes(base.players, index.players, protocol.PLAYER_FIELDS),
+                        Changes(base.bullets, index.bullets, protocol.BULLET_FIELDS))
+        # the cells with entities at either tick, and cell -> the entry of
+        # the cell, see entry()
+        self.occupied = (index.cells[0].keys() | index.cells[1].keys() |
+                         base.cells[0].keys() | base.cells[1].keys())
+        self.entries = Entries(self.entry)
+
+    def entry(self, key):
+        # the players and bullets in cell key at both ticks, as (records,
+        # bytes) of the changes of each kind, then the ids of each; then
+        # (kind, id, cell) of those that moved into the cell, with the cell
+        # they came from or None for the new, and of those that left it,
+        # with the cell they went to or None for the gone
+        cells = (self.index.cells[0].get(key, EMPTY), self.index.cells[1].get(key, EMPTY))
+        base_cells = (self.base.cells[0].get(key, EMPTY), self.base.cells[1].get(key, EMPTY))
+        if cells[0].keys() == base_cells[0].keys() and cells[1].keys() == base_cells[1].keys():
+            players = list(map(self.changes[0].__getitem__, cells[0]))
+            bullets = list(map(self.changes[1].__getitem__, cells[1]))
+            return (len(players) - players.count(b''), b''.join(players),
+                    len(bullets) - bullets.count(b''), b''.join(bullets), cells[0], cells[1], (), ())
+        counts_bodies, stayed, arrived, departed = (), (), [], []
+        for kind, cell, base_cell in zip((0, 1), cells, base_cells):
+            if cell.keys() == base_cell.keys():
+                ids = cell
+            else:
+                ids = cell.keys() & base_cell.keys()
+                base_cell_of, cell_of = self.base.cell_of[kind], self.index.cell_of[kind]
+                arrived += [(kind, e_id, base_cell_of.get(e_id)) for e_id in cell.keys() - base_cell.keys()]
+                departed += [(kind, e_id, cell_of.get(e_id)) for e_id in base_cell.keys() - cell.keys()]
+            bodies = list(map(self.changes[kind].__getitem__, ids))
+            counts_bodies += (len(bodies) - bodies.count(b''), b''.join(bodies))
+            stayed += (ids,)
+        return counts_bodies + stayed + (arrived, departed)
+
+    def delta(self, seq, base_seq, player_id, keys, base_keys):
+        # the DELTA frame of player_id's view of the cells keys against its
+        # view of base_seq, the baseline tick, of the cells base_keys
+        entries, occupied = self.entries, self.occupied.__contains__
+        if keys is base_keys or keys == base_keys:
+            columns = list(zip(EMPTY_CELL, *map(entries.__getitem__, filter(occupied, keys))))
+            arrived, departed = chain.from_iterable(columns[6]), chain.from_iterable(columns[7])
+            added = dropped = ()
+        else:
+            columns = list(zip(EMPTY_CELL, *map(entries.__getitem__, filter(occupied, keys & base_keys))))
+            arrived = chain.from_iterable(map(ARRIVED, map(entries.__getitem__, filter(occupied, keys))))
+            departed = chain.from_iterable(map(DEPARTED, map(entries.__getitem__, filter(occupied, base_keys))))
+            added, dropped = filter(occupied, keys - base_keys), filter(occupied, base_keys - keys)
+        counts = [sum(columns[0]), sum(columns[2])]
+        parts = [list(columns[1]), list(columns[3])]
+
+        # the changes, or records, of the entities that moved into the cells
+        # and of all those of the cells new to the view, and the ids of
+        # those that left the view
+        moved = ([], [])
+        removed = ([], [])
+        changes, spawns = self.changes, self.index.spawns
+        for kind, e_id, source in arrived:
+            moved[kind].append(changes[kind][e_id] if source is None or source in base_keys else spawns[kind][e_id])
+        for kind, e_id, destination in departed:
+            if destination not in keys:
+                removed[kind].append(e_id)
+        for key in added:
+            entry = entries[key]
+            moved[0].extend(map(spawns[0].__getitem__, entry[4]))
+            moved[1].extend(map(spawns[1].__getitem__, entry[5]))
+        for key in dropped:
+            entry = entries[key]
+            removed[0].extend(entry[4])
+            removed[1].extend(entry[5])
+
+        # own bullets outside the cells: a change when the client had them,
+        # as it had those of base_own. Those that left the baseline view's
+        # cells are not removed with them.
+        own = self.index.owned.get(player_id, frozenset())
+        base_own = self.base.owned.get(player_id, frozenset())
+        if own:
+            cell_of = self.index.cell_of[1]
+            outside = [b_id for b_id in own if cell_of[b_id] not in keys]
+            if outside:
+                base_cell_of = self.base.cell_of[1]
+                kept = {b_id for b_id in outside if base_cell_of.get(b_id) in base_keys}
+                moved[1].extend([changes[1][b_id] if b_id in base_own or b_id in kept else spawns[1][b_id]
+                                 for b_id in outside])
+                if kept and removed[1]:
+                    removed[1][:] = [b_id for b_id in removed[1] if b_id not in kept]
+        if base_own:
+            cell_of, base_cell_of = self.index.cell_of[1], self.base.cell_of[1]
+            removed[1].extend([b_id for b_id in base_own - own
+                               if base_cell_of[b_id] not in base_keys and cell_of.get(b_id) not in keys])
+
+        for kind in (0, 1):
+            counts[kind] += len(moved[kind]) - moved[kind].count(b'')
+            parts[kind] += moved[kind]
+        pack = protocol.ENTITY_ID.pack
+        return protocol.delta_frame(
+            seq, base_seq,
+            (counts[0], b''.join(parts[0]), len(removed[0]), b''.join(map(pack, removed[0]))),
+            (counts[1], b''.join(parts[1]), len(removed[1]), b''.join(map(pack, removed[1]))))
@@ -0,0 +1,73 @@
+import collections
+
+
+# one state from the server: arrival time, {id: (x, y, hp)}, {id: (owner, x, y)}
+Snapshot = collections.namedtuple('Snapshot', 'time players bullets')
+
+
+def lerp(a, b, t):
+    return a + (b - a) * t
+
+
+class SnapshotBuffer:
+    # States as they arrive from the server, stamped with the local arrival
+    # time. The renderer samples the world `delay` seconds in the past, so
+    # there is almost always a newer state to move towards and remote ships
+    # and bullets glide between states instead of jumping at the send rate.
+    #
+    # push() is called from the network thread, sample() from the renderer.
+    # Neither takes a lock: push() builds a new tuple of the recent
+    # snapshots and publishes it with a single reference assignment, and
+    # sample() reads that reference once. A published tuple and the
+    # snapshots in it are never changed, so the renderer always sees one
+    # consistent set of states however the threads interleave.
+    def __init__(self, delay=0.1, keep=1.0):
+        self.delay = delay
+        self.keep = keep
+        self.states = ()
+
+    def push(self, now, players_state, bullets_state):
+        snapshot = Snapshot(now, {p_id: (x, y, hp) for p_id, x, y, hp in players_state},
+                            {b_id: (owner, x, y) for b_id, owner, x, y in bullets_state})
+        states = self.states
+        # two states older than the render time are enough
+        first = 0
+        while len(states) - first > 2 and states[first + 1].time < now - self.keep:
+            first += 1
+        self.states = states[first:] + (snapshot,)
+
+    def sample(self, now):
+        # the world at now - delay as (players_state, bullets_state) lists,
+        # or None before the first state. Entities are those of the newer
+        # state; an entity that is in both states is interpolated.
+        render_time = now - self.delay
+        states = self.states
+        if not states:
+            return None
+        older = newer = states[-1]
+        for i in range(len(states) - 1, 0, -1):
+            if states[i - 1].time <= render_time:
+                older, newer = states[i - 1], states[i]
+                break
+        else:
+            older = newer = states[0]
+
+        if render_time >= newer.time or older is newer:
+            t = 1.0
+        else:
+            t = (render_time - older.time) / (newer.time - older.time)
+
+        old_players, old_bullets = older.players, older.bullets
+        players_state = []
+        for p_id, (x, y, hp) in newer.players.items():
+            old = old_players.get(p_id)
+            if old is not None:
+                x, y = lerp(old[0], x, t), lerp(old[1], y, t)
+            players_state.append((p_id, x, y, hp))
+        bullets_state = []
+        for b_id, (owner, x, y) in newer.bullets.items():
+            old = old_bullets.get(b_id)
+            if old is not None:
+                x, y = lerp(old[1], x, t), lerp(old[2], y, t)
+            bullets_state.append((b_id, owner, x, y))
+        return players_state, bullets_state
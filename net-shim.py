@@ -0,0 +1,194 @@
+# A lossy, laggy link between clients and a server on one machine, to
+# compare the TCP and UDP transports under the same conditions.
+#
+#   python game-server.py --udp-port 8889
+#   python net-shim.py --tcp 9888:8888 --udp 9889:8889 --loss 2 --latency 40 --jitter 10
+#   python bot-swarm.py --bots 20 --port 9888
+#   python bot-swarm.py --bots 20 --port 9889 --transport udp
+#
+# Every datagram, and every segment of a TCP stream, is delayed by
+# --latency ms plus up to --jitter ms each way, and --loss percent of them
+# are lost. A lost datagram is gone. TCP cannot lose data, so a lost
+# segment arrives --rto ms late instead, the time a resend takes, and
+# holds back every segment behind it: the head of line blocking that makes
+# a TCP client's states arrive in bursts.
+
+import argparse
+import asyncio
+import functools
+import random
+import time
+
+SEGMENT_SIZE = 1460
+
+
+class Link:
+    # the delay and loss of one direction of the link
+    def __init__(self, args, rng):
+        self.loss = args.loss / 100
+        self.latency = args.latency / 1000
+        self.jitter = args.jitter / 1000
+        self.rto = args.rto / 1000
+        self.rng = rng
+        self.passed = 0
+        self.lost = 0
+
+    def delay(self):
+        return self.latency + self.rng.uniform(0, self.jitter)
+
+    def is_lost(self):
+        if self.rng.random() < self.loss:
+            self.lost += 1
+            return True
+        self.passed += 1
+        return False
+
+
+class UdpUpstream(asyncio.DatagramProtocol):
+    # the shim's socket towards the server for one client
+    def __init__(self, shim, client_addr):
+        self.shim = shim
+        self.client_addr = client_addr
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.shim.forward(self.shim.down, lambda: self.shim.transport.sendto(data, self.client_addr))
+
+    def error_received(self, exc):
+        pass
+
+
+class UdpShim(asyncio.DatagramProtocol):
+    def __init__(self, target, up, down):
+        self.target = target
+        self.up = up
+        self.down = down
+        self.transport = None
+        # client address -> UdpUpstream, or the future of one being opened
+        self.upstreams = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def forward(self, link, send):
+        if link.is_lost():
+            return
+        asyncio.get_running_loop().call_later(link.delay(), send)
+
+    def datagram_received(self, data, addr):
+        upstream = self.upstreams.get(addr)
+        if upstream is None:
+            upstream = self.upstreams[addr] = asyncio.ensure_future(self.open_upstream(addr))
+        if isinstance(upstream, asyncio.Future):
+            upstream.add_done_callback(lambda done: done.exception() or self.datagram_received(data, addr))
+            return
+        self.forward(self.up, lambda: upstream.transport.sendto(data))
+
+    async def open_upstream(self, addr):
+        loop = asyncio.get_running_loop()
+        try:
+            _, upstream = await loop.create_datagram_endpoint(lambda: UdpUpstream(self, addr), remote_addr=self.target)
+        except OSError:
+            del self.upstreams[addr]
+            raise
+        self.upstreams[addr] = upstream
+        return upstream
+
+    def error_received(self, exc):
+        pass
+
+
+async def pump(reader, writer, link):
+    # copy one direction of a TCP connection segment by segment, each
+    # written when it is due and never before the segment ahead of it
+    queue = asyncio.Queue()
+
+    async def deliver():
+        while True:
+            due, segment = await queue.get()
+            if segment is None:
+                break
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            writer.write(segment)
+            await writer.drain()
+
+    delivering = asyncio.create_task(deliver())
+    last_due = 0.0
+    try:
+        while segment := await reader.read(SEGMENT_SIZE):
+            due = time.monotonic() + link.delay()
+            if link.is_lost():
+                due += link.rto
+            last_due = max(due, last_due)
+            queue.put_nowait((last_due, segment))
+        queue.put_nowait((0.0, None))
+        await delivering
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        delivering.cancel()
+        writer.close()
+
+
+async def tcp_client(reader, writer, target, up, down):
+    try:
+        server_reader, server_writer = await asyncio.open_connection(*target)
+    except OSError:
+        writer.close()
+        return
+    await asyncio.gather(pump(reader, server_writer, up), pump(server_reader, writer, down))
+
+
+def address(text):
+    listen, target = text.split(':', 1)
+    host, _, port = target.rpartition(':')
+    return int(listen), (host or 'localhost', int(port))
+
+
+async def report(links, interval=5.0):
+    while True:
+        await asyncio.sleep(interval)
+        print('  '.join(f'{name} {link.passed} passed {link.lost} lost' for name, link in links.items()))
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    links = {}
+    tasks = []
+    if args.tcp:
+        listen, target = address(args.tcp)
+        links['tcp up'], links['tcp down'] = Link(args, rng), Link(args, rng)
+        server = await asyncio.start_server(
+            functools.partial(tcp_client, target=target, up=links['tcp up'], down=links['tcp down']), '0.0.0.0', listen)
+        print(f'TCP {listen} -> {target[0]}:{target[1]}')
+        tasks.append(server.serve_forever())
+    if args.udp:
+        listen, target = address(args.udp)
+        links['udp up'], links['udp down'] = Link(args, rng), Link(args, rng)
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(functools.partial(UdpShim, target, links['udp up'], links['udp down']),
+                                            local_addr=('0.0.0.0', listen))
+        print(f'UDP {listen} -> {target[0]}:{target[1]}')
+    if not links:
+        raise SystemExit('nothing to forward, give --tcp and/or --udp')
+    tasks.append(report(links))
+    await asyncio.gather(*tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tcp', default=None, help='LISTEN:[HOST:]PORT, forward TCP from LISTEN to the server')
+    parser.add_argument('--udp', default=None, help='LISTEN:[HOST:]PORT, forward UDP from LISTEN to the server')
+    parser.add_argument('--loss', type=float, default=0, help='percent of datagrams or segments lost')
+    parser.add_argument('--latency', type=float, default=0, help='ms of delay each way')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many ms more delay each way')
+    parser.add_argument('--rto', type=float, default=200, help='ms a lost TCP segment takes to be resent')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
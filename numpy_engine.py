@@ -0,0 +1,286 @@
+import time
+
+import numpy as np
+
+import protocol
+from entity_ids import INDEX_MASK
+
+
+# how much pairs_in_window widens its window, so that no pair the exact
+# comparisons of overlapping() accept is lost to rounding
+SLACK = 1.0
+
+
+def pairs_in_window(ax, ay, bx, by, x_lo, x_hi, y_lo, y_hi):
+    # the (a, b) index pairs with about ax + x_lo < bx < ax + x_hi and
+    # ay + y_lo < by < ay + y_hi, found with a sort and sweep on x. The
+    # window is SLACK wider on every side: a broadphase for overlapping()
+    x_lo, y_lo = x_lo - SLACK, y_lo - SLACK
+    x_hi, y_hi = x_hi + SLACK, y_hi + SLACK
+    order = np.argsort(bx, kind='stable')
+    sorted_bx = bx[order]
+    lo = np.searchsorted(sorted_bx, ax + x_lo, 'right')
+    hi = np.searchsorted(sorted_bx, ax + x_hi, 'left')
+    counts = np.maximum(hi - lo, 0)
+
+    rows = np.repeat(np.arange(len(ax)), counts)
+    offsets = np.repeat(lo - np.cumsum(counts) + counts, counts)
+    cols = order[np.arange(len(rows)) + offsets]
+
+    dy = by[cols] - ay[rows]
+    keep = (dy > y_lo) & (dy < y_hi)
+    return rows[keep], cols[keep]
+
+
+def overlapping(rows, cols, ax, ay, a_width, a_height, bx, by, b_width, b_height):
+    # the pairs of rows and cols whose boxes overlap, compared exactly as
+    # GameServer.players_overlap and bullet_hits do
+    ax, ay, bx, by = ax[rows], ay[rows], bx[cols], by[cols]
+    keep = (ax < bx + b_width) & (ax + a_width > bx) & (ay < by + b_height) & (ay + a_height > by)
+    return rows[keep], cols[keep]
+
+
+class NumpyEngine:
+    # struct-of-arrays version of GameServer.step(). Bullets live only in
+    # the arrays below; players are gathered from the Player objects once
+    # per tick (handle_client keeps writing their speeds) and written back
+    # afterwards. The result is the same state the per-object loop gives.
+    def __init__(self, server):
+        self.server = server
+
+        self.bullet_id = np.empty(0, dtype=np.int64)
+        self.bullet_owner = np.empty(0, dtype=np.int64)
+        self.bullet_x = np.empty(0)
+        self.bullet_y = np.empty(0)
+        self.bullet_speed_x = np.empty(0)
+        self.bullet_speed_y = np.empty(0)
+        self.bullet_rewind = np.empty(0, dtype=np.int64)
+
+        # bullets fired since the last tick, as Bullet objects
+        self.pending = []
+
+    def bullet_count(self):
+        return len(self.bullet_id) + len(self.pending)
+
+    def spawn_bullet(self, bullet):
+        self.pending.append(bullet)
+
+    def absorb_pending(self):
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        self.bullet_id = np.concatenate((self.bullet_id, [bullet.id for bullet in pending]))
+        self.bullet_owner = np.concatenate((self.bullet_owner, [bullet.player_id for bullet in pending]))
+        self.bullet_x = np.concatenate((self.bullet_x, [bullet.x for bullet in pending]))
+        self.bullet_y = np.concatenate((self.bullet_y, [bullet.y for bullet in pending]))
+        self.bullet_speed_x = np.concatenate((self.bullet_speed_x, [bullet.speed_x for bullet in pending]))
+        self.bullet_speed_y = np.concatenate((self.bullet_speed_y, [bullet.speed_y for bullet in pending]))
+        self.bullet_rewind = np.concatenate((self.bullet_rewind, [bullet.rewind for bullet in pending]))
+
+    def move_players(self, x, y, speed_x, speed_y):
+        server = self.server
+        x = x + speed_x * server.step_scale
+        y = y + speed_y * server.step_scale
+
+        # prevent player from going off screen
+        max_x = server.game_field_width - server.player_width
+        max_y = server.game_field_height - server.player_height
+        out_x = (x < 0) | (x > max_x)
+        out_y = (y < 0) | (y > max_y)
+        x = np.clip(x, 0, max_x)
+        y = np.clip(y, 0, max_y)
+        speed_x = np.where(out_x, 0.0, speed_x)
+        speed_y = np.where(out_y, 0.0, speed_y)
+
+        # add friction
+        friction = server.acceleration * 0.5 * server.step_scale
+        speed_x = np.where(speed_x > 0, speed_x - friction, np.where(speed_x < 0, speed_x + friction, speed_x))
+        speed_y = np.where(speed_y > 0, speed_y - friction, np.where(speed_y < 0, speed_y + friction, speed_y))
+
+        return x, y, speed_x, speed_y
+
+    def knockback_rows(self, rows, old_x, old_y, x, y):
+        # the per-object loop checks a player against the players before it
+        # at their final positions and the ones after it at their positions
+        # from the start of the tick. cur_x/cur_y hold exactly that view.
+        server = self.server
+        width = server.player_width
+        height = server.player_height
+        cur_x = old_x.copy()
+        cur_y = old_y.copy()
+        done = 0
+        for i in rows:
+            cur_x[done:i] = x[done:i]
+            cur_y[done:i] = y[done:i]
+            done = i
+
+            px = float(x[i])
+            py = float(y[i])
+            checked = -1
+            while True:
+                hit = (px < cur_x + width) & (px + width > cur_x) & (py < cur_y + height) & (py + height > cur_y)
+                hit[:checked + 1] = False
+                hit[i] = False
+                candidates = np.flatnonzero(hit)
+                if not len(candidates):
+                    break
+                checked = candidates[0]
+                if px < cur_x[checked]:
+                    px -= 10
+                else:
+                    px += 10
+                if py < cur_y[checked]:
+                    py -= 10
+                else:
+                    py += 10
+            x[i] = px
+            y[i] = py
+
+    def collide_players(self, old_x, old_y, x, y):
+        # only players that overlap someone's old or new position can be
+        # knocked back, so only those are resolved in order. A knockback can
+        # push a player into one that looked quiet; those join the active
+        # set and the pass is redone until no quiet player is touched.
+        server = self.server
+        wx = server.player_width
+        wy = server.player_height
+        rows_new, cols_new = overlapping(*pairs_in_window(x, y, x, y, -wx, wx, -wy, wy), x, y, wx, wy, x, y, wx, wy)
+        rows_old, cols_old = overlapping(*pairs_in_window(x, y, old_x, old_y, -wx, wx, -wy, wy),
+                                         x, y, wx, wy, old_x, old_y, wx, wy)
+        active = np.unique(np.concatenate((rows_new[rows_new != cols_new], rows_old[rows_old != cols_old])))
+
+        while True:
+            final_x = x.copy()
+            final_y = y.copy()
+            if not len(active):
+                return final_x, final_y
+            self.knockback_rows(active.tolist(), old_x, old_y, final_x, final_y)
+
+            moved = active[(final_x[active] != x[active]) | (final_y[active] != y[active])]
+            moved_x, moved_y = final_x[moved], final_y[moved]
+            rows, cols = overlapping(*pairs_in_window(x, y, moved_x, moved_y, -wx, wx, -wy, wy),
+                                     x, y, wx, wy, moved_x, moved_y, wx, wy)
+            touched = np.setdiff1d(rows[rows != moved[cols]], active)
+            if not len(touched):
+                return final_x, final_y
+            active = np.union1d(active, touched)
+
+    def rewound_positions(self, ids, x, y, rewind):
+        # where the players were at the end of the tick rewind ticks ago,
+        # their current position if they were not there
+        positions = self.server.history.at(self.server.ticks - rewind)
+        if positions is None:
+            return x, y
+        rewound_x = x.copy()
+        rewound_y = y.copy()
+        for i, p_id in enumerate(ids.tolist()):
+            position = positions.get(p_id)
+            if position is not None:
+                rewound_x[i], rewound_y[i] = position
+        return rewound_x, rewound_y
+
+    def bullet_pairs(self, ids, x, y):
+        # (player, bullet) index pairs that overlap, each bullet tested
+        # against the players where its lag compensation puts them
+        server = self.server
+        size = server.bullet_size
+        window = (-size, server.player_width, -size, server.player_height)
+        boxes = (server.player_width, server.player_height)
+        if server.history is None or not self.bullet_rewind.any():
+            return overlapping(*pairs_in_window(x, y, self.bullet_x, self.bullet_y, *window),
+                               x, y, *boxes, self.bullet_x, self.bullet_y, size, size)
+
+        all_rows, all_cols = [], []
+        for rewind in np.unique(self.bullet_rewind).tolist():
+            picked = np.flatnonzero(self.bullet_rewind == rewind)
+            px, py = (x, y) if rewind == 0 else self.rewound_positions(ids, x, y, rewind)
+            bx, by = self.bullet_x[picked], self.bullet_y[picked]
+            rows, cols = overlapping(*pairs_in_window(px, py, bx, by, *window), px, py, *boxes, bx, by, size, size)
+            all_rows.append(rows)
+            all_cols.append(picked[cols])
+        return np.concatenate(all_rows), np.concatenate(all_cols)
+
+    def collide_bullets(self, ids, x, y, hit_points):
+        # players take bullets in list order and stop once they are dead,
+        # so the candidate pairs are sorted and resolved one by one
+        consumed = np.zeros(len(self.bullet_id), dtype=bool)
+        if not len(self.bullet_id) or not len(ids):
+            return consumed
+
+        rows, cols = self.bullet_pairs(ids, x, y)
+        own = self.bullet_owner[cols] == ids[rows]
+        rows = rows[~own]
+        cols = cols[~own]
+        order = np.lexsort((cols, rows))
+
+        for i, b in zip(rows[order].tolist(), cols[order].tolist()):
+            if consumed[b] or hit_points[i] <= 0:
+                continue
+            consumed[b] = True
+            hit_points[i] -= 1
+        return consumed
+
+    def step(self):
+        server = self.server
+        players = server.players
+        start = time.perf_counter()
+        self.absorb_pending()
+
+        ids = np.array([player.id for player in players], dtype=np.int64)
+        old_x = np.array([player.x for player in players], dtype=float)
+        old_y = np.array([player.y for player in players], dtype=float)
+        speed_x = np.array([player.speed_x for player in players], dtype=float)
+        speed_y = np.array([player.speed_y for player in players], dtype=float)
+        hit_points = [player.hit_points for player in players]
+
+        x, y, speed_x, speed_y = self.move_players(old_x, old_y, speed_x, speed_y)
+        moved = time.perf_counter()
+        x, y = self.collide_players(old_x, old_y, x, y)
+        consumed = self.collide_bullets(ids, x, y, hit_points)
+        collided = time.perf_counter()
+
+        for player, px, py, sx, sy, hp in zip(players, x.tolist(), y.tolist(), speed_x.tolist(), speed_y.tolist(), hit_points):
+            player.x = px
+            player.y = py
+            player.speed_x = sx
+            player.speed_y = sy
+            player.hit_points = hp
+        server.remove_dead_players()
+
+        bullet_x = self.bullet_x + self.bullet_speed_x * server.step_scale
+        bullet_y = self.bullet_y + self.bullet_speed_y * server.step_scale
+
+        # remove hit bullets and bullets that went off screen
+        keep = (~consumed & (bullet_x >= 0) & (bullet_x <= server.game_field_width) &
+                (bullet_y >= 0) & (bullet_y <= server.game_field_height))
+        for b_id in self.bullet_id[~keep].tolist():
+            server.bullet_ids.release(b_id)
+        self.bullet_id = self.bullet_id[keep]
+        self.bullet_owner = self.bullet_owner[keep]
+        self.bullet_x = bullet_x[keep]
+        self.bullet_y = bullet_y[keep]
+        self.bullet_speed_x = self.bullet_speed_x[keep]
+        self.bullet_speed_y = self.bullet_speed_y[keep]
+        self.bullet_rewind = self.bullet_rewind[keep]
+
+        server.phase_times['physics'] = moved - start + time.perf_counter() - collided
+        server.phase_times['collisions'] = collided - moved
+
+    def encode_bullets(self):
+        # slot indices, like GameServer.encode_state
+        return ''.join(f'{b_id},{owner},{x},{y},' for b_id, owner, x, y in zip(
+            (self.bullet_id & INDEX_MASK).tolist(), (self.bullet_owner & INDEX_MASK).tolist(),
+            self.bullet_x.tolist(), self.bullet_y.tolist()))
+
+    def bullet_states(self):
+        # (id, owner id, x, y, speed x, speed y, rewind) of every bullet, in order
+        states = list(zip(self.bullet_id.tolist(), self.bullet_owner.tolist(), self.bullet_x.tolist(),
+                          self.bullet_y.tolist(), self.bullet_speed_x.tolist(), self.bullet_speed_y.tolist(),
+                          self.bullet_rewind.tolist()))
+        return states + [(b.id, b.player_id, b.x, b.y, b.speed_x, b.speed_y, b.rewind) for b in self.pending]
+
+    def bullet_snapshot(self):
+        x = np.clip(np.round(self.bullet_x * protocol.COORD_SCALE), -32768, 32767).astype(np.int64)
+        y = np.clip(np.round(self.bullet_y * protocol.COORD_SCALE), -32768, 32767).astype(np.int64)
+        return dict(zip(self.bullet_id.tolist(), zip(self.bullet_owner.tolist(), x.tolist(), y.tolist())))
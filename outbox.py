@@ -0,0 +1,102 @@
+import asyncio
+import collections
+import logging
+
+
+class Outbox:
+    # Per connection send queue, drained by its own writer task so the game
+    # loop only ever hands frames over and never waits on a socket.
+    #
+    # Control frames (handshake) are queued and always delivered in order.
+    # Of the states only the newest one is kept: if the socket is still busy
+    # when the next state comes, the older one is dropped. After max_backlog
+    # states in a row were dropped the client is considered dead and closed.
+    #
+    # With compression (compression.py) everything written after the point
+    # start_compression() was called goes through the connection's
+    # compressor; bytes_sent counts what went on the wire.
+    def __init__(self, writer, max_backlog=40, on_close=None):
+        self.writer = writer
+        self.max_backlog = max_backlog
+        self.on_close = on_close
+
+        self.control = collections.deque()
+        self.state = None
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.task = None
+        # a compression.StreamCompressor once compression has started
+        self.compressor = None
+
+        self.backlog = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def depth(self):
+        return len(self.control) + (self.state is not None)
+
+    def send_control(self, data):
+        if self.closed:
+            return
+        self.control.append(data)
+        self.wakeup.set()
+
+    def send_state(self, data):
+        if self.closed:
+            return
+        if self.state is not None:
+            self.dropped += 1
+            self.backlog += 1
+            if self.backlog > self.max_backlog:
+                logging.error(f'Dropping client after {self.backlog} undelivered states')
+                self.close()
+                return
+        self.state = data
+        self.wakeup.set()
+
+    def start_compression(self, compressor):
+        # queued as a control entry, so what is queued before is not
+        # compressed and everything after is
+        self.control.append(compressor)
+        self.wakeup.set()
+
+    def discard_state(self):
+        self.state = None
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.close()
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+        if self.on_close is not None:
+            self.on_close()
+
+    async def run(self):
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.control or self.state is not None:
+                    if self.control:
+                        data = self.control.popleft()
+                        if not isinstance(data, bytes):
+                            self.compressor = data
+                            continue
+                    else:
+                        data = self.state
+                        self.state = None
+                        self.backlog = 0
+                    if self.compressor is not None:
+                        data = self.compressor.compress(data)
+                    self.writer.write(data)
+                    await self.writer.drain()
+                    self.bytes_sent += len(data)
+                    self.frames_sent += 1
+        except (ConnectionError, OSError):
+            self.close()
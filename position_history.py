@@ -0,0 +1,70 @@
+# Where every player was at the end of each of the last few ticks, for lag
+# compensated hits: a bullet is tested against its targets as they were
+# when its shooter saw them, not where they are now.
+#
+# A ring buffer of `length` slots, one per tick, each a dict of id ->
+# (x, y). Memory is length times the players, recording a tick is one pass
+# over the players and a lookup is a slot index and a dict get, so the cost
+# grows with the players but not with how long the game runs.
+
+
+class PositionHistory:
+    def __init__(self, length):
+        self.length = length
+        self.ticks = [None] * length
+        self.positions = [None] * length
+
+    def record(self, tick, players):
+        slot = tick % self.length
+        self.ticks[slot] = tick
+        self.positions[slot] = {player.id: (player.x, player.y) for player in players}
+
+    def at(self, tick):
+        # id -> (x, y) at the end of tick, None once it has been overwritten
+        slot = tick % self.length
+        if self.ticks[slot] != tick:
+            return None
+        return self.positions[slot]
+
+    def position(self, p_id, tick, x, y):
+        # where p_id was at the end of tick, or (x, y) if it was not there
+        positions = self.at(tick)
+        if positions is None:
+            return x, y
+        return positions.get(p_id, (x, y))
+
+    def extent(self, p_id, first_tick, last_tick, x, y):
+        # (min x, min y, max x, max y) of (x, y) and of where p_id was at
+        # the end of the ticks first_tick..last_tick
+        min_x = max_x = x
+        min_y = max_y = y
+        for tick in range(first_tick, last_tick + 1):
+            positions = self.at(tick)
+            if positions is None:
+                continue
+            position = positions.get(p_id)
+            if position is None:
+                continue
+            px, py = position
+            if px < min_x:
+                min_x = px
+            elif px > max_x:
+                max_x = px
+            if py < min_y:
+                min_y = py
+            elif py > max_y:
+                max_y = py
+        return min_x, min_y, max_x, max_y
+
+    def state(self):
+        # (tick, [(id, x, y)]) of every tick still held, oldest first
+        held = sorted((tick, slot) for slot, tick in enumerate(self.ticks) if tick is not None)
+        return [(tick, [(p_id, x, y) for p_id, (x, y) in self.positions[slot].items()]) for tick, slot in held]
+
+    def load_state(self, state):
+        self.ticks = [None] * self.length
+        self.positions = [None] * self.length
+        for tick, positions in state:
+            slot = tick % self.length
+            self.ticks[slot] = tick
+            self.positions[slot] = {p_id: (x, y) for p_id, x, y in positions}
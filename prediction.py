@@ -0,0 +1,142 @@
+import collections
+import math
+import threading
+
+
+class ShipPredictor:
+    # Client side prediction of the own ship. The held keys are applied
+    # locally as they change and the ship is stepped with the server's
+    # rules (apply_held_inputs, move_player) at the server's tick rate, so
+    # it reacts to the keys at once instead of a round trip later.
+    #
+    # When an authoritative position arrives it is compared with what was
+    # predicted `latency` seconds ago: the time from sending an input to
+    # seeing it acked, which observe_latency() keeps up to date.
+    # The difference is added to the simulation at once and to a visual
+    # offset that decays over `smoothing` seconds, so small corrections are
+    # not seen as jumps; corrections over snap_distance are shown at once.
+    def __init__(self, tick_rate=20, latency=0.05, field=(800, 800), ship=(50, 50), acceleration=0.1,
+                 input_interval=0.2, speed_interval=0.05, smoothing=0.1, snap_distance=60, history=1.0):
+        self.tick_interval = 1 / tick_rate
+        self.latency = latency
+        self.input_scale = self.tick_interval / input_interval
+        self.step_scale = self.tick_interval / speed_interval
+        self.field_width, self.field_height = field
+        self.ship_width, self.ship_height = ship
+        self.acceleration = acceleration
+        self.smoothing = smoothing
+        self.snap_distance = snap_distance
+        self.history_length = history
+        self.lock = threading.Lock()
+
+        # None until the first authoritative position
+        self.x = self.y = None
+        self.speed_x = self.speed_y = 0
+        self.move_x = self.move_y = 0
+        self.next_tick = None
+        # (tick time, x, y) after every predicted step
+        self.history = collections.deque()
+        # shown position minus simulated position, decays to zero
+        self.offset_x = self.offset_y = 0.0
+        self.last_render = None
+
+    def move(self):
+        # GameServer.apply_held_inputs and move_player, step for step
+        self.speed_x += self.move_x * self.input_scale
+        self.speed_y += self.move_y * self.input_scale
+
+        self.x += self.speed_x * self.step_scale
+        self.y += self.speed_y * self.step_scale
+
+        if self.x < 0:
+            self.x = 0
+            self.speed_x = 0
+        elif self.x > self.field_width - self.ship_width:
+            self.x = self.field_width - self.ship_width
+            self.speed_x = 0
+        if self.y < 0:
+            self.y = 0
+            self.speed_y = 0
+        elif self.y > self.field_height - self.ship_height:
+            self.y = self.field_height - self.ship_height
+            self.speed_y = 0
+
+        friction = self.acceleration * 0.5 * self.step_scale
+        if self.speed_x > 0:
+            self.speed_x -= friction
+        elif self.speed_x < 0:
+            self.speed_x += friction
+        if self.speed_y > 0:
+            self.speed_y -= friction
+        elif self.speed_y < 0:
+            self.speed_y += friction
+
+    def apply_input(self, move_x, move_y):
+        # the keys held from now on, like GameServer.apply_input
+        with self.lock:
+            self.move_x = move_x
+            self.move_y = move_y
+
+    def observe_latency(self, seconds):
+        with self.lock:
+            self.latency += (seconds - self.latency) * 0.2
+
+    def advance(self, now):
+        with self.lock:
+            if self.x is None:
+                return
+            # after a long stall (a dragged window) start over from now
+            if now - self.next_tick > self.history_length:
+                self.next_tick = now
+            while now >= self.next_tick:
+                self.move()
+                self.history.append((self.next_tick, self.x, self.y))
+                self.next_tick += self.tick_interval
+            while self.history and self.history[0][0] < now - self.history_length:
+                self.history.popleft()
+
+    def predicted_at(self, when):
+        # the predicted position of the last step before `when`
+        for tick_time, x, y in reversed(self.history):
+            if tick_time <= when:
+                return x, y
+        return self.history[0][1:] if self.history else (self.x, self.y)
+
+    def reconcile(self, now, x, y):
+        with self.lock:
+            if self.x is None:
+                self.x, self.y = x, y
+                self.next_tick = now + self.tick_interval
+                return
+            predicted_x, predicted_y = self.predicted_at(now - self.latency)
+            error_x, error_y = x - predicted_x, y - predicted_y
+            if error_x == 0 and error_y == 0:
+                return
+
+            self.x += error_x
+            self.y += error_y
+            self.history = collections.deque((t, hx + error_x, hy + error_y) for t, hx, hy in self.history)
+            if math.hypot(error_x, error_y) < self.snap_distance:
+                self.offset_x -= error_x
+                self.offset_y -= error_y
+            else:
+                self.offset_x = self.offset_y = 0.0
+
+    def position(self, now):
+        # where to draw the ship: the last step carried on at its speed for
+        # the part of the tick that has passed, plus the decaying offset
+        with self.lock:
+            if self.x is None:
+                return None
+            if self.last_render is not None and self.smoothing > 0:
+                decay = math.exp(-(now - self.last_render) / self.smoothing)
+                self.offset_x *= decay
+                self.offset_y *= decay
+            self.last_render = now
+
+            ahead = 1 - (self.next_tick - now) / self.tick_interval
+            ahead = min(max(ahead, 0.0), 1.0)
+            step = self.step_scale * ahead
+            x = min(max(self.x + self.speed_x * step, 0), self.field_width - self.ship_width)
+            y = min(max(self.y + self.speed_y * step, 0), self.field_height - self.ship_height)
+            return x + self.offset_x, y + self.offset_y
@@ -0,0 +1,298 @@
+import asyncio
+import struct
+
+# Binary wire protocol. A connection always starts with the text greeting
+# "id:<id>:<ADVERT>\n"; old clients only read the id and keep talking text.
+# A client that wants binary frames answers "proto:<ADVERT>\n", the server
+# echoes that line and from then on both sides exchange frames of
+#
+#   u32 payload length, u8 frame type, payload
+#
+# Coordinates are sent as int16 in 1/COORD_SCALE pixel steps, ids as the
+# full u32 generational ids of entity_ids.py.
+#
+# Every state carries a sequence number which the client acknowledges.
+# The server then sends only what changed since the newest state the
+# client has acknowledged (DELTA), or the whole world (KEYFRAME) when it
+# has no usable baseline.
+#
+# A snapshot is a pair of dicts of quantized records:
+#   players: id -> (x, y, hit points)
+#   bullets: id -> (owner id, x, y)
+#
+# Clients send the keys they hold when they change, and again as a
+# keepalive. An INPUT frame carries one or more inputs, each with a
+# sequence number and the client's clock in ms; the server answers with
+# INPUT_ACK holding the newest input it has applied and that input's
+# client time, so the client can tell its input to ack latency.
+#
+# A spectator relay subscribes on the server's watch port instead: no
+# greeting and no ship, only a HELLO with WATCHER_ID and then the states
+# of the whole world, which it acks like a client. Relays and replays greet
+# the game clients watching through them with accept_watcher().
+
+VERSION = 4
+ADVERT = f'bin{VERSION}'
+UPGRADE = f'proto:{ADVERT}\n'.encode()
+
+HELLO = 1
+KEYFRAME = 2
+INPUT = 3
+DELTA = 4
+ACK = 5
+INPUT_ACK = 6
+
+COORD_SCALE = 4
+# the largest coordinate an int16 record holds; a field must fit in it, or
+# ships beyond it would be sent, and filtered by area of interest, as if
+# they stood on its edge
+MAX_COORD = 32767 // COORD_SCALE
+
+# the id a watching client is given, no ship ever has it
+WATCHER_ID = 0xFFFFFFFF
+
+FRAME_HEADER = struct.Struct('<IB')
+HELLO_BODY = struct.Struct('<BI')                # version, player id
+KEYFRAME_HEADER = struct.Struct('<IHH')          # seq, players, bullets
+DELTA_HEADER = struct.Struct('<IIHHHH')          # seq, baseline seq, changed / removed players, changed / removed bullets
+PLAYER_RECORD = struct.Struct('<IhhB')           # id, x, y, hit points
+BULLET_RECORD = struct.Struct('<IIhh')           # id, owner id, x, y
+CHANGE_HEADER = struct.Struct('<IB')             # id, mask of the fields that follow
+ENTITY_ID = struct.Struct('<I')
+INPUT_COUNT = struct.Struct('<B')                # inputs in the frame
+INPUT_RECORD = struct.Struct('<IIbbB')           # input seq, client ms, move x, move y, fire
+ACK_BODY = struct.Struct('<I')                   # seq
+INPUT_ACK_BODY = struct.Struct('<II')            # input seq, client ms of that input
+
+# field formats of the records in a snapshot, in record order
+PLAYER_FIELDS = 'hhB'
+BULLET_FIELDS = 'Ihh'
+
+
+def quantize(value):
+    value = round(value * COORD_SCALE)
+    if value > 32767:
+        return 32767
+    if value < -32768:
+        return -32768
+    return value
+
+
+def player_record(x, y, hit_points):
+    return (quantize(x), quantize(y), max(0, min(hit_points, 255)))
+
+
+def bullet_record(owner, x, y):
+    return (owner, quantize(x), quantize(y))
+
+
+def snapshot_tuples(snapshot):
+    # the (id, x, y, hp) / (id, owner, x, y) lists the text protocol decodes to
+    players, bullets = snapshot
+    return ([(p_id, x / COORD_SCALE, y / COORD_SCALE, hp) for p_id, (x, y, hp) in players.items()],
+            [(b_id, owner, x / COORD_SCALE, y / COORD_SCALE) for b_id, (owner, x, y) in bullets.items()])
+
+
+def frame(frame_type, payload):
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+
+def encode_hello(player_id):
+    return frame(HELLO, HELLO_BODY.pack(VERSION, player_id))
+
+
+def decode_hello(payload):
+    version, player_id = HELLO_BODY.unpack(payload)
+    if version != VERSION:
+        raise ValueError(f'unsupported protocol version {version}')
+    return player_id
+
+
+def encode_keyframe(seq, snapshot):
+    players, bullets = snapshot
+    return frame(KEYFRAME, KEYFRAME_HEADER.pack(seq, len(players), len(bullets)) +
+                 b''.join(PLAYER_RECORD.pack(p_id, *record) for p_id, record in players.items()) +
+                 b''.join(BULLET_RECORD.pack(b_id, *record) for b_id, record in bullets.items()))
+
+
+def decode_keyframe(payload):
+    seq, player_count, bullet_count = KEYFRAME_HEADER.unpack_from(payload)
+    start = KEYFRAME_HEADER.size
+    end = start + player_count * PLAYER_RECORD.size
+    players = {p_id: (x, y, hp) for p_id, x, y, hp in PLAYER_RECORD.iter_unpack(payload[start:end])}
+    bullets = {b_id: (owner, x, y)
+               for b_id, owner, x, y in BULLET_RECORD.iter_unpack(payload[end:end + bullet_count * BULLET_RECORD.size])}
+    return seq, (players, bullets)
+
+
+# struct for every combination of changed fields, per record layout
+change_structs = {}
+
+
+def change_struct(fields, mask):
+    key = (fields, mask)
+    packer = change_structs.get(key)
+    if packer is None:
+        packer = struct.Struct('<' + ''.join(f for bit, f in enumerate(fields) if mask & (1 << bit)))
+        change_structs[key] = packer
+    return packer
+
+
+# the same with the change header in front, and which record fields it takes
+change_packers = {}
+
+
+def change_packer(fields, mask):
+    key = (fields, mask)
+    packer = change_packers.get(key)
+    if packer is None:
+        packer = (struct.Struct(CHANGE_HEADER.format + change_struct(fields, mask).format[1:]),
+                  [bit for bit in range(len(fields)) if mask & (1 << bit)])
+        change_packers[key] = packer
+    return packer
+
+
+def encode_changes(base, current, fields):
+    # records that are new or differ from the baseline, each with only the
+    # fields that changed, and the ids that are gone
+    changes = [encode_change(e_id, base.get(e_id), record, fields)
+               for e_id, record in current.items() if base.get(e_id) != record]
+    removed = [ENTITY_ID.pack(e_id) for e_id in base if e_id not in current]
+    return len(changes), b''.join(changes), len(removed), b''.join(removed)
+
+
+def encode_change(e_id, old, record, fields):
+    # one record with the fields that differ from old, all of them when
+    # old is None
+    if old is None:
+        mask = (1 << len(fields)) - 1
+    else:
+        mask = 0
+        for bit in range(len(fields)):
+            if old[bit] != record[bit]:
+                mask |= 1 << bit
+    packer, picked = change_packer(fields, mask)
+    return packer.pack(e_id, mask, *[record[bit] for bit in picked])
+
+
+def decode_changes(base, payload, offset, changed, removed, fields):
+    records = dict(base)
+    for _ in range(changed):
+        e_id, mask = CHANGE_HEADER.unpack_from(payload, offset)
+        offset += CHANGE_HEADER.size
+        packer = change_struct(fields, mask)
+        values = iter(packer.unpack_from(payload, offset))
+        offset += packer.size
+        old = records.get(e_id, (0,) * len(fields))
+        records[e_id] = tuple(next(values) if mask & (1 << bit) else old[bit] for bit in range(len(fields)))
+    for _ in range(removed):
+        records.pop(ENTITY_ID.unpack_from(payload, offset)[0], None)
+        offset += ENTITY_ID.size
+    return records, offset
+
+
+def encode_delta(seq, base_seq, base, current):
+    return delta_frame(seq, base_seq, encode_changes(base[0], current[0], PLAYER_FIELDS),
+                       encode_changes(base[1], current[1], BULLET_FIELDS))
+
+
+def delta_frame(seq, base_seq, players, bullets):
+    # players, bullets: the changes of each as encode_changes returns them
+    player_changes, player_body, player_removed, player_removed_body = players
+    bullet_changes, bullet_body, bullet_removed, bullet_removed_body = bullets
+    header = DELTA_HEADER.pack(seq, base_seq, player_changes, player_removed, bullet_changes, bullet_removed)
+    return frame(DELTA, header + player_body + player_removed_body + bullet_body + bullet_removed_body)
+
+
+def delta_baseline(payload):
+    return DELTA_HEADER.unpack_from(payload)[1]
+
+
+def decode_delta(base, payload):
+    seq, base_seq, player_changes, player_removed, bullet_changes, bullet_removed = DELTA_HEADER.unpack_from(payload)
+    offset = DELTA_HEADER.size
+    players, offset = decode_changes(base[0], payload, offset, player_changes, player_removed, PLAYER_FIELDS)
+    bullets, offset = decode_changes(base[1], payload, offset, bullet_changes, bullet_removed, BULLET_FIELDS)
+    return seq, (players, bullets)
+
+
+def encode_input(inputs):
+    # inputs: (seq, client ms, move x, move y, fire) tuples, at most 255
+    return frame(INPUT, INPUT_COUNT.pack(len(inputs)) +
+                 b''.join(INPUT_RECORD.pack(seq, client_ms & 0xFFFFFFFF, move_x, move_y, 1 if fire else 0)
+                          for seq, client_ms, move_x, move_y, fire in inputs))
+
+
+def decode_input(payload):
+    count = INPUT_COUNT.unpack_from(payload)[0]
+    end = INPUT_COUNT.size + count * INPUT_RECORD.size
+    if len(payload) != end:
+        raise struct.error(f'{count} inputs in {len(payload)} bytes')
+    return [(seq, client_ms, move_x, move_y, fire == 1)
+            for seq, client_ms, move_x, move_y, fire in INPUT_RECORD.iter_unpack(payload[INPUT_COUNT.size:end])]
+
+
+def encode_input_ack(seq, client_ms):
+    return frame(INPUT_ACK, INPUT_ACK_BODY.pack(seq, client_ms))
+
+
+def decode_input_ack(payload):
+    return INPUT_ACK_BODY.unpack(payload)
+
+
+def encode_ack(seq):
+    return frame(ACK, ACK_BODY.pack(seq))
+
+
+def decode_ack(payload):
+    return ACK_BODY.unpack(payload)[0]
+
+
+async def read_frame(reader, max_length=None):
+    # a frame longer than max_length raises ValueError, the stream cannot
+    # be read any further after that
+    header = await reader.readexactly(FRAME_HEADER.size)
+    length, frame_type = FRAME_HEADER.unpack(header)
+    if max_length is not None and length > max_length:
+        raise ValueError(f'frame of {length} bytes')
+    payload = await reader.readexactly(length)
+    return frame_type, payload
+
+
+async def accept_watcher(reader, writer, greeting_id, timeout=1.0):
+    # the server side of the handshake with a client that only watches;
+    # returns whether it switched to binary frames
+    writer.write(f'id:{greeting_id}:{ADVERT}\n'.encode())
+    await writer.drain()
+    try:
+        first = await asyncio.wait_for(reader.readline(), timeout)
+    except asyncio.TimeoutError:
+        first = b''
+    if first != UPGRADE:
+        return False
+    writer.write(UPGRADE + encode_hello(WATCHER_ID))
+    return True
+
+
+class SnapshotReceiver:
+    # client side of the delta scheme: rebuilds full snapshots and keeps the
+    # recent ones, since the server may base a delta on any acked state
+    def __init__(self, keep=64):
+        self.keep = keep
+        self.snapshots = {}
+
+    def receive(self, frame_type, payload):
+        if frame_type == KEYFRAME:
+            seq, snapshot = decode_keyframe(payload)
+        elif frame_type == DELTA:
+            base = self.snapshots.get(delta_baseline(payload))
+            if base is None:
+                return None
+            seq, snapshot = decode_delta(base, payload)
+        else:
+            return None
+
+        self.snapshots[seq] = snapshot
+        for old_seq in [s for s in self.snapshots if s <= seq - self.keep]:
+            del self.snapshots[old_seq]
+        return seq, snapshot
@@ -0,0 +1,340 @@
+import bisect
+import mmap
+import struct
+
+import protocol
+
+# Replay log of a game: what the world looked like after every tick and
+# what changed it. The file is a header followed by frames in the framing
+# of protocol.py (u32 payload length, u8 frame type, payload):
+#
+#   EVENTS    joins, leaves, inputs and lag compensation changes applied
+#             at the start of a tick, only for ticks that had any
+#   KEYFRAME  the quantized snapshot after the tick (protocol.py), seq is
+#             the tick number; first frame of every chunk
+#   SIMSTATE  the exact simulation state after that tick, right after the
+#             keyframe, so a server can be restored and stepped from it
+#   DELTA     the quantized snapshot after a tick against the tick before
+#
+# Ticks are grouped in chunks of chunk_ticks. The INDEX frame written on
+# close lists the first tick and file offset of every chunk, and the
+# trailer at the very end points at it. A log that was never closed (a
+# crashed server) has no index; the reader rebuilds it with one pass.
+
+MAGIC = b'SBRP'
+INDEX_MAGIC = b'SBIX'
+VERSION = 2
+
+EVENTS = 16
+SIMSTATE = 17
+INDEX = 18
+
+HEADER = struct.Struct('<4sBHddHHH')         # magic, version, chunk ticks, tick rate, fire interval, field size,
+                                             # rewind window in ticks
+TRAILER = struct.Struct('<Q4s')              # offset of the INDEX frame, magic
+INDEX_HEADER = struct.Struct('<II')          # chunks, last tick
+INDEX_ENTRY = struct.Struct('<IQ')           # first tick of the chunk, offset
+
+EVENTS_HEADER = struct.Struct('<IH')         # tick, events
+EVENT_KIND = struct.Struct('<B')
+JOIN_RECORD = struct.Struct('<Iddi')         # player id, x, y, hit points
+LEAVE_RECORD = struct.Struct('<I')           # player id
+INPUT_RECORD = struct.Struct('<IIddB')       # player id, input seq, move x, move y, 1 fire held | 2 fire pressed
+REWIND_RECORD = struct.Struct('<IH')         # player id, rewind ticks
+
+SIM_HEADER = struct.Struct('<III')           # tick, players, bullets
+SIM_PLAYER = struct.Struct('<Iddddiddd??H')  # id, x, y, speed x, y, hit points, move x, y, fire cooldown, fire,
+                                             # fire pressed, rewind ticks
+SIM_BULLET = struct.Struct('<IIddddH')       # id, owner id, x, y, speed x, y, rewind
+ALLOCATOR_HEADER = struct.Struct('<II')      # slots, free slots
+HISTORY_HEADER = struct.Struct('<H')         # ticks of position history
+HISTORY_TICK = struct.Struct('<IH')          # tick, players
+HISTORY_RECORD = struct.Struct('<Idd')       # player id, x, y
+
+JOIN = 1
+LEAVE = 2
+INPUT = 3
+REWIND = 4
+
+# input seq of text clients, which do not number their inputs
+NO_SEQ = 0xFFFFFFFF
+
+
+def encode_events(tick, events):
+    # events: ('join', id, x, y, hp), ('leave', id),
+    # ('input', id, seq or None, move x, move y, fire, pressed) and
+    # ('rewind', id, ticks) in order
+    body = []
+    for event in events:
+        kind = event[0]
+        if kind == 'join':
+            body.append(EVENT_KIND.pack(JOIN) + JOIN_RECORD.pack(*event[1:]))
+        elif kind == 'leave':
+            body.append(EVENT_KIND.pack(LEAVE) + LEAVE_RECORD.pack(*event[1:]))
+        elif kind == 'rewind':
+            body.append(EVENT_KIND.pack(REWIND) + REWIND_RECORD.pack(*event[1:]))
+        else:
+            p_id, seq, move_x, move_y, fire, pressed = event[1:]
+            flags = (1 if fire else 0) | (2 if pressed else 0)
+            body.append(EVENT_KIND.pack(INPUT) +
+                        INPUT_RECORD.pack(p_id, NO_SEQ if seq is None else seq, move_x, move_y, flags))
+    return protocol.frame(EVENTS, EVENTS_HEADER.pack(tick, len(events)) + b''.join(body))
+
+
+def decode_events(payload):
+    tick, count = EVENTS_HEADER.unpack_from(payload)
+    offset = EVENTS_HEADER.size
+    events = []
+    for _ in range(count):
+        kind = EVENT_KIND.unpack_from(payload, offset)[0]
+        offset += EVENT_KIND.size
+        if kind == JOIN:
+            events.append(('join',) + JOIN_RECORD.unpack_from(payload, offset))
+            offset += JOIN_RECORD.size
+        elif kind == LEAVE:
+            events.append(('leave',) + LEAVE_RECORD.unpack_from(payload, offset))
+            offset += LEAVE_RECORD.size
+        elif kind == INPUT:
+            p_id, seq, move_x, move_y, flags = INPUT_RECORD.unpack_from(payload, offset)
+            events.append(('input', p_id, None if seq == NO_SEQ else seq, move_x, move_y, bool(flags & 1),
+                           bool(flags & 2)))
+            offset += INPUT_RECORD.size
+        elif kind == REWIND:
+            events.append(('rewind',) + REWIND_RECORD.unpack_from(payload, offset))
+            offset += REWIND_RECORD.size
+        else:
+            raise ValueError(f'unknown event kind {kind}')
+    return tick, events
+
+
+def encode_allocator(state):
+    generations, free = state
+    return (ALLOCATOR_HEADER.pack(len(generations), len(free)) +
+            struct.pack(f'<{len(generations)}H', *generations) + struct.pack(f'<{len(free)}H', *free))
+
+
+def decode_allocator(payload, offset):
+    slots, free_slots = ALLOCATOR_HEADER.unpack_from(payload, offset)
+    offset += ALLOCATOR_HEADER.size
+    generations = list(struct.unpack_from(f'<{slots}H', payload, offset))
+    offset += 2 * slots
+    free = list(struct.unpack_from(f'<{free_slots}H', payload, offset))
+    offset += 2 * free_slots
+    return (generations, free), offset
+
+
+def encode_history(history):
+    return HISTORY_HEADER.pack(len(history)) + b''.join(
+        HISTORY_TICK.pack(tick, len(positions)) + b''.join(HISTORY_RECORD.pack(*record) for record in positions)
+        for tick, positions in history)
+
+
+def decode_history(payload, offset):
+    history = []
+    count = HISTORY_HEADER.unpack_from(payload, offset)[0]
+    offset += HISTORY_HEADER.size
+    for _ in range(count):
+        tick, players = HISTORY_TICK.unpack_from(payload, offset)
+        offset += HISTORY_TICK.size
+        end = offset + players * HISTORY_RECORD.size
+        history.append((tick, list(HISTORY_RECORD.iter_unpack(payload[offset:end]))))
+        offset = end
+    return history, offset
+
+
+def encode_sim_state(tick, state):
+    # state: what GameServer.sim_state() returns
+    players, bullets, player_ids, bullet_ids, history = state
+    return protocol.frame(SIMSTATE, SIM_HEADER.pack(tick, len(players), len(bullets)) +
+                          b''.join(SIM_PLAYER.pack(*player) for player in players) +
+                          b''.join(SIM_BULLET.pack(*bullet) for bullet in bullets) +
+                          encode_allocator(player_ids) + encode_allocator(bullet_ids) + encode_history(history))
+
+
+def decode_sim_state(payload):
+    tick, player_count, bullet_count = SIM_HEADER.unpack_from(payload)
+    start = SIM_HEADER.size
+    end = start + player_count * SIM_PLAYER.size
+    players = list(SIM_PLAYER.iter_unpack(payload[start:end]))
+    start, end = end, end + bullet_count * SIM_BULLET.size
+    bullets = list(SIM_BULLET.iter_unpack(payload[start:end]))
+    player_ids, offset = decode_allocator(payload, end)
+    bullet_ids, offset = decode_allocator(payload, offset)
+    history, offset = decode_history(payload, offset)
+    return tick, (players, bullets, player_ids, bullet_ids, history)
+
+
+class ReplayRecorder:
+    # Appends the ticks of a GameServer to a replay log. Joins and leaves
+    # are reported as they happen and go out with the next tick's inputs.
+    # The file is flushed at every chunk, so a crash loses at most one.
+    def __init__(self, path, tick_rate, fire_interval, field, rewind_window=0, chunk_ticks=64):
+        self.path = path
+        self.chunk_ticks = chunk_ticks
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, chunk_ticks, tick_rate, fire_interval, *field, rewind_window))
+        # (first tick, offset) of every chunk
+        self.index = []
+        self.events = []
+        self.previous = None
+        self.previous_tick = None
+        self.chunk_length = 0
+        self.bytes_written = HEADER.size
+
+    @classmethod
+    def for_server(cls, path, server, chunk_ticks=64):
+        return cls(path, 1 / server.scheduler.tick_interval, server.fire_interval,
+                   (server.game_field_width, server.game_field_height), server.rewind_window, chunk_ticks)
+
+    def joined(self, player):
+        self.events.append(('join', player.id, player.x, player.y, player.hit_points))
+
+    def left(self, player):
+        self.events.append(('leave', player.id))
+
+    def rewound(self, player):
+        self.events.append(('rewind', player.id, player.rewind_ticks))
+
+    def record(self, tick, server, applied):
+        # after the step of tick; applied are the (id, seq, move x, move y,
+        # fire, pressed) inputs of GameServer.ingest_inputs()
+        events = self.events
+        events.extend(('input',) + entry for entry in applied)
+        self.events = []
+
+        snapshot = server.snapshot()
+        frames = []
+        if events:
+            frames.append(encode_events(tick, events))
+        if self.previous is None or self.chunk_length == self.chunk_ticks:
+            self.file.flush()
+            self.index.append((tick, self.bytes_written))
+            frames.append(protocol.encode_keyframe(tick, snapshot))
+            frames.append(encode_sim_state(tick, server.sim_state()))
+            self.chunk_length = 0
+        else:
+            frames.append(protocol.encode_delta(tick, self.previous_tick, self.previous, snapshot))
+        self.chunk_length += 1
+        self.previous = snapshot
+        self.previous_tick = tick
+
+        for frame in frames:
+            self.file.write(frame)
+            self.bytes_written += len(frame)
+
+    def close(self):
+        if self.file.closed:
+            return
+        last_tick = self.previous_tick if self.previous_tick is not None else 0
+        index_offset = self.bytes_written
+        self.file.write(protocol.frame(INDEX, INDEX_HEADER.pack(len(self.index), last_tick) +
+                                       b''.join(INDEX_ENTRY.pack(*entry) for entry in self.index)))
+        self.file.write(TRAILER.pack(index_offset, INDEX_MAGIC))
+        self.file.close()
+
+
+class ReplayReader:
+    # A replay log mapped into memory. Frames are decoded straight from the
+    # mapping, so opening a long log costs the index and nothing else, and
+    # seeking is a bisect over the chunks plus at most one chunk of deltas.
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.chunk_ticks, self.tick_rate, self.fire_interval, width, height, self.rewind_window = \
+            HEADER.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a replay log')
+        if version != VERSION:
+            raise ValueError(f'unsupported replay log version {version}')
+        self.field = (width, height)
+
+        # the frames end where the index starts, or where the last whole
+        # frame ends in a log that was not closed
+        self.end = len(self.data)
+        self.closed = False
+        if self.end >= HEADER.size + TRAILER.size:
+            index_offset, magic = TRAILER.unpack_from(self.data, self.end - TRAILER.size)
+            if magic == INDEX_MAGIC:
+                self.load_index(index_offset)
+        if not self.closed:
+            self.scan_index()
+        self.chunk_starts = [tick for tick, offset in self.index]
+
+    def load_index(self, offset):
+        length, frame_type = protocol.FRAME_HEADER.unpack_from(self.data, offset)
+        if frame_type != INDEX:
+            return
+        payload = memoryview(self.data)[offset + protocol.FRAME_HEADER.size:offset + protocol.FRAME_HEADER.size + length]
+        count, self.last_tick = INDEX_HEADER.unpack_from(payload)
+        self.index = list(INDEX_ENTRY.iter_unpack(payload[INDEX_HEADER.size:INDEX_HEADER.size + count * INDEX_ENTRY.size]))
+        self.end = offset
+        self.closed = True
+
+    def scan_index(self):
+        # every keyframe starts a chunk, together with the events of its
+        # tick right before it
+        self.index = []
+        self.last_tick = 0
+        events_tick = events_offset = None
+        for offset, frame_type, payload in self.frames(HEADER.size):
+            if frame_type == EVENTS:
+                events_tick, events_offset = EVENTS_HEADER.unpack_from(payload)[0], offset
+            elif frame_type in (protocol.KEYFRAME, protocol.DELTA):
+                tick = struct.unpack_from('<I', payload)[0]
+                if frame_type == protocol.KEYFRAME:
+                    self.index.append((tick, events_offset if events_tick == tick else offset))
+                self.last_tick = tick
+
+    def frames(self, offset):
+        # (offset, frame type, payload) from offset on, stopping at the end
+        # of the frames or at a frame that was not completely written
+        data = memoryview(self.data)
+        header_size = protocol.FRAME_HEADER.size
+        while offset + header_size <= self.end:
+            length, frame_type = protocol.FRAME_HEADER.unpack_from(data, offset)
+            start = offset + header_size
+            if start + length > self.end:
+                return
+            yield offset, frame_type, data[start:start + length]
+            offset = start + length
+
+    def chunk_for(self, tick):
+        # the index entry of the chunk holding tick, the first if before it
+        return self.index[max(bisect.bisect_right(self.chunk_starts, tick) - 1, 0)]
+
+    def ticks(self, start=0, end=None):
+        # (tick, snapshot, events) of every recorded tick from start up to
+        # and including end; snapshots are the dicts of protocol.py
+        if not self.index:
+            return
+        first_tick, offset = self.chunk_for(start)
+        snapshot = None
+        events = []
+        for offset, frame_type, payload in self.frames(offset):
+            if frame_type == EVENTS:
+                events = decode_events(payload)[1]
+                continue
+            if frame_type == protocol.KEYFRAME:
+                tick, snapshot = protocol.decode_keyframe(payload)
+            elif frame_type == protocol.DELTA:
+                tick, snapshot = protocol.decode_delta(snapshot, payload)
+            else:
+                continue
+            if end is not None and tick > end:
+                return
+            if tick >= start:
+                yield tick, snapshot, events
+            events = []
+
+    def sim_state(self, tick):
+        # (tick, state) of the newest chunk start at or before tick, the
+        # state to restore a server from
+        first_tick, offset = self.chunk_for(tick)
+        for offset, frame_type, payload in self.frames(offset):
+            if frame_type == SIMSTATE:
+                return decode_sim_state(payload)
+        raise ValueError(f'no simulation state for tick {tick}')
+
+    def close(self):
+        self.data.close()
+        self.file.close()
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import time
+
+from tracing import tracer
+
+
+class TickScheduler:
+    # Fixed timestep loop. Simulation steps are due every 1 / tick_rate
+    # seconds of the monotonic clock, independent of how long a step or a
+    # send takes, and sends are due every 1 / send_rate seconds.
+    #
+    # When the loop falls behind it runs up to max_catch_up steps back to
+    # back and skips the rest, so the simulation never spirals.
+    def __init__(self, tick_rate=20, send_rate=None, max_catch_up=5, report_interval=10,
+                 clock=time.monotonic, sleep=asyncio.sleep):
+        self.tick_interval = 1 / tick_rate
+        self.send_interval = 1 / (send_rate or tick_rate)
+        self.max_catch_up = max_catch_up
+        self.report_interval = report_interval
+        self.clock = clock
+        self.sleep = sleep
+
+        self.steps = 0
+        self.sends = 0
+        # wakeups that found more than one step due
+        self.overruns = 0
+        # steps dropped because even max_catch_up was not enough
+        self.skipped_steps = 0
+        # how late the first due step of a wakeup ran, in seconds
+        self.jitter_last = 0.0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.jitter_samples = 0
+
+    def stats(self):
+        return {
+            'steps': self.steps,
+            'sends': self.sends,
+            'overruns': self.overruns,
+            'skipped_steps': self.skipped_steps,
+            'jitter_last': self.jitter_last,
+            'jitter_mean': self.jitter_total / self.jitter_samples if self.jitter_samples else 0.0,
+            'jitter_max': self.jitter_max,
+        }
+
+    def run_due_steps(self, now, step):
+        if now < self.next_tick:
+            return
+
+        jitter = now - self.next_tick
+        self.jitter_last = jitter
+        self.jitter_total += jitter
+        self.jitter_max = max(self.jitter_max, jitter)
+        self.jitter_samples += 1
+
+        due = int(jitter / self.tick_interval) + 1
+        if due > 1:
+            self.overruns += 1
+        if due > self.max_catch_up:
+            skipped = due - self.max_catch_up
+            self.skipped_steps += skipped
+            self.next_tick += skipped * self.tick_interval
+            logging.warning(f'Tick overrun, skipped {skipped} steps')
+            due = self.max_catch_up
+
+        for _ in range(due):
+            step()
+            self.steps += 1
+            self.next_tick += self.tick_interval
+
+    async def run(self, step, send, max_steps=None):
+        # step() advances the simulation by one fixed step, send() is
+        # called at the send rate; neither may block. Returns once
+        # max_steps steps have run, or never without it.
+        self.next_tick = self.clock()
+        self.next_send = self.next_tick
+        next_report = self.next_tick + self.report_interval
+        while max_steps is None or self.steps < max_steps:
+            self.run_due_steps(self.clock(), step)
+
+            now = self.clock()
+            if now >= self.next_send:
+                send()
+                self.sends += 1
+                self.next_send += self.send_interval
+                # a send that is more than an interval late is dropped
+                if now - self.next_send > self.send_interval:
+                    self.next_send = now + self.send_interval
+
+            if now >= next_report:
+                if tracer.enabled('tick'):
+                    tracer('tick', 'Tick stats: %s', self.stats())
+                next_report = now + self.report_interval
+
+            delay = min(self.next_tick, self.next_send) - self.clock()
+            await self.sleep(max(delay, 0))
@@ -0,0 +1,56 @@
+class SpatialHash:
+    # uniform grid broadphase: items are bucketed by the cell their
+    # top-left corner falls into. With cell_size >= the largest item size
+    # two items can only overlap if their cells are neighbours.
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.item_cells = {}
+
+    def cell_of(self, x, y):
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def clear(self):
+        self.cells.clear()
+        self.item_cells.clear()
+
+    def insert(self, item, x, y):
+        cell = (int(x // self.cell_size), int(y // self.cell_size))
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            self.cells[cell] = [item]
+        else:
+            bucket.append(item)
+        self.item_cells[item] = cell
+
+    def remove(self, item):
+        cell = self.item_cells.pop(item, None)
+        if cell is None:
+            return
+        bucket = self.cells[cell]
+        bucket.remove(item)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, item, x, y):
+        cell = self.cell_of(x, y)
+        if self.item_cells.get(item) == cell:
+            return
+        self.remove(item)
+        self.cells.setdefault(cell, []).append(item)
+        self.item_cells[item] = cell
+
+    def query(self, x0, y0, x1, y1):
+        # every item whose cell intersects the rect (x0, y0)-(x1, y1)
+        cx0, cy0 = self.cell_of(x0, y0)
+        cx1, cy1 = self.cell_of(x1, y1)
+        found = []
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                bucket = self.cells.get((cx, cy))
+                if bucket:
+                    found.extend(bucket)
+        return found
+
+    def __len__(self):
+        return len(self.item_cells)
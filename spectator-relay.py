@@ -0,0 +1,211 @@
+# Fans a match out to spectators. The relay subscribes once to a game
+# server's watch port and sends what it receives on to any number of
+# game-client.py viewers, so the server encodes one extra delta per state
+# whether nobody or a thousand people are watching.
+#
+#   python game-server.py --watch-port 8889
+#   python spectator-relay.py --server localhost:8889 --port 8890 --delay 5
+#   python game-client.py --port 8890
+#
+# Every spectator has its own queue of up to --buffer states and its own
+# writer task. A state is sent as a delta against the last one that went
+# to that spectator, so a slow viewer loses the oldest states in its queue
+# and nobody else notices. --delay holds every state back by that many
+# seconds before it is shown, as match broadcasts do.
+
+import argparse
+import asyncio
+import collections
+import importlib
+import time
+
+import protocol
+from entity_ids import INDEX_MASK
+
+game_server = importlib.import_module('game-server')
+
+
+class Spectator:
+    def __init__(self, relay, reader, writer, buffer):
+        self.relay = relay
+        self.reader = reader
+        self.writer = writer
+        self.queue = collections.deque(maxlen=buffer)
+        self.wakeup = asyncio.Event()
+        self.use_binary = False
+        # seq and snapshot of the newest state sent, the next delta's base
+        self.sent = None
+        self.bytes_sent = 0
+        self.dropped = 0
+
+    def restart(self):
+        # the stream starts over: what is queued belongs to the old one and
+        # the next state goes as a keyframe
+        self.queue.clear()
+        self.sent = None
+
+    def push(self, seq, snapshot):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append((seq, snapshot))
+        self.wakeup.set()
+
+    async def discard(self):
+        # acks and inputs of the client are read and ignored
+        while await self.reader.read(4096):
+            pass
+
+    async def run(self):
+        self.use_binary = await protocol.accept_watcher(self.reader, self.writer, INDEX_MASK)
+        discarding = asyncio.create_task(self.discard())
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue:
+                    seq, snapshot = self.queue.popleft()
+                    frame = self.relay.frame(seq, snapshot, self.sent if self.use_binary else None, self.use_binary)
+                    self.sent = seq, snapshot
+                    self.writer.write(frame)
+                    await self.writer.drain()
+                    self.bytes_sent += len(frame)
+        finally:
+            discarding.cancel()
+
+
+class Relay:
+    def __init__(self, delay=0.0, buffer=64):
+        self.delay = delay
+        self.buffer = buffer
+        self.spectators = set()
+        # (due time, seq, snapshot) of the states being held back
+        self.delayed = collections.deque()
+        self.released = asyncio.Event()
+        # seq -> {baseline seq or 'text': frame}; spectators that keep up
+        # share the encoding of a state
+        self.frames = {}
+        self.received = 0
+        self.encoded = 0
+
+    def frame(self, seq, snapshot, sent, use_binary):
+        frames = self.frames.get(seq)
+        if frames is None:
+            frames = self.frames[seq] = {}
+        key = 'text' if not use_binary else sent[0] if sent is not None else None
+        frame = frames.get(key)
+        if frame is None:
+            self.encoded += 1
+            if not use_binary:
+                frame = game_server.encode_text_snapshot(snapshot)
+            elif sent is None:
+                frame = protocol.encode_keyframe(seq, snapshot)
+            else:
+                frame = protocol.encode_delta(seq, sent[0], sent[1], snapshot)
+            frames[key] = frame
+        return frame
+
+    def restart(self):
+        # a new subscription numbers its states from scratch, possibly for
+        # another world: nothing encoded or held back before may be reused
+        self.frames.clear()
+        self.delayed.clear()
+        for spectator in self.spectators:
+            spectator.restart()
+
+    def receive(self, seq, snapshot):
+        self.received += 1
+        if self.delay > 0:
+            self.delayed.append((time.monotonic() + self.delay, seq, snapshot))
+            self.released.set()
+        else:
+            self.broadcast(seq, snapshot)
+
+    def broadcast(self, seq, snapshot):
+        for spectator in self.spectators:
+            spectator.push(seq, snapshot)
+        # frames of states no queue can still hold are not needed again
+        for old in [s for s in self.frames if s <= seq - 2 * self.buffer]:
+            del self.frames[old]
+
+    async def release(self):
+        # hands the held back states on as they come due
+        while True:
+            if not self.delayed:
+                self.released.clear()
+                await self.released.wait()
+                continue
+            due, seq, snapshot = self.delayed[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            self.delayed.popleft()
+            self.broadcast(seq, snapshot)
+
+    async def watch(self, reader, writer):
+        spectator = Spectator(self, reader, writer, self.buffer)
+        self.spectators.add(spectator)
+        try:
+            await spectator.run()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.spectators.discard(spectator)
+            writer.close()
+
+    async def subscribe(self, host, port):
+        # the one connection to the server, made again when it breaks
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as e:
+                print(f'cannot subscribe to {host}:{port}: {e}, trying again')
+                await asyncio.sleep(1)
+                continue
+            print(f'Subscribed to {host}:{port}')
+            self.restart()
+            snapshots = protocol.SnapshotReceiver()
+            try:
+                while True:
+                    frame_type, payload = await protocol.read_frame(reader)
+                    received = snapshots.receive(frame_type, payload)
+                    if received is None:
+                        continue
+                    writer.write(protocol.encode_ack(received[0]))
+                    self.receive(*received)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                print(f'lost {host}:{port}, subscribing again')
+            finally:
+                writer.close()
+            await asyncio.sleep(1)
+
+    async def report(self, interval):
+        last_received = last_bytes = 0
+        while True:
+            await asyncio.sleep(interval)
+            sent = sum(spectator.bytes_sent for spectator in self.spectators)
+            print(f'{len(self.spectators)} spectators, {(self.received - last_received) / interval:.1f} states/s in, '
+                  f'{max(sent - last_bytes, 0) / interval / 1024:.1f} KiB/s out, {len(self.delayed)} held back, '
+                  f'{sum(spectator.dropped for spectator in self.spectators)} dropped, {self.encoded} frames encoded')
+            last_received, last_bytes = self.received, sent
+
+
+async def main(args):
+    host, _, port = args.server.rpartition(':')
+    relay = Relay(args.delay, args.buffer)
+    server = await asyncio.start_server(relay.watch, '0.0.0.0', args.port)
+    print(f'Spectators connect at {server.sockets[0].getsockname()}')
+    await asyncio.gather(server.serve_forever(), relay.subscribe(host or 'localhost', int(port)), relay.release(),
+                         relay.report(args.report))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', default='localhost:8889', help="[HOST:]PORT, the game server's --watch-port")
+    parser.add_argument('--port', type=int, default=8890, help='port game-client.py spectators connect to')
+    parser.add_argument('--delay', type=float, default=0, help='seconds every state is held back')
+    parser.add_argument('--buffer', type=int, default=64, help='states queued per spectator before the oldest go')
+    parser.add_argument('--report', type=float, default=10, help='seconds between reports')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
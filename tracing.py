@@ -0,0 +1,164 @@
+import logging
+import queue
+import sys
+import threading
+import time
+
+# Tracing for the hot paths: a state sent every tick, every input of every
+# client. Nothing is formatted where an event happens. A traced event is a
+# category, a %-style message and its arguments; a category that is off
+# costs one set lookup, and one that is on costs a logging.LogRecord put on
+# a bounded queue. A background thread formats and writes the records, and
+# when it falls behind records are dropped rather than the event loop being
+# made to wait. Categories can be sampled, keeping one event in N.
+#
+# The arguments are formatted later in another thread, so they must not be
+# changed after the call: pass numbers, strings and bytes, not live game
+# objects.
+#
+#   from tracing import tracer
+#   tracer('input', 'Player %d sent: %r', player.id, message)
+#
+# Categories used: state (states encoded and sent), input (inputs from
+# and to clients), tick (scheduler stats).
+
+FORMAT = 'TRACE %(asctime)s %(category)s: %(message)s'
+
+
+class Tracer:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.categories = frozenset()
+        self.all = False
+        # category -> keep one event in this many
+        self.sampling = {}
+        # category -> events seen, events queued
+        self.seen = {}
+        self.records = {}
+        self.sampled_out = 0
+        # records lost to a full queue
+        self.dropped = 0
+        # time spent in the calls, on the caller's thread
+        self.seconds = 0.0
+        self.logger = logging.getLogger('trace')
+        self.queue = None
+        self.handler = None
+        self.thread = None
+
+    def enabled(self, category):
+        # for call sites whose arguments cost something to gather
+        return self.all or category in self.categories
+
+    def __call__(self, category, message, *args):
+        if not (self.all or category in self.categories):
+            return
+        start = self.clock()
+        seen = self.seen[category] = self.seen.get(category, 0) + 1
+        if seen % self.sampling.get(category, 1):
+            self.sampled_out += 1
+        else:
+            record = self.logger.makeRecord(self.logger.name, logging.INFO, '', 0, message, args, None)
+            record.category = category
+            try:
+                self.queue.put_nowait(record)
+                self.records[category] = self.records.get(category, 0) + 1
+            except queue.Full:
+                self.dropped += 1
+        self.seconds += self.clock() - start
+
+    def start(self, categories, sampling=None, handler=None, max_queue=10000):
+        # categories: names or 'all'; sampling: category -> N; handler: a
+        # logging.Handler, by default one writing to stderr
+        if self.thread is not None:
+            self.stop()
+        categories = set(categories)
+        self.all = 'all' in categories
+        self.categories = frozenset(categories - {'all'})
+        self.sampling = dict(sampling or {})
+        if handler is None:
+            handler = logging.StreamHandler(sys.stderr)
+        if handler.formatter is None:
+            handler.setFormatter(logging.Formatter(FORMAT, datefmt='%F-%H-%M-%S'))
+        self.handler = handler
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self.write, name='tracer', daemon=True)
+        self.thread.start()
+
+    def write(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+
+    def stop(self):
+        # writes what is queued and turns tracing off
+        self.all = False
+        self.categories = frozenset()
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.handler.flush()
+
+    def stats(self):
+        events = sum(self.seen.values())
+        return {
+            'records': dict(self.records),
+            'sampled_out': self.sampled_out,
+            'dropped': self.dropped,
+            'seconds': self.seconds,
+            'us_per_event': self.seconds / events * 1e6 if events else 0.0,
+        }
+
+    def report(self):
+        stats = self.stats()
+        return (f'trace: {sum(stats["records"].values())} records, {stats["sampled_out"]} sampled out, '
+                f'{stats["dropped"]} dropped; {stats["seconds"] * 1000:.1f} ms spent tracing, '
+                f'{stats["us_per_event"]:.2f} us per event')
+
+    def register(self, registry):
+        # the tracer's own cost, as Prometheus metrics
+        records = registry.counter('trace_records_total', 'Trace records queued', ['category'])
+        sampled_out = registry.counter('trace_sampled_out_total', 'Trace events skipped by sampling')
+        dropped = registry.counter('trace_dropped_total', 'Trace records lost to a full queue')
+        seconds = registry.counter('trace_seconds_total', 'Time the traced code spent in the tracer')
+        depth = registry.gauge('trace_queue_depth', 'Trace records waiting to be written')
+
+        def collect():
+            for category, count in self.records.items():
+                records.set_total(count, category)
+            sampled_out.set_total(self.sampled_out)
+            dropped.set_total(self.dropped)
+            seconds.set_total(self.seconds)
+            depth.set(self.queue.qsize() if self.queue is not None else 0)
+        registry.on_collect(collect)
+
+
+tracer = Tracer()
+
+
+def add_trace_arguments(parser):
+    parser.add_argument('--trace', default=None,
+                        help='comma separated categories to trace (state, input, tick) or all (default: off)')
+    parser.add_argument('--trace-sample', default=None,
+                        help='CATEGORY=N,... trace one event in N of a category, e.g. state=20')
+    parser.add_argument('--trace-file', default=None, help='write the trace here instead of stderr')
+    parser.add_argument('--trace-queue', type=int, default=10000,
+                        help='records waiting to be written before more are dropped')
+
+
+def start_from_args(args):
+    # starts tracer from the options of add_trace_arguments, if --trace was
+    # given; returns whether it did
+    if not args.trace:
+        return False
+    sampling = {}
+    if args.trace_sample:
+        for part in args.trace_sample.split(','):
+            category, every = part.split('=')
+            sampling[category.strip()] = max(1, int(every))
+    handler = logging.FileHandler(args.trace_file) if args.trace_file else None
+    tracer.start([category.strip() for category in args.trace.split(',')], sampling, handler, args.trace_queue)
+    return True
@@ -0,0 +1,154 @@
+# Trains the preset dictionary of compression.py on snapshot traffic.
+#
+#   python train-dictionary.py                      # traffic of a headless game
+#   python train-dictionary.py --replay match.rep   # traffic of a recorded one
+#   python train-dictionary.py --check              # only compare, write nothing
+#
+# The traffic is what clients would have been sent: the text states, and
+# keyframes and deltas of binary clients that ack every state. A zlib
+# stream learns from its own history, so a dictionary only matters for the
+# first frames of a connection, before there is any: it is made of the
+# first frames of the training streams. It is checked on other traffic,
+# a game with another seed or other pieces of the replay, against no
+# dictionary and the current one, and written to snapshots.zdict, which
+# server and clients must share: its checksum is part of what the server
+# offers, so a client with another dictionary does not ask for
+# compression.
+
+import argparse
+import importlib
+import random
+import zlib
+
+import compression
+import protocol
+from headless import HeadlessOutbox, ScriptedClient, VirtualClock, run_headless
+
+game_server = importlib.import_module('game-server')
+bot_swarm = importlib.import_module('bot-swarm')
+
+
+class CapturingOutbox(HeadlessOutbox):
+    # keeps everything the client is sent
+    def __init__(self, client, frames):
+        super().__init__(client)
+        self.frames = frames
+
+    def send_control(self, data):
+        super().send_control(data)
+        self.frames.append(data)
+
+    def send_state(self, data):
+        super().send_state(data)
+        self.frames.append(data)
+
+
+def simulated_streams(args, seed):
+    # the frames sent to each client of a headless game, half of the
+    # clients text and half binary
+    random.seed(seed)
+    clock = VirtualClock()
+    server = game_server.GameServer(clock=clock, sleep=clock.sleep)
+    streams = []
+    clients = []
+    for number in range(args.clients):
+        client = ScriptedClient(server, bot_swarm.random_moves(random.Random(seed + number)),
+                                'binary' if number % 2 else 'text')
+        frames = []
+        client.player.outbox = CapturingOutbox(client, frames)
+        streams.append(frames)
+        clients.append(client)
+    run_headless(server, clients, args.ticks)
+    return streams
+
+
+def replay_streams(args):
+    # a text and a binary stream of the recorded ticks, cut into pieces of
+    # --ticks / 10 ticks as if clients had joined at those points
+    from replay import ReplayReader
+    replay = ReplayReader(args.replay)
+    try:
+        ticks = list(replay.ticks())
+    finally:
+        replay.close()
+    length = max(args.ticks // 10, 2)
+    streams = []
+    for start in range(0, len(ticks), length):
+        piece = ticks[start:start + length]
+        streams.append([game_server.encode_text_snapshot(snapshot) for tick, snapshot, events in piece])
+        binary = [protocol.encode_keyframe(piece[0][0], piece[0][1])]
+        for (base_tick, base, _), (tick, snapshot, _) in zip(piece, piece[1:]):
+            binary.append(protocol.encode_delta(tick, base_tick, base, snapshot))
+        streams.append(binary)
+    return streams
+
+
+def train(streams, size, first=3):
+    # the first frames of the streams, taken in turns from every stream
+    # until size is reached
+    dictionary = b''
+    for position in range(first):
+        for frames in streams:
+            if position < len(frames) and len(dictionary) + len(frames[position]) <= size:
+                dictionary += frames[position]
+    return dictionary
+
+
+def stream_size(frames, dictionary, level, first=None):
+    # compressed size of a client's stream, flushed after every frame as
+    # the server does, of the first `first` frames or of all of them
+    compressor = compression.StreamCompressor(level, dictionary)
+    for frame in frames[:first]:
+        compressor.compress(frame)
+    return compressor.bytes_in, compressor.bytes_out, compressor.seconds
+
+
+def check(streams, dictionaries, level):
+    for first in (3, 10, None):
+        line = []
+        for name, dictionary in dictionaries.items():
+            raw = out = 0
+            for frames in streams:
+                frames_in, frames_out, _ = stream_size(frames, dictionary, level, first)
+                raw += frames_in
+                out += frames_out
+            line.append(f'{name} {raw / max(out, 1):.2f}x')
+        print(f'{"whole streams" if first is None else f"first {first} frames"}: ' + ', '.join(line))
+    frames = sum(len(frames) for frames in streams)
+    total = sum(stream_size(frames, dictionaries['trained'], level)[2] for frames in streams)
+    print(f'compressing: {total / max(frames, 1) * 1e6:.1f} us per frame at level {level}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', default=None, help='train on a replay log instead of a headless game')
+    parser.add_argument('--ticks', type=int, default=2000, help='ticks of the headless game, or per replay piece x 10')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--size', type=int, default=16384, help='dictionary bytes, zlib uses at most 32768')
+    parser.add_argument('--level', type=int, default=6, help='zlib level to check with')
+    parser.add_argument('--output', default=compression.DICTIONARY_FILE)
+    parser.add_argument('--check', action='store_true', help='compare with the current dictionary, write nothing')
+    args = parser.parse_args()
+
+    if args.replay:
+        # every fourth piece of the replay, text and binary, is held back
+        streams = replay_streams(args)
+        training = [frames for number, frames in enumerate(streams) if number // 2 % 4 != 3]
+        held_back = [frames for number, frames in enumerate(streams) if number // 2 % 4 == 3]
+    else:
+        training = simulated_streams(args, args.seed)
+        held_back = simulated_streams(args, args.seed + 1)
+    dictionary = train(training, args.size)
+    print(f'{sum(len(frames) for frames in training)} frames in {len(training)} streams, '
+          f'dictionary of {len(dictionary)} bytes')
+    check(held_back, {'none': b'', 'current': compression.DICTIONARY, 'trained': dictionary}, args.level)
+
+    if not args.check:
+        with open(args.output, 'wb') as f:
+            f.write(dictionary)
+        print(f'written to {args.output}, offered as zd{zlib.adler32(dictionary):08x}')
+
+
+if __name__ == '__main__':
+    main()
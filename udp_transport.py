@@ -0,0 +1,403 @@
+import asyncio
+import logging
+import struct
+import time
+
+import protocol
+
+# Game traffic over UDP, for clients that would rather lose a state than
+# wait for it. Over TCP one lost segment holds back every state after it
+# until it has been resent; here every state is its own datagram and a
+# late or lost one is simply replaced by the next.
+#
+# Every datagram starts with
+#
+#   u8 kind, u32 sequence number
+#
+# and carries the same frames as the binary protocol (protocol.py):
+#
+#   RELIABLE      frames that must arrive: the handshake, the server's
+#                 control frames (HELLO, INPUT_ACK) and the client's
+#                 inputs. Acked one by one, resent until acked, delivered
+#                 once and in order.
+#   RELIABLE_ACK  the sequence number of a RELIABLE datagram that arrived
+#   STATE         a KEYFRAME or DELTA, split into fragments (u8 index, u8
+#                 count) that fit a datagram. States are numbered; one
+#                 older than a state already delivered is dropped, and so
+#                 is an incomplete one once a newer one is complete.
+#   UNRELIABLE    frames that may be lost, the client's state ACKs
+#   DISCONNECT    the other end is going away
+#
+# A connection opens with the client sending protocol.UPGRADE reliably;
+# the server answers with a HELLO frame holding the player id. A peer not
+# heard from for `timeout` seconds, or that leaves a reliable datagram
+# unacked through max_tries sends, is lost.
+
+PACKET_HEADER = struct.Struct('<BI')         # kind, sequence number
+FRAGMENT_HEADER = struct.Struct('<BB')       # fragment index, fragments
+
+RELIABLE = 1
+RELIABLE_ACK = 2
+STATE = 3
+UNRELIABLE = 4
+DISCONNECT = 5
+
+# state bytes per datagram, so a datagram stays below a typical MTU
+FRAGMENT_SIZE = 1200
+# largest reliable message, sent as one datagram
+MAX_RELIABLE = 60000
+
+
+class UdpConnection:
+    # One end of a connection; the server has one per client address, the
+    # client one in all. The owner feeds it datagrams, calls poll() a few
+    # times per round trip for resends and timeouts, and gets the frames
+    # through on_frames(data) and a lost connection through on_lost().
+    def __init__(self, transport, addr, on_frames, on_lost=None, clock=time.monotonic, timeout=5.0, max_tries=10,
+                 reorder_window=256):
+        self.transport = transport
+        # None when the socket is connected to the peer
+        self.addr = addr
+        self.on_frames = on_frames
+        self.on_lost = on_lost
+        self.clock = clock
+        self.timeout = timeout
+        self.max_tries = max_tries
+        self.reorder_window = reorder_window
+        self.closed = False
+        self.last_heard = clock()
+
+        # reliable sending: seq -> [datagram, last sent, sends]
+        self.next_reliable = 0
+        self.unacked = {}
+        self.srtt = None
+        # reliable receiving: the next seq to deliver and the ones after it
+        # that came early
+        self.expected = 0
+        self.early = {}
+
+        self.next_state = 0
+        # newest state delivered, and fragments of newer ones by seq
+        self.delivered_state = -1
+        self.fragments = {}
+
+        self.bytes_sent = 0
+        self.datagrams_sent = 0
+        self.resent = 0
+        self.states_sent = 0
+        # states that arrived too late or never completed
+        self.states_dropped = 0
+
+    def send(self, datagram):
+        self.transport.sendto(datagram, self.addr)
+        self.bytes_sent += len(datagram)
+        self.datagrams_sent += 1
+
+    def resend_timeout(self):
+        if self.srtt is None:
+            return 0.2
+        return min(max(2 * self.srtt, 0.05), 1.0)
+
+    def send_reliable(self, data):
+        if self.closed:
+            return
+        if len(data) > MAX_RELIABLE:
+            raise ValueError(f'reliable message of {len(data)} bytes')
+        seq = self.next_reliable
+        self.next_reliable += 1
+        datagram = PACKET_HEADER.pack(RELIABLE, seq) + data
+        self.unacked[seq] = [datagram, self.clock(), 1]
+        self.send(datagram)
+
+    def send_state(self, data):
+        # returns False for a state too big to be fragmented
+        if self.closed:
+            return True
+        count = max(1, -(-len(data) // FRAGMENT_SIZE))
+        if count > 255:
+            return False
+        seq = self.next_state
+        self.next_state += 1
+        for index in range(count):
+            self.send(PACKET_HEADER.pack(STATE, seq) + FRAGMENT_HEADER.pack(index, count) +
+                      data[index * FRAGMENT_SIZE:(index + 1) * FRAGMENT_SIZE])
+        self.states_sent += 1
+        return True
+
+    def send_unreliable(self, data):
+        if not self.closed:
+            self.send(PACKET_HEADER.pack(UNRELIABLE, 0) + data)
+
+    def datagram_received(self, datagram):
+        if self.closed or len(datagram) < PACKET_HEADER.size:
+            return
+        self.last_heard = self.clock()
+        kind, seq = PACKET_HEADER.unpack_from(datagram)
+        body = datagram[PACKET_HEADER.size:]
+        if kind == RELIABLE:
+            self.reliable_received(seq, body)
+        elif kind == RELIABLE_ACK:
+            entry = self.unacked.pop(seq, None)
+            # only datagrams sent once give a clean round trip
+            if entry is not None and entry[2] == 1:
+                rtt = self.clock() - entry[1]
+                self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) * 0.125
+        elif kind == STATE:
+            self.state_received(seq, body)
+        elif kind == UNRELIABLE:
+            self.on_frames(body)
+        elif kind == DISCONNECT:
+            self.lose()
+
+    def reliable_received(self, seq, body):
+        # ack every copy, the ack of an earlier one may have been lost
+        self.send(PACKET_HEADER.pack(RELIABLE_ACK, seq))
+        if seq < self.expected or seq in self.early or seq >= self.expected + self.reorder_window:
+            return
+        self.early[seq] = body
+        while self.expected in self.early and not self.closed:
+            self.on_frames(self.early.pop(self.expected))
+            self.expected += 1
+
+    def state_received(self, seq, body):
+        if seq <= self.delivered_state or len(body) < FRAGMENT_HEADER.size:
+            return
+        index, count = FRAGMENT_HEADER.unpack_from(body)
+        chunk = body[FRAGMENT_HEADER.size:]
+        if count == 1:
+            self.deliver_state(seq, chunk)
+            return
+        parts = self.fragments.get(seq)
+        if parts is None:
+            parts = self.fragments[seq] = [None] * count
+        if index >= len(parts):
+            return
+        parts[index] = chunk
+        if None not in parts:
+            self.deliver_state(seq, b''.join(parts))
+
+    def deliver_state(self, seq, data):
+        self.states_dropped += seq - self.delivered_state - 1
+        self.delivered_state = seq
+        for old in [s for s in self.fragments if s <= seq]:
+            del self.fragments[old]
+        self.on_frames(data)
+
+    def poll(self, now):
+        if self.closed:
+            return
+        if now - self.last_heard > self.timeout:
+            logging.error(f'UDP peer {self.addr} timed out')
+            self.lose()
+            return
+        timeout = self.resend_timeout()
+        for seq, entry in self.unacked.items():
+            datagram, sent, sends = entry
+            # back off on every resend of the same datagram
+            if now - sent < timeout * 2 ** (sends - 1):
+                continue
+            if sends >= self.max_tries:
+                logging.error(f'UDP peer {self.addr} does not ack')
+                self.lose()
+                return
+            self.send(datagram)
+            self.resent += 1
+            entry[1] = now
+            entry[2] = sends + 1
+
+    def lose(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.unacked.clear()
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def close(self):
+        # tell the peer, twice in case one is lost
+        if not self.closed:
+            for _ in range(2):
+                self.send(PACKET_HEADER.pack(DISCONNECT, 0))
+        self.lose()
+
+
+async def poll_connections(connections, interval=0.02):
+    # resends and timeouts of a collection of UdpConnections, forever
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        for connection in list(connections):
+            connection.poll(now)
+
+
+class UdpOutbox:
+    # The Outbox of a UDP client. Control frames go reliable, states as
+    # STATE datagrams. Nothing waits for the socket: a state is dropped
+    # when the transport already holds more than max_buffer bytes, and
+    # after max_backlog states in a row were dropped the client is closed.
+    def __init__(self, connection, max_backlog=40, max_buffer=65536, on_close=None):
+        self.connection = connection
+        self.max_backlog = max_backlog
+        self.max_buffer = max_buffer
+        self.on_close = on_close
+        self.closed = False
+        self.backlog = 0
+        self.dropped = 0
+        self.frames_sent = 0
+
+    @property
+    def bytes_sent(self):
+        return self.connection.bytes_sent
+
+    def start(self):
+        pass
+
+    def depth(self):
+        return len(self.connection.unacked)
+
+    def send_control(self, data):
+        if self.closed:
+            return
+        self.connection.send_reliable(data)
+        self.frames_sent += 1
+
+    def send_state(self, data):
+        if self.closed:
+            return
+        if (self.connection.transport.get_write_buffer_size() > self.max_buffer
+                or not self.connection.send_state(data)):
+            self.dropped += 1
+            self.backlog += 1
+            if self.backlog > self.max_backlog:
+                logging.error(f'Dropping UDP client after {self.backlog} undelivered states')
+                self.close()
+            return
+        self.backlog = 0
+        self.frames_sent += 1
+
+    def discard_state(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.connection.close()
+        if self.on_close is not None:
+            self.on_close()
+
+
+class UdpServer(asyncio.DatagramProtocol):
+    # The UDP side of a GameServer: a connection per client address, opened
+    # by a reliable protocol.UPGRADE. Frames from a client go to
+    # GameServer.handle_frames like the frames of a TCP client.
+    def __init__(self, game_server):
+        self.game_server = game_server
+        self.transport = None
+        # address -> UdpConnection, and the Player once the handshake is done
+        self.connections = {}
+        self.players = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        connection = self.connections.get(addr)
+        if connection is None:
+            # only the first datagram of a handshake opens a connection
+            if data != PACKET_HEADER.pack(RELIABLE, 0) + protocol.UPGRADE:
+                return
+            connection = UdpConnection(self.transport, addr, lambda frames: self.frames_received(addr, frames),
+                                       lambda: self.lost(addr))
+            self.connections[addr] = connection
+        connection.datagram_received(data)
+
+    def frames_received(self, addr, frames):
+        player = self.players.get(addr)
+        if player is None:
+            if frames == protocol.UPGRADE:
+                self.players[addr] = self.game_server.add_udp_player(self.connections[addr])
+            return
+        self.game_server.handle_frames(player, frames)
+
+    def lost(self, addr):
+        self.connections.pop(addr, None)
+        player = self.players.pop(addr, None)
+        if player is not None:
+            player.outbox.close()
+
+    def error_received(self, exc):
+        # an ICMP error about some earlier datagram, the timeouts handle it
+        pass
+
+    async def run(self):
+        await poll_connections(self.connections.values())
+
+
+class UdpClient(asyncio.DatagramProtocol):
+    # The client end. Frames that arrive are fed to a StreamReader, so they
+    # are read with protocol.read_frame() exactly as over TCP.
+    def __init__(self):
+        self.reader = asyncio.StreamReader()
+        self.connection = None
+        self.task = None
+
+    def connection_made(self, transport):
+        self.connection = UdpConnection(transport, None, self.reader.feed_data, self.reader.feed_eof)
+        self.task = asyncio.create_task(poll_connections([self.connection]))
+
+    def datagram_received(self, data, addr):
+        self.connection.datagram_received(data)
+
+    def error_received(self, exc):
+        # e.g. nothing listening yet, the handshake is resent
+        pass
+
+    def connection_lost(self, exc):
+        self.task.cancel()
+
+
+class UdpStreamWriter:
+    # the writer of a UDP client: inputs go reliable, the state acks that
+    # follow each other quickly go as plain datagrams
+    def __init__(self, client):
+        self.client = client
+
+    def write(self, data):
+        connection = self.client.connection
+        if protocol.FRAME_HEADER.unpack_from(data)[1] == protocol.INPUT:
+            connection.send_reliable(data)
+        else:
+            connection.send_unreliable(data)
+
+    async def drain(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return self.client.connection.transport.get_extra_info(name, default)
+
+    def close(self):
+        self.client.connection.close()
+        self.client.connection.transport.close()
+
+
+async def open_udp_connection(host, port, timeout=5.0):
+    # connects and completes the handshake; returns a reader, a writer and
+    # the player id
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(UdpClient, remote_addr=(host, port))
+    client.connection.send_reliable(protocol.UPGRADE)
+
+    async def hello():
+        # a state may overtake the HELLO, it is of no use without the id
+        while True:
+            frame_type, payload = await protocol.read_frame(client.reader)
+            if frame_type == protocol.HELLO:
+                return protocol.decode_hello(payload)
+
+    try:
+        player_id = await asyncio.wait_for(hello(), timeout)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+        transport.close()
+        raise ConnectionError(f'no UDP game server at {host}:{port}')
+    return client.reader, UdpStreamWriter(client), player_id